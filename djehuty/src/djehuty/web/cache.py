@@ -3,13 +3,102 @@ This module provides a general cache mechanism to avoid duplicated queries
 to the database server. Any object can be cached, as long as the object is
 serializable by means of 'json.dumps' and deseralizeable by means of
 'json.loads'.
+
+Cache items are stored in a directory tree that follows the components of
+their prefix, so that 'datasets_<uuid>' items live in 'store/datasets/<uuid>'.
+This makes invalidating a prefix a matter of removing one directory.
+For prefixes registered in 'stale_prefixes', invalidated items are moved
+to the 'stale' tree instead, from which 'stale_value' can still serve them.
+
+Optionally, an in-process least-recently-used tier, which all cache layers
+of a process share, can be enabled in front of the files on disk.
+Invalidations are communicated between processes through a small
+memory-mapped file of generation counters, so that looking up a hot item
+does not need to touch the filesystem.
 """
 
 import glob
 import os
+import re
+import shutil
+import uuid
 import logging
 import hashlib
 import json
+import mmap
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from djehuty.web.config import config
+
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
+GENERATION_SLOTS     = 256
+GENERATION_SLOT_SIZE = 8
+FLIGHT_SLOTS         = 4096
+STORE_DIRECTORY      = "store"
+STALE_DIRECTORY      = "stale"
+LEGACY_KEY_PATTERN   = re.compile ("^[0-9a-f]{32}$")
+
+class _MemoryTier:
+    """The least-recently-used items of the cache layers of a process."""
+
+    def __init__ (self):
+        self.items = OrderedDict()
+        self.size  = 0
+        self.lock  = Lock()
+
+## A server object, and with it its cache layer, may be created for each
+## request, so the memory tier and the files shared between processes are
+## kept per process instead.  Files are opened again after a fork, because
+## 'flock' locks belong to the open file, which a forked process would share.
+MEMORY            = _MemoryTier()
+SHARED_FILES      = {}
+SHARED_FILES_LOCK = Lock()
+
+def _open_shared (filename, size=None):
+    """
+    Returns a descriptor of FILENAME, opened once per process, and a shared
+    memory map of its first SIZE bytes, or None when SIZE is None.
+    """
+    with SHARED_FILES_LOCK:
+        entry = SHARED_FILES.get (filename)
+        if entry is None or entry[0] != os.getpid():
+            if entry is not None:
+                try:
+                    if entry[2] is not None:
+                        entry[2].close()
+                    os.close (entry[1])
+                except (OSError, ValueError):
+                    pass
+                del SHARED_FILES[filename]
+
+            file_fd = os.open (filename, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                mapping = None
+                if size is not None:
+                    if os.fstat (file_fd).st_size < size:
+                        os.ftruncate (file_fd, size)
+                    mapping = mmap.mmap (file_fd, size)
+            except (OSError, ValueError):
+                os.close (file_fd)
+                raise
+            entry = (os.getpid(), file_fd, mapping)
+            SHARED_FILES[filename] = entry
+    return entry[1], entry[2]
+
+def _private_copy (value):
+    """Returns a copy of VALUE that callers may modify without side-effects."""
+    if isinstance (value, list):
+        return [item.copy() if isinstance (item, dict) else item for item in value]
+    if isinstance (value, dict):
+        return value.copy()
+    return value
 
 class CacheLayer:
     """This class provides the caching layer."""
@@ -17,6 +106,9 @@ class CacheLayer:
     def __init__ (self, storage_path):
         self.storage     = storage_path
         self.log         = logging.getLogger(__name__)
+        self.generation_slots = {}
+        self.prefix_directories = {}
+        self.stale_prefixes = set()
 
     def make_key (self, input_string):
         """Procedure to turn 'input_string' into a short, unique identifier."""
@@ -34,21 +126,298 @@ class CacheLayer:
 
         try:
             os.makedirs(self.storage, mode=0o700, exist_ok=True)
-            return os.path.isdir(self.storage)
+            if not os.path.isdir(self.storage):
+                return False
+            if not config.clear_cache_on_start:
+                self.__migrate_flat_cache ()
+            return True
         except PermissionError:
             pass
 
         return False
 
+    ## ------------------------------------------------------------------------
+    ## Directory layout
+    ## ------------------------------------------------------------------------
+
+    def __prefix_directory (self, prefix):
+        """Returns the directory in which items for PREFIX are stored."""
+        directory = self.prefix_directories.get (prefix)
+        if directory is None:
+            directory = os.path.join (STORE_DIRECTORY, *prefix.split ("_"))
+            self.prefix_directories[prefix] = directory
+        return os.path.join (self.storage, directory)
+
+    def __stale_directory (self, prefix):
+        """Returns the directory in which outdated items for PREFIX are kept."""
+        return os.path.join (self.storage, STALE_DIRECTORY, *prefix.split ("_"))
+
+    def __retire_directory (self, prefix):
+        """Procedure to move the items of PREFIX to the stale tree."""
+        if not os.path.isdir (self.__prefix_directory (prefix)):
+            return None
+
+        stale_directory = self.__stale_directory (prefix)
+        self.__remove_directory (stale_directory)
+        try:
+            os.makedirs (os.path.dirname (stale_directory), mode=0o700, exist_ok=True)
+            os.rename (self.__prefix_directory (prefix), stale_directory)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            self.log.warning ("Failed to keep stale items for %s: %s", prefix, error)
+            self.__remove_directory (self.__prefix_directory (prefix))
+        return None
+
+    def __remove_directory (self, directory):
+        """Procedure to remove DIRECTORY without racing against writers."""
+        trash = os.path.join (self.storage, f".trash-{uuid.uuid4()}")
+        try:
+            os.rename (directory, trash)
+        except FileNotFoundError:
+            return None
+        except OSError as error:
+            self.log.warning ("Failed to move %s out of the way: %s", directory, error)
+            trash = directory
+
+        shutil.rmtree (trash, ignore_errors=True)
+        return None
+
+    def __migrate_flat_cache (self):
+        """
+        Procedure to move items written by earlier versions, which stored
+        every item as '<prefix>_<key>' in the cache root, into the prefix
+        directories.  Items whose prefix cannot be determined are removed.
+        """
+        migrated = 0
+        removed  = 0
+        with os.scandir (self.storage) as entries:
+            for entry in entries:
+                # Left-overs from an interrupted invalidation.
+                if entry.name.startswith (".trash-"):
+                    shutil.rmtree (entry.path, ignore_errors=True)
+                    continue
+                if entry.name.startswith (".") or not entry.is_file():
+                    continue
+
+                name, suffix = entry.name, ""
+                if name.endswith (".sparql"):
+                    name, suffix = name[:-7], ".sparql"
+
+                prefix, _, key = name.rpartition ("_")
+                try:
+                    if prefix and LEGACY_KEY_PATTERN.match (key):
+                        directory = self.__prefix_directory (prefix)
+                        os.makedirs (directory, mode=0o700, exist_ok=True)
+                        os.replace (entry.path, os.path.join (directory, f"{key}{suffix}"))
+                        migrated += 1
+                    else:
+                        os.remove (entry.path)
+                        removed += 1
+                except OSError as error:
+                    self.log.warning ("Failed to migrate cache item %s: %s", entry.path, error)
+
+        if migrated or removed:
+            self.log.info ("Migrated %d and removed %d cache items from the flat layout.",
+                           migrated, removed)
+        return None
+
+    ## ------------------------------------------------------------------------
+    ## In-process memory tier
+    ## ------------------------------------------------------------------------
+
+    def __memory_enabled (self):
+        return config.cache_memory_budget > 0 and self.storage is not None
+
+    def __generations (self):
+        """
+        Returns the descriptor and memory map of the generation counters
+        shared between processes, or None when they are unavailable.
+        """
+        try:
+            return _open_shared (os.path.join (self.storage, ".generations"),
+                                 GENERATION_SLOTS * GENERATION_SLOT_SIZE)
+        except (OSError, ValueError) as error:
+            self.log.warning ("Disabling the in-memory cache due to: %s", error)
+            config.cache_memory_budget = 0
+
+        return None
+
+    def __generation_slot (self, prefix):
+        """Returns the offset of the counter for PREFIX in the generations map."""
+        slot = self.generation_slots.get (prefix)
+        if slot is None:
+            slot = 1 + (zlib.crc32 (prefix.encode("utf-8")) % (GENERATION_SLOTS - 1))
+            slot = slot * GENERATION_SLOT_SIZE
+            self.generation_slots[prefix] = slot
+        return slot
+
+    def __generation_stamp (self, generations, prefix):
+        """
+        Returns the counters in GENERATIONS that invalidate items cached
+        under PREFIX.
+
+        Because 'invalidate_by_prefix' removes every item whose name starts
+        with the given prefix, an item in 'datasets_<uuid>' is invalidated by
+        both 'datasets' and 'datasets_<uuid>'.  Slot 0 is the global counter.
+        """
+        stamp = [struct.unpack_from ("<Q", generations, 0)[0]]
+        components = prefix.split ("_")
+        for index in range (1, len(components) + 1):
+            offset = self.__generation_slot ("_".join (components[:index]))
+            stamp.append (struct.unpack_from ("<Q", generations, offset)[0])
+        return tuple(stamp)
+
+    def __bump_generation (self, offset):
+        """Procedure to increment the counter at OFFSET for all processes."""
+        if not self.__memory_enabled():
+            return None
+        shared = self.__generations ()
+        if shared is None:
+            return None
+
+        generations_fd, generations = shared
+        if fcntl is not None:
+            fcntl.flock (generations_fd, fcntl.LOCK_EX)
+        try:
+            value = struct.unpack_from ("<Q", generations, offset)[0]
+            struct.pack_into ("<Q", generations, offset, value + 1)
+        finally:
+            if fcntl is not None:
+                fcntl.flock (generations_fd, fcntl.LOCK_UN)
+        return None
+
+    def __memory_ttl (self, prefix):
+        """Returns the time-to-live in seconds for PREFIX or None."""
+        ttls = config.cache_memory_ttls
+        if ttls:
+            components = prefix.split ("_")
+            for index in range (len(components), 0, -1):
+                ttl = ttls.get ("_".join (components[:index]))
+                if ttl is not None:
+                    return ttl
+        return config.cache_memory_default_ttl
+
+    def __memory_lookup (self, generations, prefix, key, is_raw):
+        memory_key = (self.storage, prefix, key, is_raw)
+        with MEMORY.lock:
+            entry = MEMORY.items.get (memory_key)
+            if entry is None:
+                return None
+            value, size, stamp, expires_at = entry
+            if ((expires_at is not None and expires_at < time.monotonic()) or
+                stamp != self.__generation_stamp (generations, prefix)):
+                del MEMORY.items[memory_key]
+                MEMORY.size -= size
+                return None
+            MEMORY.items.move_to_end (memory_key)
+
+        return _private_copy (value)
+
+    def __memory_store (self, prefix, key, value, size, stamp, is_raw):
+        ttl = self.__memory_ttl (prefix)
+        if ttl == 0 or size > config.cache_memory_budget:
+            return None
+
+        expires_at = None
+        if ttl is not None:
+            expires_at = time.monotonic() + ttl
+
+        memory_key = (self.storage, prefix, key, is_raw)
+        with MEMORY.lock:
+            previous = MEMORY.items.pop (memory_key, None)
+            if previous is not None:
+                MEMORY.size -= previous[1]
+            MEMORY.items[memory_key] = (_private_copy (value), size, stamp, expires_at)
+            MEMORY.size += size
+            while MEMORY.size > config.cache_memory_budget:
+                _, evicted = MEMORY.items.popitem (last=False)
+                MEMORY.size -= evicted[1]
+
+        return None
+
+    def __memory_invalidate (self, prefix=None):
+        with MEMORY.lock:
+            for memory_key in list(MEMORY.items.keys()):
+                storage, item_prefix = memory_key[:2]
+                if storage != self.storage:
+                    continue
+                if (prefix is None or item_prefix == prefix or
+                    item_prefix.startswith (f"{prefix}_")):
+                    MEMORY.size -= MEMORY.items.pop (memory_key)[1]
+
+        return None
+
+    ## ------------------------------------------------------------------------
+    ## Locks shared between processes
+    ## ------------------------------------------------------------------------
+
+    def lock_item (self, prefix, key, timeout=60):
+        """
+        Procedure to acquire a lock for an item that is shared between
+        processes.  Returns a handle to pass to 'unlock_item', or None when
+        the lock could not be acquired within TIMEOUT seconds.
+
+        Each item maps onto one byte of a single lock file.  Items that map
+        onto the same byte share a lock, which only serializes their
+        computation.  Because 'lockf' locks are held by the process, the
+        lock does not exclude other threads of the same process.
+        """
+        if fcntl is None or self.storage is None:
+            return None
+
+        try:
+            flights_fd, _ = _open_shared (os.path.join (self.storage, ".flights"))
+        except OSError as error:
+            self.log.warning ("Unable to open the cache lock file: %s", error)
+            return None
+
+        offset   = zlib.crc32 (f"{prefix}_{key}".encode("utf-8")) % FLIGHT_SLOTS
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.lockf (flights_fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                return (flights_fd, offset)
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.log.warning ("Gave up waiting for the lock on %s.", key)
+                    return None
+                time.sleep (0.05)
+
+    def unlock_item (self, handle):
+        """Procedure to release a lock acquired with 'lock_item'."""
+        if handle is None:
+            return None
+
+        flights_fd, offset = handle
+        fcntl.lockf (flights_fd, fcntl.LOCK_UN, 1, offset)
+        return None
+
+    ## ------------------------------------------------------------------------
+    ## Public interface
+    ## ------------------------------------------------------------------------
+
     def cached_value (self, prefix, key, is_raw=False):
         """Returns the cached value or None."""
+
+        stamp  = None
+        shared = self.__generations () if self.__memory_enabled() else None
+        if shared is not None:
+            cached = self.__memory_lookup (shared[1], prefix, key, is_raw)
+            if cached is not None:
+                return cached
+            # Take the stamp before reading the file so that an invalidation
+            # which happens while reading makes the memory copy outdated.
+            stamp = self.__generation_stamp (shared[1], prefix)
+
         try:
-            filename = os.path.join (self.storage, f"{prefix}_{key}")
+            filename = os.path.join (self.__prefix_directory (prefix), key)
             with open(filename, "r", encoding = "utf-8") as cache_file:
                 cached = cache_file.read()
-                if is_raw:
-                    return cached
-                return json.loads (cached)
+                value  = cached if is_raw else json.loads (cached)
+                if stamp is not None:
+                    self.__memory_store (prefix, key, value, len(cached), stamp, is_raw)
+                return value
         except OSError:
             self.log.debug ("No cached response for %s.", key)
         except json.decoder.JSONDecodeError:
@@ -59,36 +428,69 @@ class CacheLayer:
     def cache_value (self, prefix, key, value, query=None, is_raw=False):
         """Procedure to store 'value' as a cache."""
         try:
-            cache_filename = os.path.join (self.storage, f"{prefix}_{key}")
-            cache_fd = os.open (cache_filename, os.O_WRONLY | os.O_CREAT, 0o600)
+            serialized = value if is_raw else json.dumps(value)
+            directory  = self.__prefix_directory (prefix)
+            cache_filename = os.path.join (directory, key)
+            try:
+                cache_fd = os.open (cache_filename, os.O_WRONLY | os.O_CREAT, 0o600)
+            except FileNotFoundError:
+                os.makedirs (directory, mode=0o700, exist_ok=True)
+                cache_fd = os.open (cache_filename, os.O_WRONLY | os.O_CREAT, 0o600)
             with open(cache_fd, "w", encoding = "utf-8") as cache_file:
-                if is_raw:
-                    cache_file.write (value)
-                else:
-                    cache_file.write (json.dumps(value))
+                cache_file.write (serialized)
                 if os.name != 'nt':
                     os.fchmod (cache_fd, 0o400)  # pylint: disable=no-member
 
             if query is not None:
-                query_filename = os.path.join (self.storage, f"{prefix}_{key}.sparql")
+                query_filename = os.path.join (directory, f"{key}.sparql")
                 query_fd = os.open (query_filename, os.O_WRONLY | os.O_CREAT, 0o600)
                 with open(query_fd, "w", encoding = "utf-8") as query_file:
                     query_file.write(query)
                     if os.name != 'nt':
                         os.fchmod (query_fd, 0o400)  # pylint: disable=no-member
+
+            shared = self.__generations () if self.__memory_enabled() else None
+            if shared is not None:
+                self.__memory_store (prefix, key, value, len(serialized),
+                                     self.__generation_stamp (shared[1], prefix), is_raw)
         except OSError:
             self.log.warning ("Failed to save cache for %s.", key)
 
         return value
 
+    def stale_value (self, prefix, key):
+        """
+        Returns an invalidated value for PREFIX and KEY when PREFIX is
+        served stale-while-revalidate and the value is not older than the
+        configured maximum staleness, or None otherwise.
+        """
+        if (prefix not in self.stale_prefixes or
+            config.cache_max_staleness <= 0 or
+            self.storage is None):
+            return None
+
+        filename = os.path.join (self.__stale_directory (prefix), key)
+        try:
+            with open(filename, "r", encoding = "utf-8") as cache_file:
+                age = time.time() - os.fstat (cache_file.fileno()).st_mtime
+                if age > config.cache_max_staleness:
+                    return None
+                return json.loads (cache_file.read())
+        except OSError:
+            pass
+        except json.decoder.JSONDecodeError:
+            self.log.error ("Possible cache corruption at %s.", filename)
+
+        return None
+
     def invalidate_by_prefix (self, prefix):
         """Procedure to remove all cache items belonging to 'prefix'."""
-        for file_path in glob.glob(os.path.join(self.storage, f"{prefix}_*")):
-            try:
-                os.remove(file_path)
-            except FileNotFoundError:
-                self.log.warning ("Trying to remove %s multiple times.", file_path)
-
+        if prefix in self.stale_prefixes and config.cache_max_staleness > 0:
+            self.__retire_directory (prefix)
+        else:
+            self.__remove_directory (self.__prefix_directory (prefix))
+        self.__memory_invalidate (prefix)
+        self.__bump_generation (self.__generation_slot (prefix))
         return True
 
     def invalidate_all (self):
@@ -100,6 +502,12 @@ class CacheLayer:
         if self.storage in ("", "/"):
             return False
 
+        if config.cache_max_staleness > 0:
+            for prefix in self.stale_prefixes:
+                self.__retire_directory (prefix)
+        self.__remove_directory (os.path.join (self.storage, STORE_DIRECTORY))
+
+        # Remove items left behind by the flat layout of earlier versions.
         files = glob.glob(os.path.join(self.storage, "*"))
         self.log.info ("Removing %d files.", len(files))
         for file_path in files:
@@ -110,4 +518,6 @@ class CacheLayer:
             except IsADirectoryError:
                 pass
 
+        self.__memory_invalidate ()
+        self.__bump_generation (0)
         return True
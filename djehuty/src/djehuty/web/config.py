@@ -22,19 +22,48 @@ class RuntimeConfiguration:  # pylint: disable=too-few-public-methods
         self.transactions_directory      = "."
         self.static_cache_root           = None
         self.clear_cache_on_start        = False
+        self.cache_max_staleness         = 86400
+        self.cache_refresh_workers       = 2
+        self.cache_memory_budget         = 0
+        self.cache_memory_default_ttl    = None
+        self.cache_memory_ttls           = {}
+        self.coalesce_queries_between_workers = False
+        self.session_cache_ttl           = 5
+        self.session_cache_size          = 1024
         self.s3_buckets                  = {}
         self.s3_cache_storage            = None
+        self.s3_cache_budget             = 10737418240
+        self.s3_pool_size                = 10
+        self.s3_read_ahead               = 4
+        self.s3_read_ahead_memory        = 67108864
         self.storage_locations           = []
         self.storage                     = None
         self.secondary_storage           = None
         self.secondary_storage_quirks    = False
+        self.download_offload            = None
+        self.download_offload_locations  = {}
+        self.upload_chunk_size           = 1048576
+        self.upload_sha256               = False
+        self.upload_s3_bucket            = None
         self.endpoint                    = "http://127.0.0.1:8890/sparql"
         self.update_endpoint             = None
+        self.parallel_queries            = 8
+        self.sparql_pool_size            = 10
+        self.sparql_connect_timeout      = 10
+        self.sparql_read_timeout         = None
         self.state_graph                 = "https://data.4tu.nl/portal/self-test"
         self.privileges                  = {}
         self.thumbnail_storage           = None
+        self.thumbnail_widths            = [160, 320, 480]
+        self.thumbnail_avif              = False
+        self.job_storage                 = None
+        self.job_workers                 = 2
+        self.job_attempts                = 3
+        self.job_retry_delay             = 60
         self.profile_images_storage      = None
         self.iiif_cache_storage          = None
+        self.iiif_pyramid_workers        = 1
+        self.iiif_cache_budget           = 10737418240
         self.enable_query_audit_log      = False
         self.account_quotas              = {}
         self.group_quotas                = {}
@@ -7,18 +7,32 @@ import sys
 import uuid
 import secrets
 import os.path
+import time
 import logging
+from collections import OrderedDict
 from datetime import datetime
+from threading import Event, Lock, local
+from concurrent.futures import ThreadPoolExecutor
 from rdflib import Dataset, Graph, Literal, RDF, XSD, URIRef
 from rdflib.plugins.stores import sparqlstore, memory
 from rdflib.store import CORRUPTED_STORE, NO_STORE
+from rdflib.plugins.sparql.results.jsonresults import parseJsonTerm
 from jinja2 import Environment, FileSystemLoader
 from djehuty.web import cache
+from djehuty.web.pooled_store import PooledSPARQLUpdateStore
 from djehuty.utils import rdf
 from djehuty.utils import convenience as conv
 from djehuty.utils.constants import datetime_format
 from djehuty.web.config import config
 
+## Concurrent identical queries are coalesced, and the accounts of session
+## tokens are remembered, per process rather than per SparqlInterface,
+## because a server object may be created for each request.
+FLIGHTS            = {}
+FLIGHTS_LOCK       = Lock()
+SESSION_CACHE      = OrderedDict()
+SESSION_CACHE_LOCK = Lock()
+
 def rdflib_network_audit_hook (name, arguments):
     """Event handler to audit making unexpected network connections."""
 
@@ -31,6 +45,78 @@ def rdflib_network_audit_hook (name, arguments):
         logger = logging.getLogger(__name__)
         logger.audit ("Attempted to send a network request to %s", arguments[0])
 
+def normalize_integer (value):
+    """Returns VALUE, a numeric literal, as an integer."""
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+def normalize_boolean (value):
+    """Returns VALUE, a boolean literal, as a boolean."""
+    try:
+        return bool(int(value))
+    except ValueError:
+        return str(value).lower() == "true"
+
+def normalize_datetime (value):
+    """Returns VALUE, a dateTime literal, as a string without fractions and timezone."""
+    time_value = value.partition(".")[0]
+    if time_value[-1] == 'Z':
+        time_value = time_value[:-1]
+    if time_value.endswith("+00:00"):
+        time_value = time_value[:-6]
+    return time_value
+
+def normalize_string (value):
+    """Returns VALUE, a string literal, as a string or None."""
+    if value == "NULL":
+        return None
+    return str(value)
+
+## Literals of other data types are left out of normalized bindings.
+## Bindings that were produced with BIND() on Virtuoso have no XSD type.
+LITERAL_NORMALIZERS = {
+    XSD.integer:  normalize_integer,
+    XSD.decimal:  normalize_integer,
+    XSD.boolean:  normalize_boolean,
+    XSD.dateTime: normalize_datetime,
+    XSD.date:     lambda value: value,
+    XSD.string:   normalize_string,
+    None:         str
+}
+
+def binding_normalizer ():
+    """
+    Returns a procedure that turns a binding of a query result into a
+    dictionary of plain Python values.  The procedure remembers the
+    variable names it has seen, so it should be created once per result.
+    """
+
+    names        = {}
+    normalizers  = LITERAL_NORMALIZERS
+    literal_type = Literal
+
+    def normalize (row):
+        output = {}
+        for variable, value in row.items():
+            name = names.get (variable)
+            if name is None:
+                name = names[variable] = str(variable)
+
+            if value is None:
+                output[name] = None
+            elif isinstance (value, literal_type):
+                normalizer = normalizers.get (value.datatype)
+                if normalizer is not None:
+                    output[name] = normalizer (value)
+            else:
+                output[name] = str(value)
+
+        return output
+
+    return normalize
+
 class SparqlInterface:
     """This class reads and writes data from a SPARQL endpoint."""
 
@@ -45,6 +131,16 @@ class SparqlInterface:
         self.sparql       = None
         self.sparql_is_up = False
         self.store        = None
+        self.flights_lock = Lock()
+        self.refreshing   = set()
+        self.refresher    = None
+        self.query_pool   = None
+        self.request_scope = local()
+
+        # Statistics are expensive to compute and may be slightly outdated,
+        # so after invalidating them the previous values are served while
+        # they are being recalculated in the background.
+        self.cache.stale_prefixes.update (("repository_statistics", "statistics"))
 
     def setup_sparql_endpoint (self):
         """Procedure to be called after setting the 'endpoint' members."""
@@ -77,15 +173,24 @@ class SparqlInterface:
             if config.update_endpoint is None:
                 config.update_endpoint = config.endpoint
 
-            self.store = sparqlstore.SPARQLUpdateStore(
+            store_arguments = {
                 # Avoid rdflib from wrapping in a blank-node graph by setting
                 # context_aware to False.
-                context_aware   = False,
-                autocommit      = False,
-                query_endpoint  = config.endpoint,
-                update_endpoint = config.update_endpoint,
-                returnFormat    = "json",
-                method          = "POST")
+                "context_aware":   False,
+                "autocommit":      False,
+                "query_endpoint":  config.endpoint,
+                "update_endpoint": config.update_endpoint,
+                "returnFormat":    "json",
+                "method":          "POST"
+            }
+            if config.sparql_pool_size > 0:
+                self.store = PooledSPARQLUpdateStore(
+                    pool_size       = config.sparql_pool_size,
+                    connect_timeout = config.sparql_connect_timeout,
+                    read_timeout    = config.sparql_read_timeout,
+                    **store_arguments)
+            else:
+                self.store = sparqlstore.SPARQLUpdateStore(**store_arguments)
             # Set bind_namespaces so rdflib does not inject PREFIXes.
             self.sparql  = Graph(store = self.store, bind_namespaces = "none")
             self.log.info ("Using external RDF store.")
@@ -101,45 +206,6 @@ class SparqlInterface:
     def __log_query (self, query, prefix="Query"):
         self.log.info ("%s:\n---\n%s\n---", prefix, query)
 
-    def __normalize_binding (self, row):
-        output = {}
-        for name in row.keys():
-            if isinstance(row[name], Literal):
-                xsd_type = row[name].datatype
-                if xsd_type == XSD.integer:
-                    output[str(name)] = int(float(row[name]))
-                elif xsd_type == XSD.decimal:
-                    output[str(name)] = int(float(row[name]))
-                elif xsd_type == XSD.boolean:
-                    try:
-                        output[str(name)] = bool(int(row[name]))
-                    except ValueError:
-                        output[str(name)] = str(row[name]).lower() == "true"
-                elif xsd_type == XSD.dateTime:
-                    time_value = row[name].partition(".")[0]
-                    if time_value[-1] == 'Z':
-                        time_value = time_value[:-1]
-                    if time_value.endswith("+00:00"):
-                        time_value = time_value[:-6]
-                    output[str(name)] = time_value
-                elif xsd_type == XSD.date:
-                    output[str(name)] = row[name]
-                elif xsd_type == XSD.string:
-                    if row[name] == "NULL":
-                        output[str(name)] = None
-                    else:
-                        output[str(name)] = str(row[name])
-                # bindings that were produced with BIND() on Virtuoso
-                # have no XSD type.
-                elif xsd_type is None:
-                    output[str(name)] = str(row[name])
-            elif row[name] is None:
-                output[str(name)] = None
-            else:
-                output[str(name)] = str(row[name])
-
-        return output
-
     def __query_from_template (self, name, args=None):
         template   = self.jinja.get_template (f"{name}.sparql")
         parameters = {
@@ -159,7 +225,74 @@ class SparqlInterface:
 
         return self.__run_query (query)
 
-    def __run_query (self, query, cache_key_string=None, prefix=None, retries=5):
+    def __run_coalesced_query (self, query, cache_key_string, prefix, cache_key, retries):
+        """
+        Procedure to run QUERY only once for all concurrent callers that ask
+        for the same CACHE_KEY.  The callers that arrive while the query runs
+        wait for it to finish and read its result from the cache.
+        """
+
+        flight_key = (self.cache.storage, prefix, cache_key)
+        with FLIGHTS_LOCK:
+            flight    = FLIGHTS.get (flight_key)
+            is_leader = flight is None
+            if is_leader:
+                flight = Event()
+                FLIGHTS[flight_key] = flight
+
+        if not is_leader:
+            flight.wait (timeout=60)
+            cached = self.cache.cached_value (prefix, cache_key)
+            if cached is not None:
+                return cached
+
+            # The query failed, so its result wasn't cached.
+            return self.__run_query (query, cache_key_string, prefix, retries,
+                                     coalesce=False, allow_stale=False)
+
+        lock = None
+        try:
+            # The lock only excludes other processes: 'lockf' locks belong
+            # to the process, so threads of this process that hold keys in
+            # the same slot don't block each other.  Within this process,
+            # the map of flights is what lets a single caller run the query.
+            if config.coalesce_queries_between_workers:
+                lock = self.cache.lock_item (prefix, cache_key)
+
+            # Another worker process may have filled in the cache while
+            # we were waiting for the lock, which '__run_query' checks.
+            return self.__run_query (query, cache_key_string, prefix, retries,
+                                     coalesce=False, allow_stale=False)
+        finally:
+            self.cache.unlock_item (lock)
+            with FLIGHTS_LOCK:
+                del FLIGHTS[flight_key]
+            flight.set()
+
+    def __refresh_in_background (self, query, cache_key_string, prefix, cache_key):
+        """Procedure to recompute a stale cache item on a background thread."""
+
+        with self.flights_lock:
+            if (prefix, cache_key) in self.refreshing:
+                return None
+            self.refreshing.add ((prefix, cache_key))
+            if self.refresher is None:
+                self.refresher = ThreadPoolExecutor (
+                    max_workers = max(1, config.cache_refresh_workers),
+                    thread_name_prefix = "cache-refresh")
+
+        def refresh ():
+            try:
+                self.__run_query (query, cache_key_string, prefix, allow_stale=False)
+            finally:
+                with self.flights_lock:
+                    self.refreshing.discard ((prefix, cache_key))
+
+        self.refresher.submit (refresh)
+        return None
+
+    def __run_query (self, query, cache_key_string=None, prefix=None, retries=5,
+                     coalesce=True, allow_stale=True):
 
         cache_key = None
         if cache_key_string is not None:
@@ -167,6 +300,15 @@ class SparqlInterface:
             cached    = self.cache.cached_value(prefix, cache_key)
             if cached is not None:
                 return cached
+            if allow_stale:
+                cached = self.cache.stale_value (prefix, cache_key)
+                if cached is not None:
+                    self.__refresh_in_background (query, cache_key_string,
+                                                  prefix, cache_key)
+                    return cached
+            if coalesce:
+                return self.__run_coalesced_query (query, cache_key_string,
+                                                   prefix, cache_key, retries)
 
         results = []
         try:
@@ -190,7 +332,7 @@ class SparqlInterface:
                     self.__log_query (query)
                     return []
                 else:
-                    results = list(map(self.__normalize_binding,
+                    results = list(map(binding_normalizer (),
                                        query_results.bindings))
             else:
                 self.log.error ("Invalid query (%s, %s)", execution_type, query_type)
@@ -212,7 +354,8 @@ class SparqlInterface:
                     if retries > 0:
                         self.log.warning ("Retrying SPARQL request due to 503 (%s).", retries)
                         return self.__run_query (query, cache_key_string=cache_key_string,
-                                                 prefix=prefix, retries=retries-1)
+                                                 prefix=prefix, retries=retries-1,
+                                                 coalesce=False, allow_stale=False)
                     self.log.warning ("Giving up on retrying SPARQL request.")
                 self.log.error ("SPARQL endpoint returned %d:\n---\n%s\n---",
                                 error.code, error.reason)
@@ -237,6 +380,95 @@ class SparqlInterface:
 
         return results
 
+    def __run_query_iterator (self, query, cache_key_string=None, prefix=None):
+        """
+        Returns an iterator over the results of the SELECT QUERY.  Unlike
+        '__run_query', results are normalized while they are received from
+        the SPARQL endpoint.  With a CACHE_KEY_STRING, the results are
+        written to the cache once all of them have been received.
+        """
+
+        if cache_key_string is None:
+            return self.__stream_query (query)
+
+        cache_key = self.cache.make_key (cache_key_string)
+        cached    = self.cache.cached_value (prefix, cache_key)
+        if cached is not None:
+            return iter(cached)
+
+        return self.__stream_and_cache_query (query, prefix, cache_key)
+
+    def __stream_and_cache_query (self, query, prefix, cache_key):
+        """
+        Generator that yields the bindings of QUERY and caches them at the
+        end.  The bindings are held in memory until then, so large results
+        should be streamed without a cache key.
+        """
+
+        results = []
+        for binding in self.__stream_query (query):
+            results.append (binding)
+            yield binding
+
+        self.cache.cache_value (prefix, cache_key, results)
+
+    def __stream_query (self, query):
+        """
+        Generator that yields the normalized bindings of QUERY.  Errors are
+        logged and raised, because the bindings that were already yielded
+        would otherwise pass for the complete result.
+        """
+
+        try:
+            normalize = binding_normalizer ()
+            if isinstance (self.store, PooledSPARQLUpdateStore):
+                for binding in self.store.query_bindings (query):
+                    yield normalize ({ name: parseJsonTerm (term)
+                                       for name, term in binding.items() })
+                return
+
+            query_results = self.sparql.query (query)
+            if isinstance (query_results, tuple):
+                raise RuntimeError (f"Error executing query ({query_results[0]}): "
+                                    f"{query_results[1]}")
+            for binding in query_results.bindings:
+                yield normalize (binding)
+
+        except OSError as error:
+            self.log.error ("Streaming SPARQL query failed due to %s: %s",
+                            type(error).__name__, error)
+            self.__log_query (query)
+            raise
+        except Exception as error:
+            self.log.error ("SPARQL query failed.")
+            self.log.error ("Exception: %s: %s", type(error), error)
+            self.__log_query (query)
+            raise
+
+    def __run_in_parallel (self, calls):
+        """
+        Procedure to run the procedures in CALLS, a dictionary of names to
+        (procedure, keyword arguments) pairs, and return a dictionary of
+        names to their results.  Queries to an external SPARQL endpoint are
+        sent concurrently, because their latency is dominated by the
+        round-trip to the endpoint.
+        """
+
+        if (not isinstance (self.store, sparqlstore.SPARQLStore) or
+            config.parallel_queries <= 1):
+            return { name: procedure (**arguments)
+                     for name, (procedure, arguments) in calls.items() }
+
+        with self.flights_lock:
+            if self.query_pool is None:
+                self.query_pool = ThreadPoolExecutor (
+                    max_workers = config.parallel_queries,
+                    thread_name_prefix = "sparql-query")
+
+        futures = { name: self.query_pool.submit (procedure, **arguments)
+                    for name, (procedure, arguments) in calls.items() }
+        return { name: future.result() for name, future in futures.items() }
+
     def __insert_query_for_graph (self, graph, only_log_query=False):
         if config.enable_query_audit_log:
             query = rdf.insert_query (config.state_graph, graph)
@@ -402,7 +634,7 @@ class SparqlInterface:
                   is_published=True, is_under_review=None, git_uuid=None,
                   private_link_id_string=None, use_cache=True, is_restricted=None,
                   is_embargoed=None, is_software=None, organizations=None,
-                  codecheck_certificate_doi=None):
+                  codecheck_certificate_doi=None, as_iterator=False):
         """Procedure to retrieve version(s) of datasets."""
 
         filters  = rdf.sparql_filter ("container_uri",  rdf.uuid_to_uri (container_uuid, "container"), is_uri=True)
@@ -472,8 +704,13 @@ class SparqlInterface:
         if not return_count:
             query += rdf.sparql_suffix (order, order_direction, limit, offset)
 
+        cache_prefix = f"datasets_{account_uuid}" if account_uuid is not None else "datasets"
+        if as_iterator:
+            if use_cache:
+                return self.__run_query_iterator (query, query, cache_prefix)
+            return self.__run_query_iterator (query)
+
         if use_cache:
-            cache_prefix = f"datasets_{account_uuid}" if account_uuid is not None else "datasets"
             return self.__run_query (query, query, cache_prefix)
 
         return self.__run_query (query)
@@ -483,12 +720,16 @@ class SparqlInterface:
         query = self.__query_from_template ("missing_dois")
         return self.__run_query (query)
 
-    def repository_file_statistics (self, extended_properties=False, use_cache=False):
+    def repository_file_statistics (self, extended_properties=False, use_cache=False,
+                                    as_iterator=False):
         """Returns files and their sizes, and optionally more properties."""
         query = self.__query_from_template ("statistics_files", {
             "extended_properties": extended_properties
         })
 
+        if as_iterator:
+            return self.__run_query_iterator (query)
+
         if use_cache:
             return self.__run_query (query, query, "repository_statistics")
 
@@ -764,6 +1005,28 @@ class SparqlInterface:
 
         return self.__run_query(query)
 
+    def authors_for_items (self, item_uris, item_type="dataset"):
+        """
+        Returns a dictionary mapping each of ITEM_URIS to the list of its
+        authors, gathered in a single query.
+        """
+
+        authors = { item_uri: [] for item_uri in item_uris }
+        if not authors:
+            return authors
+
+        query = self.__query_from_template ("authors_for_items", {
+            "item_uris": list(authors.keys()),
+            "prefix":    item_type.capitalize()
+        })
+
+        for record in self.__run_query (query):
+            item_uri = record.pop ("item_uri")
+            if item_uri in authors:
+                authors[item_uri].append (record)
+
+        return authors
+
     def author_profile (self, author_uri):
         """Returns author and account information for an AUTHOR_URI."""
         query = self.__query_from_template ("author_profile", {
@@ -1167,6 +1430,49 @@ class SparqlInterface:
 
         return self.__run_query(query)
 
+    def item_metadata_bundle (self, item, item_type="dataset", parts=None,
+                              files_parameters=None):
+        """
+        Returns the records that accompany ITEM on its landing page as a
+        dictionary with the keys 'versions', 'authors', 'files', 'tags',
+        'categories', 'references', 'derived_from', 'fundings',
+        'collections' (for datasets) and 'datasets' (for collections).
+        Pass PARTS to only gather a subset of these records.
+        """
+
+        item_uri      = rdf.uuid_to_uri (item["uuid"], item_type)
+        container_uri = rdf.uuid_to_uri (item["container_uuid"], "container")
+        calls = {
+            "authors":    (self.authors,    { "item_uri": item_uri,
+                                              "item_type": item_type,
+                                              "limit": None }),
+            "tags":       (self.tags,       { "item_uri": item_uri, "limit": None }),
+            "categories": (self.categories, { "item_uri": item_uri, "limit": None }),
+            "references": (self.references, { "item_uri": item_uri, "limit": None }),
+            "fundings":   (self.fundings,   { "item_uri": item_uri,
+                                              "item_type": item_type,
+                                              "limit": None })
+        }
+
+        if item_type == "dataset":
+            if files_parameters is None:
+                files_parameters = {}
+            calls["versions"]     = (self.dataset_versions, { "container_uri": container_uri })
+            calls["derived_from"] = (self.derived_from, { "item_uri": item_uri, "limit": None })
+            calls["collections"]  = (self.collections_from_dataset,
+                                     { "dataset_container_uuid": item["container_uuid"] })
+            calls["files"]        = (self.dataset_files, { "dataset_uri": item_uri,
+                                                           "order": "order_name",
+                                                           **files_parameters })
+        else:
+            calls["versions"]     = (self.collection_versions, { "container_uri": container_uri })
+            calls["datasets"]     = (self.collection_datasets, { "collection_uri": item_uri })
+
+        if parts is not None:
+            calls = { name: call for name, call in calls.items() if name in parts }
+
+        return self.__run_in_parallel (calls)
+
     ## ------------------------------------------------------------------------
     ## INSERT METHODS
     ## ------------------------------------------------------------------------
@@ -1514,7 +1820,9 @@ class SparqlInterface:
         })
 
         self.cache.invalidate_by_prefix ("accounts")
-        return self.__run_logged_query (query)
+        result = self.__run_logged_query (query)
+        self.__invalidate_sessions ()
+        return result
 
     def quota_requests (self, status=None, quota_request_uuid=None, account_uuid=None):
         """Procedure to return a list of quota requests."""
@@ -1569,6 +1877,7 @@ class SparqlInterface:
 
         self.cache.invalidate_by_prefix ("group")
         self.cache.invalidate_by_prefix ("accounts")
+        self.__invalidate_sessions ()
 
         results = self.__run_logged_query (query)
         if results and categories:
@@ -1697,6 +2006,7 @@ class SparqlInterface:
 
         if self.add_triples_from_graph (graph):
             self.cache.invalidate_by_prefix ("accounts")
+            self.__invalidate_sessions ()
 
             if email is not None and (first_name is not None or last_name is not None):
                 account_uuid = rdf.uri_to_uuid (account_uri)
@@ -1746,7 +2056,9 @@ class SparqlInterface:
         })
 
         self.cache.invalidate_by_prefix ("accounts")
-        return self.__run_logged_query (query)
+        result = self.__run_logged_query (query)
+        self.__invalidate_sessions ()
+        return result
 
     def insert_funding (self, title=None, grant_code=None, funder_name=None,
                         account_uuid=None, url=None, funding_id=None):
@@ -1897,7 +2209,8 @@ class SparqlInterface:
     def update_file (self, account_uuid, file_uuid, dataset_uuid, download_url=None,
                      computed_md5=None, viewer_type=None, preview_state=None,
                      file_size=None, status=None, filesystem_location=None,
-                     is_incomplete=None, is_image=None, handle=None):
+                     is_incomplete=None, is_image=None, handle=None,
+                     computed_crc32=None, computed_sha256=None):
         """Procedure to update file metadata."""
 
         modified_date = datetime.strftime (datetime.now(), datetime_format)
@@ -1907,6 +2220,8 @@ class SparqlInterface:
             "filesystem_location": filesystem_location,
             "download_url":  download_url,
             "computed_md5":  computed_md5,
+            "computed_crc32": computed_crc32,
+            "computed_sha256": computed_sha256,
             "viewer_type":   viewer_type,
             "preview_state": preview_state,
             "file_size":     file_size,
@@ -1919,7 +2234,22 @@ class SparqlInterface:
 
         self.cache.invalidate_by_prefix (f"{account_uuid}_storage")
         self.cache.invalidate_by_prefix (f"{dataset_uuid}_dataset_storage")
+        if filesystem_location is not None:
+            self.cache.invalidate_by_prefix (f"locations_{file_uuid}")
+
+        return self.__run_logged_query (query)
 
+    def insert_missing_crc32 (self, file_uuid, computed_crc32):
+        """
+        Procedure to store COMPUTED_CRC32 for a file without a CRC-32
+        checksum.  Unlike 'update_file', this leaves the modification date
+        of the file alone, because its contents did not change.
+        """
+
+        query = self.__query_from_template ("insert_missing_crc32", {
+            "file_uuid":      file_uuid,
+            "computed_crc32": computed_crc32
+        })
         return self.__run_logged_query (query)
 
     def insert_log_entry (self, created_date, ip_address, item_uuid,
@@ -3217,22 +3547,102 @@ class SparqlInterface:
 
         return account
 
+    def begin_request (self):
+        """Procedure to start remembering the accounts resolved for a request."""
+        self.request_scope.accounts = {}
+
+    def end_request (self):
+        """Procedure to forget the accounts resolved for a request."""
+        self.request_scope.accounts = None
+
+    def __cached_session_account (self, session_token):
+        """Returns a tuple of whether SESSION_TOKEN was cached and its account."""
+
+        accounts = getattr (self.request_scope, "accounts", None)
+        if accounts is not None and session_token in accounts:
+            return True, accounts[session_token]
+
+        if config.session_cache_ttl <= 0:
+            return False, None
+
+        with SESSION_CACHE_LOCK:
+            try:
+                expires, account = SESSION_CACHE[session_token]
+            except KeyError:
+                return False, None
+            if expires < time.monotonic():
+                del SESSION_CACHE[session_token]
+                return False, None
+            SESSION_CACHE.move_to_end (session_token)
+
+        if accounts is not None:
+            accounts[session_token] = account
+        return True, account
+
+    def __cache_session_account (self, session_token, account):
+        """Procedure to remember ACCOUNT as the account of SESSION_TOKEN."""
+
+        accounts = getattr (self.request_scope, "accounts", None)
+        if accounts is not None:
+            accounts[session_token] = account
+
+        if config.session_cache_ttl <= 0:
+            return None
+
+        with SESSION_CACHE_LOCK:
+            SESSION_CACHE[session_token] = (time.monotonic() + config.session_cache_ttl,
+                                            account)
+            SESSION_CACHE.move_to_end (session_token)
+            while len(SESSION_CACHE) > config.session_cache_size:
+                SESSION_CACHE.popitem (last=False)
+
+        return None
+
+    def __invalidate_sessions (self, session_token=None):
+        """
+        Procedure to forget the account of SESSION_TOKEN, or the accounts of
+        all sessions when SESSION_TOKEN is None.
+        """
+
+        accounts = getattr (self.request_scope, "accounts", None)
+        with SESSION_CACHE_LOCK:
+            if session_token is None:
+                SESSION_CACHE.clear()
+                if accounts is not None:
+                    accounts.clear()
+            else:
+                SESSION_CACHE.pop (session_token, None)
+                if accounts is not None:
+                    accounts.pop (session_token, None)
+
     def account_by_session_token (self, session_token, mfa_token=None):
         """Returns an account record or None."""
 
         if session_token is None:
             return None
 
+        ## Sessions awaiting their second factor are never cached.
+        if mfa_token is None:
+            is_cached, account = self.__cached_session_account (session_token)
+            if is_cached:
+                return None if account is None else account.copy()
+
         query = self.__query_from_template ("account_by_session_token", {
             "token":       rdf.escape_string_value (session_token),
             "mfa_token":   mfa_token
         })
 
+        account = None
         results = self.__run_query (query)
         if results:
-            return self.__account_with_privileges_and_quotas (results[0])
+            account = self.__account_with_privileges_and_quotas (results[0])
 
-        return None
+        if mfa_token is None:
+            self.__cache_session_account (session_token, account)
+            if account is not None:
+                account = account.copy()
+
+        return account
 
     def __privileged_role_email_addresses (self, privilege, domain=None):
         """
@@ -3339,6 +3749,18 @@ class SparqlInterface:
         })
         return self.__run_query (query)
 
+    def missing_crc32_files (self):
+        """Returns the files for which no CRC-32 checksum is stored."""
+
+        query = self.__query_from_template ("missing_crc32_files")
+        return self.__run_query (query)
+
+    def image_files (self):
+        """Returns the files that are marked as images."""
+
+        query = self.__query_from_template ("image_files")
+        return self.__run_query (query)
+
     def initialize_privileged_accounts (self):
         """Ensures privileged accounts are present in the database."""
 
@@ -3405,6 +3827,7 @@ class SparqlInterface:
         rdf.add (graph, link_uri, rdf.DJHT["active"], (mfa_token is None), XSD.boolean)
 
         if self.add_triples_from_graph (graph):
+            self.__invalidate_sessions (token)
             return token, mfa_token, rdf.uri_to_uuid (link_uri)
 
         return None, None, None
@@ -3419,13 +3842,17 @@ class SparqlInterface:
             "active":        rdf.escape_boolean_value (active)
         })
 
-        return self.__run_logged_query (query)
+        result = self.__run_logged_query (query)
+        self.__invalidate_sessions ()
+        return result
 
     def delete_all_sessions (self):
         """Procedure to delete all sessions."""
 
         query = self.__query_from_template ("delete_sessions")
-        return self.__run_logged_query (query)
+        result = self.__run_logged_query (query)
+        self.__invalidate_sessions ()
+        return result
 
     def delete_inactive_session_by_uuid (self, session_uuid):
         """Procedure to remove an inactive session by its UUID alone."""
@@ -3434,7 +3861,9 @@ class SparqlInterface:
             "session_uuid": session_uuid
         })
 
-        return self.__run_logged_query (query)
+        result = self.__run_logged_query (query)
+        self.__invalidate_sessions ()
+        return result
 
     def delete_session_by_uuid (self, account_uuid, session_uuid):
         """Procedure to remove a session from the state graph."""
@@ -3444,7 +3873,9 @@ class SparqlInterface:
             "account_uuid":  account_uuid
         })
 
-        return self.__run_logged_query (query)
+        result = self.__run_logged_query (query)
+        self.__invalidate_sessions ()
+        return result
 
     def delete_sessions_older_than (self, timestamp, name):
         """Procedure to prune old sessions from the state graph."""
@@ -3453,7 +3884,9 @@ class SparqlInterface:
             "timestamp":  rdf.escape_string_value (timestamp),
             "name":       rdf.escape_string_value (name)
         })
-        return self.__run_logged_query (query)
+        result = self.__run_logged_query (query)
+        self.__invalidate_sessions ()
+        return result
 
     def delete_session (self, token):
         """Procedure to remove a session from the state graph."""
@@ -3464,7 +3897,9 @@ class SparqlInterface:
         query = self.__query_from_template ("delete_session", {
             "token": rdf.escape_string_value (token)
         })
-        return self.__run_logged_query (query)
+        result = self.__run_logged_query (query)
+        self.__invalidate_sessions (token)
+        return result
 
     def sessions (self, account_uuid, session_uuid=None, mfa_token=None):
         """Returns the sessions for an account."""
@@ -3670,7 +4105,7 @@ class SparqlInterface:
 
     def __export_rdf_to_file (self, query, export_directory, filename):
 
-        records   = self.__run_query (query)
+        records   = self.__run_query_iterator (query)
         stream_fd = os.open (os.path.join (export_directory, filename),
                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
 
@@ -0,0 +1,479 @@
+"""
+This module implements the image transformations of the IIIF image API,
+and pyramidal TIFF copies of images from which IIIF image requests read
+only the resolution level they need.
+"""
+
+import os
+import re
+import time
+import shutil
+import logging
+from math import ceil, floor, log2
+from threading import Lock, get_ident
+from concurrent.futures import ThreadPoolExecutor
+from djehuty.web.config import config
+from djehuty.web import s3
+
+## Error handling for loading pyvips is done in 'ui'.
+try:
+    import pyvips
+except (OSError, ImportError, ModuleNotFoundError):
+    pass
+
+TILE_SIZE         = 1024
+PYRAMID_TILE_SIZE = 256
+TOUCH_INTERVAL    = 3600
+CLAIM_TIMEOUT     = 3600
+SAFE_NAME         = re.compile (r"[0-9A-Za-z,.:!^_-]+")
+LEGACY_NAME       = re.compile (r"[0-9a-f]{32}")
+
+## Pyramids are created on one pool of threads per process, and the
+## counters of the cache are kept per process, even when the web server
+## object, and thus its Pyramids and DerivativeCache, is created more
+## than once.
+EXECUTORS_LOCK    = Lock()
+EXECUTORS         = {}
+COUNTERS_LOCK     = Lock()
+COUNTERS          = {}
+
+def level_sizes (width, height, tile_size=TILE_SIZE):
+    """
+    Returns the scale factors and sizes of the resolution levels of an
+    image of WIDTH by HEIGHT pixels, from the full size downwards until the
+    image fits in a single tile.
+    """
+    layers = max(0, ceil(log2(max(width, height) / tile_size)))
+    scale_factors = [pow(2, layer) for layer in range(layers + 1)]
+    sizes = [{ "width": ceil(width / factor), "height": ceil(height / factor) }
+             for factor in scale_factors]
+    return scale_factors, sizes
+
+def _loader (image):
+    """Returns the name of the loader that opened IMAGE, or None."""
+    if image.get_typeof ("vips-loader") == 0:
+        return None
+    return image.get ("vips-loader")
+
+def _crop (image, full_image, region):
+    """Returns REGION of FULL_IMAGE from IMAGE, a scaled copy of it."""
+    scale  = image.width / full_image.width
+    left   = min(int(region["x"] * scale), image.width - 1)
+    top    = min(int(region["y"] * scale), image.height - 1)
+    width  = max(1, min(round(region["w"] * scale), image.width - left))
+    height = max(1, min(round(region["h"] * scale), image.height - top))
+    return image.crop (left, top, width, height)
+
+def load_region (filename, full_image, region, size):
+    """
+    Returns REGION of the image in FILENAME, in full resolution pixels of
+    FULL_IMAGE, without decoding the image beforehand.  When the output of
+    SIZE is smaller, formats that can shrink while loading are loaded at
+    the smallest resolution that is still large enough.
+    """
+    is_full = (region["x"] == 0 and region["y"] == 0 and
+               region["w"] >= full_image.width and region["h"] >= full_image.height)
+    if is_full:
+        return pyvips.Image.thumbnail (filename, max(1, round(size["w"])),
+                                       height    = max(1, round(size["h"])),
+                                       size      = "force",
+                                       no_rotate = True)
+
+    shrink = min(region["w"] / max(size["w"], 1), region["h"] / max(size["h"], 1))
+    factor = 1
+    while factor < 8 and factor * 2 <= shrink:
+        factor *= 2
+
+    loader = _loader (full_image)
+    if loader == "jpegload" and factor > 1:
+        image = pyvips.Image.new_from_file (filename, shrink=factor, access="sequential")
+    elif loader == "webpload" and factor > 1:
+        image = pyvips.Image.new_from_file (filename, scale=1 / factor, access="sequential")
+    elif loader == "pdfload":
+        image = pyvips.Image.new_from_file (filename, dpi=300 / factor)
+    else:
+        image = pyvips.Image.new_from_file (filename, access="sequential")
+
+    return _crop (image, full_image, region)
+
+def transform (image, size, mirror=False, rotation=0, quality="default"):
+    """Returns IMAGE resized to SIZE, mirrored, rotated and in QUALITY."""
+    image = image.thumbnail_image (max(1, round(size["w"])),
+                                   height = max(1, round(size["h"])),
+                                   size   = "force")
+    if mirror:
+        image = image.fliphor()
+    if rotation not in (0, 360):
+        # Rotating needs random access, which the resized image allows
+        # without holding more than its own pixels.
+        image = image.copy_memory()
+        if rotation == 90:
+            image = image.rot90()
+        elif rotation == 180:
+            image = image.rot180()
+        elif rotation == 270:
+            image = image.rot270()
+        else:
+            image = image.similarity (angle=rotation)
+    if quality == "gray":
+        image = image.colourspace (pyvips.enums.Interpretation.B_W)
+
+    return image
+
+class Pyramids:
+    """
+    Creates and reads pyramidal TIFF files stored in the 'pyramids'
+    directory of the IIIF cache.  Pyramids are created on a small pool of
+    background threads, so that requests never wait for them.  Pyramids
+    count against the budget of CACHE, which evicts them like outputs.
+    """
+
+    def __init__ (self, cache=None):
+        self.log      = logging.getLogger (__name__)
+        self.cache    = cache
+
+    def filename (self, file_uuid):
+        """Returns the path of the pyramid of FILE_UUID."""
+        return os.path.join (config.iiif_cache_storage, "pyramids", f"{file_uuid}.tif")
+
+    def full_image (self, file_uuid):
+        """Returns the full resolution level of FILE_UUID, or None."""
+        filename = self.filename (file_uuid)
+        try:
+            status = os.stat (filename)
+            if time.time() - status.st_mtime > TOUCH_INTERVAL:
+                os.utime (filename)
+            return pyvips.Image.new_from_file (filename, page=0)
+        except (FileNotFoundError, pyvips.error.Error):
+            return None
+
+    def level (self, file_uuid, full_image, shrink):
+        """
+        Returns the smallest level of FILE_UUID that still has at least
+        1/SHRINK of the pixels of FULL_IMAGE in each direction, along with
+        its scale relative to FULL_IMAGE.
+        """
+        page = 0
+        if shrink >= 2:
+            page = min(floor(log2(shrink)), full_image.get_n_pages() - 1)
+        if page == 0:
+            return full_image, 1.0
+
+        try:
+            image = pyvips.Image.new_from_file (self.filename (file_uuid), page=page)
+            return image, image.width / full_image.width
+        except pyvips.error.Error:
+            return full_image, 1.0
+
+    def region (self, file_uuid, full_image, region, size):
+        """
+        Returns REGION of FULL_IMAGE, in full resolution pixels, read from
+        the level of FILE_UUID closest to, but not smaller than, SIZE.
+        """
+        shrink = min(region["w"] / max(size["w"], 1), region["h"] / max(size["h"], 1))
+        image, _ = self.level (file_uuid, full_image, shrink)
+        return _crop (image, full_image, region)
+
+    def claim (self, file_uuid):
+        """
+        Returns True when the caller may create the pyramid of FILE_UUID.
+        A claim is a file that is created exclusively, so that only one
+        worker of all processes creates a pyramid.  Claims of workers that
+        stopped expire after CLAIM_TIMEOUT seconds.
+        """
+        claim_filename = f"{self.filename (file_uuid)}.claim"
+        try:
+            os.makedirs (os.path.dirname (claim_filename), mode=0o700, exist_ok=True)
+            for _ in range (2):
+                try:
+                    os.close (os.open (claim_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+                    return True
+                except FileExistsError:
+                    try:
+                        if time.time() - os.stat (claim_filename).st_mtime < CLAIM_TIMEOUT:
+                            return False
+                        self.log.warning ("Taking over the expired claim on %s.", file_uuid)
+                        os.remove (claim_filename)
+                    except FileNotFoundError:
+                        pass
+        except OSError as error:
+            self.log.error ("Unable to claim the IIIF pyramid of %s: %s", file_uuid, error)
+
+        return False
+
+    def create (self, source, file_uuid, is_pdf=False):
+        """
+        Writes the pyramid of FILE_UUID from SOURCE and returns False on
+        failure.  When another worker is creating it, nothing is written.
+        """
+        if not self.claim (file_uuid):
+            return True
+        return self.__create_claimed (source, file_uuid, is_pdf)
+
+    def __create_claimed (self, source, file_uuid, is_pdf):
+        """Writes the claimed pyramid of FILE_UUID and releases the claim."""
+        partial_filename = None
+        try:
+            if isinstance (source, s3.S3DownloadStreamer):
+                source = s3.s3_cached_file (source)
+            if is_pdf:
+                source = f"{source}[dpi=300]"
+
+            image = pyvips.Image.new_from_file (source, access="sequential")
+            if max(image.width, image.height) <= TILE_SIZE:
+                return True
+
+            output_filename = self.filename (file_uuid)
+            os.makedirs (os.path.dirname (output_filename), mode=0o700, exist_ok=True)
+            partial_filename = f"{output_filename}.{os.getpid()}-{get_ident()}.partial"
+            image.tiffsave (partial_filename,
+                            tile        = True,
+                            pyramid     = True,
+                            tile_width  = PYRAMID_TILE_SIZE,
+                            tile_height = PYRAMID_TILE_SIZE,
+                            compression = "deflate",
+                            predictor   = "horizontal",
+                            bigtiff     = True)
+            size = os.path.getsize (partial_filename)
+            os.replace (partial_filename, output_filename)
+            self.log.info ("Created the IIIF pyramid of %s.", file_uuid)
+            if self.cache is not None:
+                self.cache.account (output_filename, size)
+        except (OSError, pyvips.error.Error) as error:
+            self.log.error ("Unable to create the IIIF pyramid of %s: %s", file_uuid, error)
+            if partial_filename is not None and os.path.isfile (partial_filename):
+                os.remove (partial_filename)
+            return False
+        finally:
+            _remove (f"{self.filename (file_uuid)}.claim")
+
+        return True
+
+    def schedule (self, source, file_uuid, is_pdf=False):
+        """
+        Creates the pyramid of FILE_UUID from SOURCE on a background thread,
+        unless a worker of any process is already creating it.
+        """
+        if config.iiif_pyramid_workers < 1 or not self.claim (file_uuid):
+            return None
+
+        with EXECUTORS_LOCK:
+            executor = EXECUTORS.get (os.getpid())
+            if executor is None:
+                executor = ThreadPoolExecutor (
+                    max_workers = config.iiif_pyramid_workers,
+                    thread_name_prefix = "iiif-pyramids")
+                EXECUTORS[os.getpid()] = executor
+
+        executor.submit (self.__create_claimed, source, file_uuid, is_pdf)
+        return None
+
+    def remove (self, file_uuid):
+        """Removes the pyramid of FILE_UUID."""
+        try:
+            os.remove (self.filename (file_uuid))
+        except FileNotFoundError:
+            pass
+
+class _Counters:
+    """The counters of the IIIF cache in one directory for one process."""
+
+    def __init__ (self):
+        self.lock               = Lock()
+        self.hits               = 0
+        self.misses             = 0
+        self.bytes_served       = 0
+        self.bytes_stored       = 0
+        self.evictions          = 0
+        self.stored_since_evict = 0
+
+def _counters (directory):
+    """Returns the counters of this process for the IIIF cache in DIRECTORY."""
+    key = (os.getpid(), directory)
+    with COUNTERS_LOCK:
+        counters = COUNTERS.get (key)
+        if counters is None:
+            counters = COUNTERS[key] = _Counters()
+    return counters
+
+class DerivativeCache:
+    """
+    Stores the output of IIIF image requests in the 'derivatives' directory
+    of the IIIF cache, with a directory per file.  The least recently used
+    outputs and pyramids are removed when together they take more than
+    'iiif_cache_budget' bytes.  The counters cover the requests handled by
+    this process, and are shared by all its DerivativeCache objects.
+    """
+
+    def __init__ (self):
+        self.log = logging.getLogger (__name__)
+
+    def __counters (self):
+        """Returns the counters of this process for the configured IIIF cache."""
+        return _counters (config.iiif_cache_storage)
+
+    def directory (self, file_uuid=None):
+        """Returns the directory of the outputs of FILE_UUID, or of all files."""
+        directory = os.path.join (config.iiif_cache_storage, "derivatives")
+        if file_uuid is None:
+            return directory
+        return os.path.join (directory, file_uuid)
+
+    def filename (self, file_uuid, region, size, rotation, quality, image_format):
+        """
+        Returns the path of the output of a request, or None when the request
+        cannot be stored.  Paths are formed from the request itself, so that
+        looking up an output does not need a query or a hash.
+        """
+        name = f"{region}_{size}_{rotation}_{quality}.{image_format}"
+        if len(name) > 200 or SAFE_NAME.fullmatch (name) is None:
+            return None
+        return os.path.join (self.directory (file_uuid), name)
+
+    def lookup (self, filename):
+        """Returns the size of the output in FILENAME, or None when it is missing."""
+        try:
+            status = os.stat (filename)
+        except (FileNotFoundError, NotADirectoryError):
+            counters = self.__counters ()
+            with counters.lock:
+                counters.misses += 1
+            return None
+
+        # Outputs are marked as recently used at most once per interval,
+        # so that serving a hot tile costs a single 'stat'.
+        if time.time() - status.st_mtime > TOUCH_INTERVAL:
+            try:
+                os.utime (filename)
+            except FileNotFoundError:
+                pass
+
+        counters = self.__counters ()
+        with counters.lock:
+            counters.hits += 1
+            counters.bytes_served += status.st_size
+        return status.st_size
+
+    def store (self, filename, image, image_format):
+        """Writes IMAGE to FILENAME and returns True on success."""
+        os.makedirs (os.path.dirname (filename), mode=0o700, exist_ok=True)
+        partial_filename = f"{filename}.{os.getpid()}-{get_ident()}.partial"
+        try:
+            image.write_to_target (pyvips.Target.new_to_file (partial_filename),
+                                   f".{image_format}")
+            size = os.path.getsize (partial_filename)
+            os.replace (partial_filename, filename)
+        except (OSError, pyvips.error.Error):
+            if os.path.isfile (partial_filename):
+                os.remove (partial_filename)
+            raise
+
+        counters = self.__counters ()
+        with counters.lock:
+            counters.bytes_stored += size
+        self.account (filename, size)
+        return True
+
+    def account (self, filename, size):
+        """
+        Procedure to count SIZE bytes stored in FILENAME against the budget,
+        and to evict once a twentieth of the budget was stored since the
+        previous eviction.
+        """
+        counters = self.__counters ()
+        with counters.lock:
+            counters.stored_since_evict += size
+            must_evict = counters.stored_since_evict > config.iiif_cache_budget // 20
+            if must_evict:
+                counters.stored_since_evict = 0
+
+        if must_evict:
+            self.evict (keep=filename)
+
+    def invalidate (self, file_uuid):
+        """Removes the outputs of FILE_UUID."""
+        shutil.rmtree (self.directory (file_uuid), ignore_errors=True)
+
+    def __entries (self):
+        """Returns the modification time, size and path of every output and pyramid."""
+        directories = [os.path.join (config.iiif_cache_storage, "pyramids")]
+        try:
+            with os.scandir (self.directory ()) as iterator:
+                directories += [entry.path for entry in iterator if entry.is_dir()]
+        except FileNotFoundError:
+            pass
+
+        entries = []
+        now     = time.time()
+        for directory in directories:
+            try:
+                with os.scandir (directory) as iterator:
+                    for entry in iterator:
+                        try:
+                            status = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        if entry.name.endswith (".claim"):
+                            continue
+                        # Files that were interrupted are removed after a day.
+                        if entry.name.endswith (".partial"):
+                            if now - status.st_mtime > 86400:
+                                _remove (entry.path)
+                            continue
+                        entries.append ((status.st_mtime, status.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def evict (self, keep=None):
+        """
+        Removes the least recently used outputs, except KEEP, until the
+        budget is met.
+        """
+        # Outputs stored before the directory per file was introduced
+        # can no longer be found.
+        with os.scandir (config.iiif_cache_storage) as iterator:
+            for entry in iterator:
+                if entry.is_file() and LEGACY_NAME.fullmatch (entry.name):
+                    _remove (entry.path)
+
+        entries  = self.__entries ()
+        total    = sum(size for _, size, _ in entries)
+        counters = self.__counters ()
+        entries.sort()
+        for _, size, path in entries:
+            if total <= config.iiif_cache_budget:
+                break
+            if path == keep:
+                continue
+            _remove (path)
+            total -= size
+            with counters.lock:
+                counters.evictions += 1
+
+        return None
+
+    def statistics (self):
+        """Returns the counters and the current size of the cache."""
+        entries  = self.__entries ()
+        pyramids = os.path.join (config.iiif_cache_storage, "pyramids", "")
+        counters = self.__counters ()
+        with counters.lock:
+            return {
+                "hits":         counters.hits,
+                "misses":       counters.misses,
+                "bytes_served": counters.bytes_served,
+                "bytes_stored": counters.bytes_stored,
+                "evictions":    counters.evictions,
+                "files":        len(entries),
+                "pyramids":     sum(1 for _, _, path in entries if path.startswith (pyramids)),
+                "bytes":        sum(size for _, size, _ in entries),
+                "budget":       config.iiif_cache_budget
+            }
+
+def _remove (filename):
+    """Procedure to remove FILENAME unless another worker already did."""
+    try:
+        os.remove (filename)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,291 @@
+"""
+This module implements a queue of background jobs that is spooled to disk.
+
+Each job is a JSON file that moves between the 'queued', 'running', 'done'
+and 'failed' directories of the spool.  Because renaming a file is atomic,
+the processes of a deployment can share one spool without a broker.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+from threading import Condition, Lock, Thread
+from djehuty.web.config import config
+
+## Worker threads are started once per process, even when the web server
+## object, and thus its JobQueue, is created more than once.
+WORKERS_LOCK = Lock()
+WORKERS      = {}
+
+STATES         = ("done", "failed", "running", "queued")
+POLL_INTERVAL  = 5
+PRUNE_INTERVAL = 3600
+RETENTION      = 604800
+
+def _process_is_alive (pid):
+    """Returns True when the process PID exists."""
+    try:
+        os.kill (pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class JobQueue:
+    """
+    Runs spooled jobs on a pool of 'job_workers' threads.  A job that raises
+    an exception is retried after 'job_retry_delay' seconds, doubling the
+    delay for each attempt, until it has been tried 'job_attempts' times.
+    """
+
+    def __init__ (self):
+        self.log        = logging.getLogger(__name__)
+        self.handlers   = {}
+        self.condition  = Condition()
+        self.order_lock = Lock()
+        self.last_prune = 0
+        self.last_queue = 0
+
+    def register (self, job_type, handler):
+        """Procedure to run HANDLER with the parameters of JOB_TYPE jobs."""
+        self.handlers[job_type] = handler
+
+    def directory (self, state):
+        """Returns the spool directory of jobs in STATE."""
+        return os.path.join (config.job_storage, state)
+
+    def __write (self, job, state, not_before=None):
+        """Procedure to store JOB in the spool directory of STATE."""
+        job["state"]   = state
+        job["updated"] = time.time()
+        name = f"{job['id']}.json"
+        if not_before is not None:
+            # Queued jobs are named by the time they may start, so that
+            # sorting their names gives the order in which to run them.
+            name = f"{not_before:017d}_{name}"
+
+        directory = self.directory (state)
+        os.makedirs (directory, mode=0o700, exist_ok=True)
+        filename  = os.path.join (directory, name)
+        partial   = f"{filename}.{os.getpid()}.partial"
+        with open (partial, "w", encoding="utf-8") as output:
+            json.dump (job, output)
+        os.replace (partial, filename)
+        return filename
+
+    def __not_before (self, timestamp):
+        """
+        Returns TIMESTAMP in microseconds, later than that of the previous
+        job this process queued, so that its jobs run in the order queued.
+        """
+        with self.order_lock:
+            self.last_queue = max(int(timestamp * 1000000), self.last_queue + 1)
+            return self.last_queue
+
+    def __names (self, state, suffix=".json"):
+        """Returns the sorted names of the jobs in STATE."""
+        try:
+            return sorted (name for name in os.listdir (self.directory (state))
+                           if name.endswith (suffix))
+        except FileNotFoundError:
+            return []
+
+    def submit (self, job_type, parameters, account_uuid=None):
+        """Returns the identifier of a new JOB_TYPE job for PARAMETERS."""
+        if config.job_storage is None:
+            self.log.error ("Unable to spool a %s job without a job spool.", job_type)
+            return None
+
+        now = time.time()
+        job = {
+            "id":           str(uuid.uuid4()),
+            "type":         job_type,
+            "parameters":   parameters,
+            "account_uuid": account_uuid,
+            "attempts":     0,
+            "error":        None,
+            "created":      now
+        }
+        try:
+            self.__write (job, "queued", not_before=self.__not_before (now))
+        except OSError as error:
+            self.log.error ("Unable to spool a %s job: %s", job_type, error)
+            return None
+
+        self.start ()
+        with self.condition:
+            self.condition.notify ()
+        return job["id"]
+
+    def status (self, job_id):
+        """Returns the job record of JOB_ID or None when it does not exist."""
+        if config.job_storage is None:
+            return None
+
+        for state in STATES:
+            names = [f"{job_id}.json"]
+            if state == "queued":
+                names = [name for name in self.__names (state)
+                         if name.endswith (f"_{job_id}.json")]
+            elif state == "running":
+                names += [name for name in self.__names (state, ".claim")
+                          if name.startswith (f"{job_id}.")]
+            for name in names:
+                try:
+                    with open (os.path.join (self.directory (state), name),
+                               "r", encoding="utf-8") as stream:
+                        job = json.load (stream)
+                    job["state"] = state
+                    return job
+                except (FileNotFoundError, json.JSONDecodeError):
+                    continue
+        return None
+
+    def __claim (self):
+        """Returns the first queued job that may start, or None."""
+        now = int(time.time() * 1000000)
+        for name in self.__names ("queued"):
+            try:
+                not_before, job_name = name.split ("_", 1)
+                if int(not_before) > now:
+                    break
+            except ValueError:
+                continue
+
+            # The job is claimed under a name that 'recover' attributes to
+            # this process, until it is stored with this process' pid.
+            job_id = job_name[:-len(".json")]
+            claim  = os.path.join (self.directory ("running"), f"{job_id}.{os.getpid()}.claim")
+            try:
+                os.makedirs (self.directory ("running"), mode=0o700, exist_ok=True)
+                os.rename (os.path.join (self.directory ("queued"), name), claim)
+                with open (claim, "r", encoding="utf-8") as stream:
+                    job = json.load (stream)
+                job["pid"] = os.getpid()
+                job["attempts"] += 1
+                self.__write (job, "running")
+                os.remove (claim)
+            except FileNotFoundError:
+                # Another worker claimed the job first.
+                continue
+            except (OSError, json.JSONDecodeError, KeyError, TypeError) as error:
+                self.log.error ("Unable to claim job %s: %s", name, error)
+                continue
+
+            return job
+
+        return None
+
+    def run_next (self):
+        """Runs the first queued job that may start and returns whether one ran."""
+        job = self.__claim ()
+        if job is None:
+            return False
+
+        running = os.path.join (self.directory ("running"), f"{job['id']}.json")
+        try:
+            handler = self.handlers[job["type"]]
+            handler (job["parameters"])
+            job["error"] = None
+            self.__write (job, "done")
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            job["error"] = str(error) or type(error).__name__
+            if job["type"] in self.handlers and job["attempts"] < config.job_attempts:
+                delay = config.job_retry_delay * pow(2, job["attempts"] - 1)
+                self.log.warning ("Job %s (%s) failed; Retrying in %s seconds: %s",
+                                  job["id"], job["type"], delay, job["error"])
+                self.__write (job, "queued", not_before=self.__not_before (time.time() + delay))
+            else:
+                self.log.error ("Job %s (%s) failed: %s", job["id"], job["type"], job["error"])
+                self.__write (job, "failed")
+
+        os.remove (running)
+        return True
+
+    def recover (self):
+        """Procedure to queue the running jobs of processes that stopped."""
+        for name in self.__names ("running", ".claim"):
+            try:
+                job_id, pid, _ = name.rsplit (".", 2)
+                if int(pid) != os.getpid() and _process_is_alive (int(pid)):
+                    continue
+                os.rename (os.path.join (self.directory ("running"), name),
+                           os.path.join (self.directory ("queued"),
+                                         f"{self.__not_before (time.time()):017d}_{job_id}.json"))
+            except (OSError, ValueError) as error:
+                self.log.error ("Unable to recover job %s: %s", name, error)
+
+        for name in self.__names ("running"):
+            filename = os.path.join (self.directory ("running"), name)
+            try:
+                with open (filename, "r", encoding="utf-8") as stream:
+                    job = json.load (stream)
+                pid = job.get ("pid")
+                if pid is not None and pid != os.getpid() and _process_is_alive (pid):
+                    continue
+                self.__write (job, "queued", not_before=self.__not_before (time.time()))
+                os.remove (filename)
+                self.log.info ("Queued interrupted job %s (%s).", job["id"], job["type"])
+            except (OSError, json.JSONDecodeError) as error:
+                self.log.error ("Unable to recover job %s: %s", name, error)
+
+    def prune (self, retention=RETENTION):
+        """Procedure to remove finished jobs older than RETENTION seconds."""
+        self.last_prune = time.time()
+        for state in ("done", "failed"):
+            for name in self.__names (state):
+                filename = os.path.join (self.directory (state), name)
+                try:
+                    if os.stat (filename).st_mtime < self.last_prune - retention:
+                        os.remove (filename)
+                except FileNotFoundError:
+                    pass
+
+    def statistics (self):
+        """Returns the number of jobs in each state."""
+        return { state: len(self.__names (state)) for state in STATES }
+
+    def __work (self):
+        """Procedure that runs queued jobs until the process exits."""
+        while True:
+            try:
+                if self.run_next ():
+                    continue
+                if time.time() - self.last_prune > PRUNE_INTERVAL:
+                    self.prune ()
+            except OSError as error:
+                self.log.error ("The job spool is not accessible: %s", error)
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                self.log.error ("Running jobs failed: %s", error)
+
+            # Jobs queued by other processes and jobs waiting for a retry
+            # are picked up at the next poll.
+            with self.condition:
+                self.condition.wait (timeout=POLL_INTERVAL)
+
+    def start (self):
+        """
+        Procedure to start the worker threads, unless this process already
+        runs them.  Threads do not survive a fork, so they are started per
+        process.
+        """
+        if config.job_storage is None or config.job_workers < 1:
+            return None
+
+        with WORKERS_LOCK:
+            if os.getpid() in WORKERS:
+                return None
+            self.recover ()
+            workers = []
+            for index in range (config.job_workers):
+                worker = Thread (target = self.__work,
+                                 name   = f"jobs-{index}",
+                                 daemon = True)
+                worker.start ()
+                workers.append (worker)
+            WORKERS[os.getpid()] = workers
+
+        return None
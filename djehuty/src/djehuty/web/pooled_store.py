@@ -0,0 +1,202 @@
+"""
+This module provides a SPARQL store that keeps its HTTP connections to the
+SPARQL endpoint open between queries.
+"""
+
+import os
+import re
+import json
+import codecs
+from io import BytesIO
+from threading import Lock, local
+from urllib.error import HTTPError, URLError
+import requests
+from requests.adapters import HTTPAdapter
+from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
+from rdflib.query import Result
+from rdflib.store import Store
+from rdflib.term import BNode
+
+BINDINGS_START = re.compile(r'"bindings"\s*:\s*\[')
+SEPARATORS     = re.compile(r'[\s,]*')
+
+## A server object, and with it its store, may be created for each request,
+## so the pools of connections are kept per process instead.  Connections
+## are not shared with forked processes.
+ADAPTERS      = {}
+ADAPTERS_LOCK = Lock()
+
+def http_adapter (query_endpoint, update_endpoint, pool_size):
+    """
+    Returns the pool of keep-alive connections of this process to the
+    QUERY_ENDPOINT and UPDATE_ENDPOINT, holding up to POOL_SIZE connections.
+    """
+    key = (os.getpid(), query_endpoint, update_endpoint, pool_size)
+    with ADAPTERS_LOCK:
+        adapter = ADAPTERS.get (key)
+        if adapter is None:
+            adapter = HTTPAdapter (pool_connections = 2,
+                                   pool_maxsize     = pool_size)
+            ADAPTERS[key] = adapter
+
+    return adapter
+
+def json_bindings (chunks):
+    """
+    Returns an iterator over the bindings of the SPARQL JSON result that is
+    read as a sequence of byte strings from CHUNKS.  Only a single binding
+    is held in memory at a time.
+    """
+
+    decoder  = json.JSONDecoder()
+    text     = codecs.getincrementaldecoder ("utf-8")()
+    chunks   = iter(chunks)
+    buffer   = ""
+    position = None
+    while True:
+        if position is None:
+            match = BINDINGS_START.search (buffer)
+            if match is not None:
+                position = match.end()
+                continue
+        else:
+            position = SEPARATORS.match (buffer, position).end()
+            if buffer[position:position + 1] == "]":
+                return
+            if position < len(buffer):
+                try:
+                    binding, position = decoder.raw_decode (buffer, position)
+                    yield binding
+                    continue
+                except json.JSONDecodeError:
+                    pass
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            if position is None:
+                return
+            raise ValueError ("Incomplete SPARQL result.")
+
+        if position is None:
+            # Keep enough characters to recognize a partially read key.
+            buffer = buffer[-32:] + text.decode (chunk)
+        else:
+            buffer   = buffer[position:] + text.decode (chunk)
+            position = 0
+
+class PooledSPARQLUpdateStore (SPARQLUpdateStore):
+    """
+    SPARQLUpdateStore that sends its requests over a pool of keep-alive
+    connections.  The pool is shared by all stores and threads of a process
+    that use the same endpoints, while each thread keeps its own session
+    and its own pending edits.
+    """
+
+    def __init__ (self, pool_size=10, connect_timeout=10, read_timeout=None, **kwargs):
+        # The pending edits are stored per thread, and 'SPARQLUpdateStore'
+        # already assigns them while initializing.
+        self.threads         = local()
+        self.pool_size       = pool_size
+        self.timeout         = (connect_timeout, read_timeout)
+        super().__init__(**kwargs)
+
+    @property
+    def _edits (self):
+        return getattr (self.threads, "edits", None)
+
+    @_edits.setter
+    def _edits (self, value):
+        self.threads.edits = value
+
+    def __session (self):
+        """Returns the HTTP session of the current thread."""
+
+        session = getattr (self.threads, "session", None)
+        if session is None or self.threads.pid != os.getpid():
+            adapter = http_adapter (self.query_endpoint, self.update_endpoint, self.pool_size)
+            session = requests.Session()
+            session.mount ("http://", adapter)
+            session.mount ("https://", adapter)
+            session.headers.update ({ "Accept-Encoding": "gzip, deflate" })
+            self.threads.session = session
+            self.threads.pid     = os.getpid()
+
+        return session
+
+    def __post (self, url, body, params, content_type, stream=False):
+        """
+        Returns the response to posting BODY to URL.  Failures are raised
+        as the exceptions urllib would raise so that callers can handle
+        both stores the same way.
+        """
+
+        headers = {
+            "Accept":       self.response_mime_types(),
+            "Content-Type": content_type
+        }
+        try:
+            response = self.__session().post (url,
+                                              params  = params,
+                                              data    = body.encode("utf-8"),
+                                              headers = headers,
+                                              timeout = self.timeout,
+                                              stream  = stream)
+        except requests.exceptions.RequestException as error:
+            raise URLError (error) from error
+
+        if response.status_code >= 400:
+            response.close()
+            raise HTTPError (url, response.status_code, response.reason,
+                             response.headers, None)
+
+        return response
+
+    def triples_choices (self, triple, context=None):
+        """Returns the matches of TRIPLE with a 'triples' query per choice."""
+        # SPARQLStore leaves this unimplemented, so use rdflib's fallback.
+        return Store.triples_choices (self, triple, context)
+
+    def _query (self, *args, **kwargs):
+        query         = args[0]
+        default_graph = kwargs.get ("default_graph")
+        self._queries += 1
+
+        params = {}
+        if default_graph is not None and not isinstance (default_graph, BNode):
+            params["default-graph-uri"] = default_graph
+
+        try:
+            response = self.__post (self.query_endpoint, query, params,
+                                    "application/sparql-query")
+        except HTTPError as error:
+            # Mimic rdflib's SPARQLConnector, which returns errors for
+            # queries rather than raising them.
+            return error.code, str(error), None
+
+        content_type = response.headers.get ("Content-Type", "").split(";")[0]
+        return Result.parse (BytesIO (response.content), content_type=content_type)
+
+    def _update (self, update):
+        self._updates += 1
+        self.__post (self.update_endpoint, update, {},
+                     "application/sparql-update; charset=UTF-8")
+
+    def query_bindings (self, query):
+        """
+        Returns an iterator over the bindings of the SELECT QUERY, as they
+        appear in the SPARQL JSON result, while the result is still being
+        received.
+        """
+
+        if not self.autocommit and not self.dirty_reads:
+            self.commit()
+
+        self._queries += 1
+        response = self.__post (self.query_endpoint, query, {},
+                                "application/sparql-query", stream=True)
+        try:
+            yield from json_bindings (response.iter_content (chunk_size=65536))
+        except requests.exceptions.RequestException as error:
+            raise URLError (error) from error
+        finally:
+            response.close()
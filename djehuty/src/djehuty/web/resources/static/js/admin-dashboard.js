@@ -11,6 +11,28 @@ jQuery(document).ready(function () {
             show_message ("failure", "<p>Failed recalculate statistics.</p>");
         });
     });
+    jQuery("#compute-crc32-checksums").on("click", function (event) {
+        stop_event_propagation (event);
+        jQuery.ajax({
+            url:  "/admin/maintenance/compute-crc32-checksums",
+            type: "GET"
+        }).done(function () {
+            show_message ("success", "<p>Computed the missing CRC-32 checksums.</p>");
+        }).fail(function () {
+            show_message ("failure", "<p>Failed to compute all missing CRC-32 checksums.</p>");
+        });
+    });
+    jQuery("#create-missing-thumbnails").on("click", function (event) {
+        stop_event_propagation (event);
+        jQuery.ajax({
+            url:  "/admin/maintenance/create-missing-thumbnails",
+            type: "GET"
+        }).done(function () {
+            show_message ("success", "<p>Queued the creation of missing thumbnails.</p>");
+        }).fail(function () {
+            show_message ("failure", "<p>Failed to queue the creation of missing thumbnails.</p>");
+        });
+    });
     jQuery("#clear-cache").on("click", function (event) {
         stop_event_propagation (event);
         jQuery.ajax({
@@ -919,6 +919,8 @@ function render_files_for_thumbnail (dataset_uuid) {
                     contentType: "application/json",
                     accept:      "application/json",
                     data:        JSON.stringify({ "uuid": `${selected_thumb.val()}` })
+                }).done(function (data) {
+                    if (data && data.job) { poll_thumbnail_job (data.job, 1000); }
                 }).fail(function () {
                     show_message ("failure", "<p>Failed to set thumbnail.</p>");
                 });
@@ -932,6 +934,22 @@ function render_files_for_thumbnail (dataset_uuid) {
     });
 }
 
+function poll_thumbnail_job (job_id, delay) {
+    setTimeout(function () {
+        jQuery.ajax({
+            url:         `/v3/jobs/${job_id}`,
+            type:        "GET",
+            accept:      "application/json",
+        }).done(function (job) {
+            if (job.state == "failed") {
+                show_message ("failure", "<p>Failed to set thumbnail.</p>");
+            } else if (job.state != "done") {
+                poll_thumbnail_job (job_id, Math.min(delay * 2, 10000));
+            }
+        });
+    }, delay);
+}
+
 function add_author (author_uuid, dataset_uuid) {
     jQuery.ajax({
         url:         `/v2/account/articles/${dataset_uuid}/authors`,
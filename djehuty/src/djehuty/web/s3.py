@@ -1,26 +1,66 @@
 """This module implements interaction with an S3 endpoint."""
 
 import logging
+import hashlib
 import uuid
 import os
+import time
 from datetime import datetime
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from djehuty.web.config import config
 from djehuty.utils.convenience import value_or
 
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
 try:
     import boto3
-    from botocore.exceptions import ClientError, PartialCredentialsError
+    from botocore.exceptions import BotoCoreError, ClientError, PartialCredentialsError
     from botocore.exceptions import ResponseStreamingError, ReadTimeoutError
     from botocore.config import Config
     from urllib3.exceptions import IncompleteRead
+
+    ## Errors that can interrupt reading or writing an object.
+    S3_ERRORS = (BotoCoreError, ClientError, IncompleteRead)
 except (ImportError, ModuleNotFoundError):
-    pass
+    S3_ERRORS = ()
+
+CLIENTS      = {}
+CLIENTS_LOCK = Lock()
+
+def s3_client (endpoint, access_key, secret_key):
+    """
+    Returns the S3 client for ENDPOINT and the credentials.  Clients are
+    shared by all threads, and each client has its own pool of connections.
+    """
+    key = (endpoint, access_key, secret_key)
+    with CLIENTS_LOCK:
+        client = CLIENTS.get (key)
+        if client is None:
+            boto_config = Config(retries = { "total_max_attempts": 30,
+                                             "mode": "standard" },
+                                 max_pool_connections = config.s3_pool_size,
+                                 read_timeout = 120)
+            client = boto3.client ("s3", endpoint_url    = endpoint,
+                                   aws_access_key_id     = access_key,
+                                   aws_secret_access_key = secret_key,
+                                   config                = boto_config)
+            CLIENTS[key] = client
+
+    return client
 
 class S3DownloadStreamer:
     """Generator to stream the contents of a file stored in S3."""
 
-    def __init__ (self, endpoint, bucket, access_key, secret_key, filename, name, chunk_size=32768, offset=0):
+    def __init__ (self, endpoint, bucket, access_key, secret_key, filename, name, chunk_size=32768, offset=0,
+                  part_size=8388608, part_workers=1, part_memory=67108864):
         self.client = None
+        self.part_size = part_size
+        self.part_workers = part_workers
+        self.part_memory = part_memory
         self.endpoint = endpoint
         self.bucket = bucket
         self.access_key = access_key
@@ -34,19 +74,13 @@ class S3DownloadStreamer:
         self.content_length = 0
         self.content_type = "binary/octet-stream"
         self.last_modified = None
+        self.etag = None
         self.file_object = None
         self.file_contents = None
-        self.boto_config = Config(retries = { "total_max_attempts": 30,
-                                              "mode": "standard" },
-                                  max_pool_connections = 1,
-                                  read_timeout = 120)
 
     def connect (self):
         """Initialize procedure that can be recalled."""
-        self.client = boto3.client ("s3", endpoint_url    = self.endpoint,
-                                    aws_access_key_id     = self.access_key,
-                                    aws_secret_access_key = self.secret_key,
-                                    config                = self.boto_config)
+        self.client = s3_client (self.endpoint, self.access_key, self.secret_key)
         try:
             self.file_object   = self.client.get_object (Bucket = self.bucket,
                                                          Key    = self.filename,
@@ -68,6 +102,93 @@ class S3DownloadStreamer:
             self.log.warning ("Could not read metadata for s3://%s/%s",
                               self.bucket, self.filename)
 
+    def head (self):
+        """Reads the size and modification time without fetching the object."""
+        client = s3_client (self.endpoint, self.access_key, self.secret_key)
+        try:
+            metadata = client.head_object (Bucket = self.bucket, Key = self.filename)
+            self.content_length = int(metadata["ContentLength"])
+            self.content_type   = value_or (metadata, "ContentType", self.content_type)
+            self.etag           = value_or (metadata, "ETag", None)
+            modified = value_or (metadata, "LastModified", None)
+            if modified is not None:
+                self.last_modified = (modified.year, modified.month, modified.day,
+                                      modified.hour, modified.minute, modified.second)
+            return True
+        except (ClientError, KeyError, TypeError, ValueError) as error:
+            self.log.error ("Could not read metadata for s3://%s/%s: %s",
+                            self.bucket, self.filename, error)
+            return False
+
+    def part_ranges (self):
+        """
+        Returns the byte ranges in which the object is read in parallel, or
+        None when the object should be read as a single stream.
+        """
+        if self.part_workers < 2 or self.part_size < 1:
+            return None
+
+        if self.etag is None and not self.head():
+            return None
+
+        if self.content_length - self.offset <= self.part_size:
+            return None
+
+        return [(start, min(start + self.part_size, self.content_length))
+                for start in range (self.offset, self.content_length, self.part_size)]
+
+    def __fetch_part (self, start, stop):
+        """Returns the bytes START to STOP of the object, or None."""
+        client = s3_client (self.endpoint, self.access_key, self.secret_key)
+        retries = 3
+        while retries > 0:
+            try:
+                part = client.get_object (Bucket = self.bucket,
+                                          Key    = self.filename,
+                                          Range  = f"bytes={start}-{stop - 1}")
+                data = part["Body"].read()
+                if len(data) == stop - start:
+                    return data
+                self.log.warning ("Received %s of %s bytes of s3://%s/%s.",
+                                  len(data), stop - start, self.bucket, self.filename)
+            except (ResponseStreamingError, ReadTimeoutError, IncompleteRead):
+                self.log.warning ("Retrying to fetch bytes %s-%s of %s.",
+                                  start, stop, self.original_filename)
+            except (ClientError, KeyError) as error:
+                self.log.error ("An S3 download stream error occurred: %s", error)
+                return None
+            retries -= 1
+
+        return None
+
+    def parts_iterator (self, ranges):
+        """
+        Returns an iterator over the object that fetches RANGES with a small
+        pool of threads, and yields them in order.  At most 'part_memory'
+        bytes are held in memory.
+        """
+        in_flight = max(1, min(self.part_workers, self.part_memory // self.part_size))
+        executor  = ThreadPoolExecutor (max_workers = in_flight,
+                                        thread_name_prefix = "s3-parts")
+        try:
+            futures = [executor.submit (self.__fetch_part, *part_range)
+                       for part_range in ranges[:in_flight]]
+            next_range = in_flight
+            while futures:
+                data = futures.pop(0).result()
+                if data is None:
+                    self.log.error ("Failed to fetch S3 object %s (%s).",
+                                    self.original_filename, self.content_length)
+                    return
+                if next_range < len(ranges):
+                    futures.append (executor.submit (self.__fetch_part,
+                                                     *ranges[next_range]))
+                    next_range += 1
+                for index in range (0, len(data), self.chunk_size):
+                    yield data[index:index + self.chunk_size]
+        finally:
+            executor.shutdown (wait=False, cancel_futures=True)
+
     def body (self):
         """Returns the request body to directly read from."""
         if self.file_contents is None:
@@ -83,9 +204,12 @@ class S3DownloadStreamer:
         return self.file_contents.iter_chunks (chunk_size=self.chunk_size)
 
     def close (self):
-        """Closes the S3 client and resets the internal state."""
-        self.file_contents.close()
-        self.client.close()
+        """Closes the response body and resets the internal state."""
+        # The client is shared, so only the connection of the response
+        # body is returned to its pool.
+        if self.file_contents is not None:
+            self.file_contents.close()
+        self.client = None
         self.file_object = None
         self.file_contents = None
         self.content_length = 0
@@ -98,12 +222,165 @@ class S3DownloadStreamer:
         self.offset = offset
         self.connect ()
 
+def bucket_streamer (bucket, filename, name):
+    """Returns an S3DownloadStreamer for FILENAME in the configured BUCKET."""
+    return S3DownloadStreamer (bucket["endpoint"],
+                               bucket["name"],
+                               bucket["key-id"],
+                               bucket["secret-key"],
+                               filename,
+                               name,
+                               part_size    = value_or (bucket, "part-size", 8388608),
+                               part_workers = value_or (bucket, "part-workers", 1),
+                               part_memory  = value_or (bucket, "part-memory", 67108864))
+
+class S3MultipartWriter:
+    """
+    Writes an object to S3 as a multipart upload.  Parts are sent with a
+    small pool of threads while the next part is being collected, and at
+    most 'part-memory' bytes are held in memory.
+    """
+
+    def __init__ (self, bucket, filename):
+        self.bucket = bucket
+        self.filename = filename
+        self.log = logging.getLogger (__name__)
+        # S3 does not accept parts smaller than 5 MiB, except for the last.
+        self.part_size = max(5242880, value_or (bucket, "part-size", 8388608))
+        self.in_flight = max(1, min(value_or (bucket, "part-workers", 1),
+                                    value_or (bucket, "part-memory", 67108864)
+                                    // self.part_size))
+        self.client = s3_client (bucket["endpoint"], bucket["key-id"],
+                                 bucket["secret-key"])
+        self.executor = None
+        self.upload_id = None
+        self.futures = []
+        self.parts = []
+        self.buffer = bytearray()
+        self.failed = False
+
+    def __upload_part (self, part_number, data):
+        """Sends DATA as part PART_NUMBER and returns its ETag, or None."""
+        retries = 3
+        while retries > 0:
+            try:
+                response = self.client.upload_part (Bucket     = self.bucket["name"],
+                                                    Key        = self.filename,
+                                                    UploadId   = self.upload_id,
+                                                    PartNumber = part_number,
+                                                    Body       = data)
+                return response["ETag"]
+            except (ReadTimeoutError, IncompleteRead):
+                self.log.warning ("Retrying to send part %s of s3://%s/%s.",
+                                  part_number, self.bucket["name"], self.filename)
+            except (BotoCoreError, ClientError, KeyError) as error:
+                self.log.error ("An S3 upload error occurred: %s", error)
+                return None
+            retries -= 1
+
+        return None
+
+    def __collect (self, wait_for):
+        """Waits until at most WAIT_FOR parts are in flight."""
+        while len(self.futures) > wait_for:
+            part_number, future = self.futures.pop(0)
+            etag = future.result()
+            if etag is None:
+                self.failed = True
+            else:
+                self.parts.append ({ "ETag": etag, "PartNumber": part_number })
+
+    def __send_buffer (self):
+        """Sends the buffered bytes as the next part."""
+        if self.upload_id is None:
+            try:
+                response = self.client.create_multipart_upload (
+                    Bucket = self.bucket["name"],
+                    Key    = self.filename)
+                self.upload_id = response["UploadId"]
+            except (BotoCoreError, ClientError, KeyError) as error:
+                self.log.error ("Could not start an S3 upload of %s: %s",
+                                self.filename, error)
+                self.failed = True
+                return
+            self.executor = ThreadPoolExecutor (max_workers = self.in_flight,
+                                                thread_name_prefix = "s3-upload")
+
+        self.__collect (self.in_flight - 1)
+        part_number = len(self.parts) + len(self.futures) + 1
+        self.futures.append ((part_number,
+                              self.executor.submit (self.__upload_part, part_number,
+                                                    bytes(self.buffer))))
+        self.buffer = bytearray()
+
+    def write (self, data):
+        """Adds DATA to the object."""
+        if self.failed:
+            return
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self.__send_buffer ()
+
+    def __abort (self):
+        """Procedure to discard the parts of the multipart upload."""
+        if self.upload_id is None:
+            return
+
+        # Parts that are still being sent would otherwise outlive the abort.
+        self.executor.shutdown (wait=True, cancel_futures=True)
+        try:
+            self.client.abort_multipart_upload (Bucket   = self.bucket["name"],
+                                                Key      = self.filename,
+                                                UploadId = self.upload_id)
+        except (BotoCoreError, ClientError) as error:
+            self.log.error ("Could not abort the S3 upload of %s: %s",
+                            self.filename, error)
+
+    def close (self, complete=True):
+        """
+        Finishes the object when COMPLETE is True, or discards it otherwise.
+        Returns True when the object was written to the bucket.
+        """
+        try:
+            if complete and not self.failed and self.upload_id is None:
+                # Objects smaller than a single part need no multipart upload.
+                self.client.put_object (Bucket = self.bucket["name"],
+                                        Key    = self.filename,
+                                        Body   = bytes(self.buffer))
+                return True
+
+            if complete and not self.failed:
+                if self.buffer:
+                    self.__send_buffer ()
+                self.__collect (0)
+
+            if self.upload_id is None:
+                return False
+
+            if complete and not self.failed:
+                self.client.complete_multipart_upload (
+                    Bucket          = self.bucket["name"],
+                    Key             = self.filename,
+                    UploadId        = self.upload_id,
+                    MultipartUpload = { "Parts": self.parts })
+                return True
+
+            self.__abort ()
+        except (BotoCoreError, ClientError) as error:
+            self.log.error ("Could not finish the S3 upload of %s: %s",
+                            self.filename, error)
+            self.__abort ()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown (wait=False, cancel_futures=True)
+            self.buffer = bytearray()
+
+        return False
+
 def s3_file_exists (endpoint, bucket, access_key, secret_key, filename):
     """Returns True when FILENAME exists in BUCKET, False otherwise."""
     try:
-        client = boto3.client("s3", endpoint_url=endpoint,
-                              aws_access_key_id=access_key,
-                              aws_secret_access_key=secret_key)
+        client = s3_client (endpoint, access_key, secret_key)
         client.head_object (Bucket=bucket, Key=filename)
         return True
     except PartialCredentialsError:
@@ -113,11 +390,18 @@ def s3_file_exists (endpoint, bucket, access_key, secret_key, filename):
     except ClientError:
         return False
 
-def s3_temporary_file (reader):
+def s3_temporary_file (reader, directory=None):
     """Downloads the S3 file from READER and returns the local filesystem path."""
-    cached_filename = os.path.join (config.s3_cache_storage, str(uuid.uuid4()))
+    if directory is None:
+        directory = config.s3_cache_storage
+    cached_filename = os.path.join (directory, f"{uuid.uuid4()}.partial")
+    ranges = reader.part_ranges ()
     with open (cached_filename, "wb") as output_stream:
-        retries = 3
+        # Parts are retried individually.
+        retries = 3 if ranges is None else 0
+        if ranges is not None:
+            for chunk in reader.parts_iterator (ranges):
+                output_stream.write (chunk)
         while retries > 0:
             try:
                 for chunk in reader.iterator():
@@ -137,3 +421,107 @@ def s3_temporary_file (reader):
                               reader.content_length)
     reader.close()
     return cached_filename
+
+class _SlotLock:
+    """Lock shared between threads and processes for one of 256 slots."""
+
+    def __init__ (self, directory, slot, blocking=True):
+        self.filename = os.path.join (directory, f"{slot:02x}")
+        self.blocking = blocking
+        self.stream   = None
+
+    def __enter__ (self):
+        if fcntl is None:
+            return True
+        self.stream = open (self.filename, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+        try:
+            flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            fcntl.flock (self.stream.fileno(), flags)
+            return True
+        except OSError:
+            return False
+
+    def __exit__ (self, *args):
+        if self.stream is not None:
+            self.stream.close()
+
+def _touch (filename):
+    """Returns True when FILENAME exists and marks it as recently used."""
+    try:
+        os.utime (filename)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _evict_s3_cache (directory, keep):
+    """Removes the least recently used objects until the budget is met."""
+    entries = []
+    total   = 0
+    now     = time.time()
+    with os.scandir (directory) as iterator:
+        for entry in iterator:
+            try:
+                status = entry.stat()
+            except FileNotFoundError:
+                continue
+            # Downloads that were interrupted are removed after a day.
+            if entry.name.endswith (".partial"):
+                if now - status.st_mtime > 86400:
+                    _remove (entry.path)
+                continue
+            total += status.st_size
+            if entry.path != keep:
+                entries.append ((status.st_mtime, status.st_size, entry.path))
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= config.s3_cache_budget:
+            break
+        _remove (path)
+        total -= size
+
+def _remove (filename):
+    """Procedure to remove FILENAME unless another worker already did."""
+    try:
+        os.remove (filename)
+    except FileNotFoundError:
+        pass
+
+def s3_cached_file (reader):
+    """
+    Returns the local filesystem path of a copy of the S3 object of READER.
+    Copies are identified by the bucket, key and ETag of the object, so a
+    changed object is downloaded again.  The least recently used copies are
+    removed when all copies take more than 's3_cache_budget' bytes.
+    """
+    if not reader.head():
+        raise FileNotFoundError(f"s3://{reader.bucket}/{reader.filename}")
+
+    identifier = f"{reader.bucket}\0{reader.filename}\0{reader.etag}"
+    digest     = hashlib.sha256 (identifier.encode("utf-8")).hexdigest()
+    directory  = os.path.join (config.s3_cache_storage, "objects")
+    locks      = os.path.join (config.s3_cache_storage, "locks")
+    cached_filename = os.path.join (directory, digest)
+    if _touch (cached_filename):
+        return cached_filename
+
+    os.makedirs (directory, mode=0o700, exist_ok=True)
+    os.makedirs (locks, mode=0o700, exist_ok=True)
+
+    # Only one worker downloads an object, while the others wait for it.
+    with _SlotLock (locks, int(digest[:2], 16)):
+        if _touch (cached_filename):
+            return cached_filename
+
+        expected_size = reader.content_length
+        filename      = s3_temporary_file (reader, directory)
+        if os.path.getsize (filename) != expected_size:
+            os.remove (filename)
+            raise FileNotFoundError(f"Incomplete download of s3://{reader.bucket}/{reader.filename}")
+        os.replace (filename, cached_filename)
+
+    with _SlotLock (locks, 256, blocking=False) as is_locked:
+        if is_locked:
+            _evict_s3_cache (directory, cached_filename)
+
+    return cached_filename
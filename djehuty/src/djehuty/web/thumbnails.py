@@ -0,0 +1,81 @@
+"""
+This module implements the responsive variants of dataset thumbnails:
+copies of a thumbnail at several widths in WebP, and optionally AVIF,
+from which browsers pick the smallest one that suits the page.
+"""
+
+import os
+from PIL import Image, features
+from djehuty.web.config import config
+
+def formats ():
+    """Returns the encodings in which variants are stored, preferred first."""
+    output = []
+    if config.thumbnail_avif and features.check ("avif"):
+        output.append ("avif")
+    if features.check ("webp"):
+        output.append ("webp")
+    return output
+
+def variant_filename (dataset_uuid, width, image_format):
+    """Returns the filename of the WIDTH pixels wide variant in IMAGE_FORMAT."""
+    return os.path.join (config.thumbnail_storage, f"{dataset_uuid}-{width}.{image_format}")
+
+def remove_variants (dataset_uuid):
+    """Procedure to remove the variants of the thumbnail of DATASET_UUID."""
+    for width in config.thumbnail_widths:
+        for image_format in ("avif", "webp"):
+            try:
+                os.remove (variant_filename (dataset_uuid, width, image_format))
+            except FileNotFoundError:
+                pass
+
+def save_variants (image, dataset_uuid):
+    """
+    Procedure to store the variants of IMAGE as the thumbnail of
+    DATASET_UUID.  Animated images have no variants, so that browsers
+    fall back to the animated thumbnail.
+    """
+    remove_variants (dataset_uuid)
+    if getattr (image, "is_animated", False):
+        return None
+
+    has_alpha = "A" in image.getbands () or "transparency" in image.info
+    image = image.convert ("RGBA" if has_alpha else "RGB")
+    for width in config.thumbnail_widths:
+        # Images are not enlarged; a narrow image is stored as it is.
+        scaled_width = min(width, image.width)
+        height  = max(1, round(image.height * scaled_width / image.width))
+        resized = image.resize ((scaled_width, height), Image.Resampling.LANCZOS)
+        for image_format in formats ():
+            filename = variant_filename (dataset_uuid, width, image_format)
+            partial  = f"{filename}.{os.getpid()}.partial"
+            resized.save (partial, format=image_format.upper())
+            os.replace (partial, filename)
+
+    return None
+
+def sources (thumb):
+    """
+    Returns a list of dictionaries with the 'type' and 'srcset' of the
+    variants of THUMB, or an empty list when no variants are stored.
+    """
+    if (not thumb or not thumb.startswith ("/thumbnails/") or
+        config.thumbnail_storage is None or not config.thumbnail_widths):
+        return []
+
+    dataset_uuid = os.path.splitext (os.path.basename (thumb))[0]
+    output = []
+    for image_format in formats ():
+        # Variants are written from small to large, so the largest one
+        # being present means all of them are.
+        largest = variant_filename (dataset_uuid, config.thumbnail_widths[-1], image_format)
+        if not os.path.isfile (largest):
+            continue
+        output.append ({
+            "type":   f"image/{image_format}",
+            "srcset": ", ".join (f"/thumbnails/{dataset_uuid}-{width}.{image_format} {width}w"
+                                 for width in config.thumbnail_widths)
+        })
+
+    return output
@@ -163,6 +163,15 @@ def read_storage_configuration (xml_root, logger):
                     logger.warning ("Missing '%s' for S3 bucket.", key)
                     break
 
+            for key, default in (("part-size", 8388608), ("part-workers", 1),
+                                 ("part-memory", 67108864)):
+                try:
+                    bucket[key] = int(config_value (item, key, None, default))
+                except (ValueError, TypeError):
+                    logger.warning ("Invalid value for '%s' of S3 bucket; Using %s.",
+                                    key, default)
+                    bucket[key] = default
+
             config.s3_buckets[bucket["name"]] = bucket
     return None
 
@@ -199,6 +208,102 @@ def read_quotas_configuration (xml_root):
 
     return None
 
+def read_memory_cache_configuration (xml_root, logger):
+    """Read the configuration of the in-memory cache tier from XML_ROOT."""
+
+    memory_cache = xml_root.find("memory-cache")
+    if memory_cache is None:
+        return None
+
+    try:
+        config.cache_memory_budget = int(memory_cache.attrib.get("budget", 0))
+        default_ttl = memory_cache.attrib.get("default-ttl")
+        if default_ttl is not None:
+            config.cache_memory_default_ttl = int(default_ttl)
+    except (ValueError, TypeError):
+        logger.warning ("Invalid value for 'memory-cache'; Disabling the in-memory cache.")
+        config.cache_memory_budget = 0
+        return None
+
+    for prefix in memory_cache:
+        if prefix.tag != "prefix":
+            continue
+        name = prefix.attrib.get("name")
+        try:
+            config.cache_memory_ttls[name] = int(prefix.text)
+        except (ValueError, TypeError):
+            logger.warning ("Ignoring invalid time-to-live for cache prefix '%s'.", name)
+
+    return None
+
+def read_session_cache_configuration (xml_root, logger):
+    """Read the configuration of the in-process session cache from XML_ROOT."""
+
+    session_cache = xml_root.find("session-cache")
+    if session_cache is None:
+        return None
+
+    try:
+        config.session_cache_ttl  = int(session_cache.attrib.get("ttl", config.session_cache_ttl))
+        config.session_cache_size = int(session_cache.attrib.get("size", config.session_cache_size))
+    except (ValueError, TypeError):
+        logger.warning ("Invalid value for 'session-cache'; Disabling the session cache.")
+        config.session_cache_ttl = 0
+
+    return None
+
+def read_download_offload_configuration (xml_root, logger):
+    """Read how file downloads are handed over to the web server from XML_ROOT."""
+
+    offload = xml_root.find("download-offload")
+    if offload is None:
+        return None
+
+    mode = offload.attrib.get("mode", "none")
+    if mode not in ("none", "x-sendfile", "x-accel-redirect"):
+        logger.warning ("Unknown download offload mode '%s'; Not offloading downloads.", mode)
+        return None
+
+    config.download_offload = None if mode == "none" else mode
+    for location in offload:
+        if location.tag != "location":
+            continue
+        path = location.attrib.get("path")
+        uri  = location.attrib.get("uri")
+        if path is None or uri is None:
+            logger.warning ("Ignoring download offload location without 'path' or 'uri'.")
+            continue
+        # Paths are compared with the real path of each file, so they are
+        # stored without symbolic links or relative components.
+        path = os.path.join (os.path.realpath (path), "")
+        config.download_offload_locations[path] = uri.rstrip("/")
+
+    if mode == "x-accel-redirect" and not config.download_offload_locations:
+        logger.warning ("No locations configured for 'x-accel-redirect'; Not offloading downloads.")
+        config.download_offload = None
+
+    return None
+
+def read_upload_configuration (xml_root, logger):
+    """Read how uploaded files are received from XML_ROOT."""
+
+    upload = xml_root.find("upload")
+    if upload is None:
+        return None
+
+    try:
+        chunk_size = int(upload.attrib.get("chunk-size", config.upload_chunk_size))
+        if chunk_size < 4096:
+            raise ValueError
+        config.upload_chunk_size = chunk_size
+    except (ValueError, TypeError):
+        logger.warning ("Invalid value for the 'chunk-size' attribute in 'upload'; Using %s bytes.",
+                        config.upload_chunk_size)
+
+    config.upload_sha256    = upload.attrib.get("sha256", "0") == "1"
+    config.upload_s3_bucket = upload.attrib.get("s3-bucket", config.upload_s3_bucket)
+    return None
+
 def read_sram_configuration (xml_root):
     """Read the SRAM configuration from XML_ROOT."""
 
@@ -735,6 +840,26 @@ def read_configuration_file (server, config_file, logger, config_files):
         if update_endpoint:
             config.update_endpoint = update_endpoint
 
+        try:
+            config.parallel_queries = int(config_value (xml_root, "rdf-store/parallel-queries",
+                                                        None, config.parallel_queries))
+        except (ValueError, TypeError):
+            logger.warning ("Invalid value for 'parallel-queries'; Sending queries one-by-one.")
+            config.parallel_queries = 1
+
+        connection_pool = xml_root.find("rdf-store/connection-pool")
+        if connection_pool is not None:
+            try:
+                config.sparql_pool_size = int(connection_pool.attrib.get(
+                    "size", config.sparql_pool_size))
+                config.sparql_connect_timeout = float(connection_pool.attrib.get(
+                    "connect-timeout", config.sparql_connect_timeout))
+                read_timeout = connection_pool.attrib.get("read-timeout")
+                if read_timeout is not None:
+                    config.sparql_read_timeout = float(read_timeout)
+            except (ValueError, TypeError):
+                logger.warning ("Invalid value for 'connection-pool'; Using default values.")
+
         config.show_portal_summary = read_boolean_value (xml_root, "show-portal-summary",
                                                          config.show_portal_summary, logger)
 
@@ -765,6 +890,10 @@ def read_configuration_file (server, config_file, logger, config_files):
         config.delay_inserting_log_entries = read_boolean_value (xml_root, "delay-inserting-log-entries",
                                                                  config.delay_inserting_log_entries, logger)
 
+        config.coalesce_queries_between_workers = read_boolean_value (
+            xml_root, "coalesce-queries-between-workers",
+            config.coalesce_queries_between_workers, logger)
+
         ssi_psk = config_value (xml_root, "ssi-psk")
         if ssi_psk is not None:
             ssi_psk = ssi_psk.replace(" ", "").replace("\n", "").replace("\r", "").replace("\t", "")
@@ -797,6 +926,13 @@ def read_configuration_file (server, config_file, logger, config_files):
                 config.clear_cache_on_start = False
             except TypeError:
                 config.clear_cache_on_start = False
+            try:
+                config.cache_max_staleness = int(cache_root.attrib.get(
+                    "max-staleness", config.cache_max_staleness))
+                config.cache_refresh_workers = int(cache_root.attrib.get(
+                    "refresh-workers", config.cache_refresh_workers))
+            except ValueError:
+                logger.warning ("Invalid value for the 'max-staleness' or 'refresh-workers' attribute in 'cache-root'.")
         elif server.db.cache.storage is None:
             server.db.cache.storage = os.path.join (config.storage, "cache")
 
@@ -809,21 +945,76 @@ def read_configuration_file (server, config_file, logger, config_files):
         thumbnails_root = xml_root.find ("thumbnails-root")
         if thumbnails_root is not None:
             config.thumbnail_storage = thumbnails_root.text
+            try:
+                widths = thumbnails_root.attrib.get("widths")
+                if widths is not None:
+                    widths = sorted (int(width) for width in widths.split(",") if width.strip())
+                    if min(widths, default=0) < 1:
+                        raise ValueError
+                    config.thumbnail_widths = widths
+            except ValueError:
+                logger.warning ("Invalid value for the 'widths' attribute in 'thumbnails-root'.")
+            config.thumbnail_avif = thumbnails_root.attrib.get("avif", "0") == "1"
         elif config.thumbnail_storage is None:
             config.thumbnail_storage = os.path.join (config.storage, "thumbnails")
 
+        jobs_root = xml_root.find ("jobs-root")
+        if jobs_root is not None:
+            config.job_storage = jobs_root.text
+            try:
+                config.job_workers     = int(jobs_root.attrib.get("workers", config.job_workers))
+                config.job_attempts    = max(1, int(jobs_root.attrib.get("attempts", config.job_attempts)))
+                config.job_retry_delay = int(jobs_root.attrib.get("retry-delay", config.job_retry_delay))
+            except (ValueError, TypeError):
+                logger.warning ("Invalid value for the 'workers', 'attempts' or 'retry-delay' attribute in 'jobs-root'.")
+        elif config.job_storage is None:
+            config.job_storage = os.path.join (config.storage, "jobs")
+
         iiif_cache = xml_root.find ("iiif-cache-root")
         if iiif_cache is not None:
             config.iiif_cache_storage = iiif_cache.text
+            try:
+                config.iiif_cache_budget = int(iiif_cache.attrib.get("budget", config.iiif_cache_budget))
+            except (ValueError, TypeError):
+                logger.warning ("Invalid value for the 'budget' attribute in 'iiif-cache-root'.")
         elif config.iiif_cache_storage is None:
             config.iiif_cache_storage = os.path.join (config.storage, "iiif")
 
+        try:
+            config.iiif_pyramid_workers = int(config_value (xml_root, "iiif-pyramid-workers",
+                                                            None, config.iiif_pyramid_workers))
+        except (ValueError, TypeError):
+            logger.warning ("Invalid value for 'iiif-pyramid-workers'; Using %s threads.",
+                            config.iiif_pyramid_workers)
+
         s3_cache = xml_root.find ("s3-cache-root")
         if s3_cache is not None:
             config.s3_cache_storage = s3_cache.text
+            try:
+                config.s3_cache_budget = int(s3_cache.attrib.get("budget", config.s3_cache_budget))
+            except (ValueError, TypeError):
+                logger.warning ("Invalid value for the 'budget' attribute in 's3-cache-root'.")
         elif config.s3_cache_storage is None:
             config.s3_cache_storage = os.path.join (config.storage, "s3")
 
+        try:
+            config.s3_pool_size = int(config_value (xml_root, "s3-pool-size",
+                                                    None, config.s3_pool_size))
+        except (ValueError, TypeError):
+            logger.warning ("Invalid value for 's3-pool-size'; Using %s connections.",
+                            config.s3_pool_size)
+
+        s3_read_ahead = xml_root.find ("s3-read-ahead")
+        if s3_read_ahead is not None:
+            try:
+                config.s3_read_ahead = int(s3_read_ahead.attrib.get(
+                    "objects", config.s3_read_ahead))
+                config.s3_read_ahead_memory = int(s3_read_ahead.attrib.get(
+                    "memory", config.s3_read_ahead_memory))
+            except (ValueError, TypeError):
+                logger.warning ("Invalid value for 's3-read-ahead'; Reading S3 objects one-by-one.")
+                config.s3_read_ahead = 0
+
         static_resources_cache = xml_root.find ("static-resources-cache")
         if static_resources_cache is not None:
             config.static_cache_root = static_resources_cache.text
@@ -918,6 +1109,10 @@ def read_configuration_file (server, config_file, logger, config_files):
         read_privilege_configuration (xml_root, logger)
         read_storage_configuration (xml_root, logger)
         read_quotas_configuration (xml_root)
+        read_memory_cache_configuration (xml_root, logger)
+        read_session_cache_configuration (xml_root, logger)
+        read_download_offload_configuration (xml_root, logger)
+        read_upload_configuration (xml_root, logger)
         read_colors_configuration (xml_root)
 
         for include_element in xml_root.iter('include'):
@@ -1205,6 +1400,12 @@ def main (config_file=None, run_internal_server=True, initialize=True,
         if not server.add_static_root ("/thumbnails", config.thumbnail_storage):
             logger.error ("Failed to setup route for thumbnails.")
 
+        if config.job_storage is not None and not inside_reload:
+            try:
+                os.makedirs (config.job_storage, mode=0o700, exist_ok=True)
+            except PermissionError:
+                logger.error ("Cannot create %s directory.", config.job_storage)
+
         if config.iiif_cache_storage is not None and not inside_reload:
             try:
                 os.makedirs (config.iiif_cache_storage, mode=0o700, exist_ok=True)
@@ -1219,6 +1420,10 @@ def main (config_file=None, run_internal_server=True, initialize=True,
         if perform_export:
             return perform_rdf_export (logger, server, full_rdf_export)
 
+        # Resume the jobs that were spooled before the server (re)started.
+        # Under uWSGI this runs in each worker process that builds a server.
+        server.jobs.start ()
+
         if not run_internal_server:
             config.using_uwsgi = True
             config.startup_timestamp = int(datetime.now().timestamp())
@@ -1253,6 +1458,9 @@ def main (config_file=None, run_internal_server=True, initialize=True,
                     logger.info ("Storage path:            %s", location["path"])
             logger.info ("Secondary storage path:  %s", config.secondary_storage)
             logger.info ("Cache storage path:      %s", server.db.cache.storage)
+            logger.info ("Job spool path:          %s", config.job_storage)
+            if config.cache_memory_budget > 0:
+                logger.info ("In-memory cache budget:  %s bytes", config.cache_memory_budget)
             logger.info ("Static pages loaded:     %s", len(server.static_pages))
             if config.handle_url is None:
                 logger.info ("Handle registration is disabled.")
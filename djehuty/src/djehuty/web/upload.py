@@ -0,0 +1,113 @@
+"""
+This module implements writing the body of an upload to disk while its
+checksums are computed, and optionally copied to S3, by another thread.
+"""
+
+import logging
+import hashlib
+import queue
+import time
+import zlib
+from threading import Thread
+from djehuty.web import s3
+
+class UploadWriter:
+    """
+    Copies an upload to OUTPUT_STREAM in chunks of CHUNK_SIZE bytes.  The
+    request body is read and written to disk by the calling thread, while
+    a second thread computes the MD5, CRC-32 and optional SHA-256 checksums
+    and passes the data on to S3 when BUCKET is given.
+    """
+
+    def __init__ (self, output_stream, chunk_size=1048576, sha256=False,
+                  bucket=None, filename=None, queue_size=4):
+        self.output_stream = output_stream
+        self.chunk_size    = chunk_size
+        self.log           = logging.getLogger (__name__)
+        self.md5           = hashlib.new ("md5", usedforsecurity=False)
+        self.sha256        = hashlib.sha256 () if sha256 else None
+        self.crc32         = 0
+        self.bytes_written = 0
+        self.read_time     = 0.0
+        self.stall_time    = 0.0
+        self.start_time    = time.perf_counter()
+        self.chunks        = queue.Queue (maxsize = max(1, queue_size))
+        self.s3_writer     = None
+        if bucket is not None:
+            self.s3_writer = s3.S3MultipartWriter (bucket, filename)
+
+        self.consumer      = Thread (target = self.__consume,
+                                     name   = "upload-checksums",
+                                     daemon = True)
+        self.consumer.start()
+
+    def __consume (self):
+        """Computes the checksums of and copies the chunks until None."""
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            self.md5.update (chunk)
+            self.crc32 = zlib.crc32 (chunk, self.crc32)
+            if self.sha256 is not None:
+                self.sha256.update (chunk)
+            if self.s3_writer is not None and not self.s3_writer.failed:
+                try:
+                    self.s3_writer.write (chunk)
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    self.log.error ("Copying the upload to S3 failed: %s", error)
+                    self.s3_writer.failed = True
+
+    def write (self, chunk):
+        """Writes CHUNK to disk and hands it over to the checksum thread."""
+        start_time = time.perf_counter()
+        self.chunks.put (chunk)
+        self.stall_time += time.perf_counter() - start_time
+        written = self.output_stream.write (chunk)
+        self.bytes_written += written
+        return written
+
+    def copy (self, input_stream, length):
+        """Copies LENGTH bytes from INPUT_STREAM and returns the bytes written."""
+        written = 0
+        while length > 0:
+            start_time = time.perf_counter()
+            chunk = input_stream.read (min(length, self.chunk_size))
+            self.read_time += time.perf_counter() - start_time
+            if not chunk:
+                break
+            length  -= len(chunk)
+            written += self.write (chunk)
+
+        return written
+
+    def finish (self, complete=True, expected_md5=None):
+        """
+        Waits for the checksum thread and returns the checksums as a
+        dictionary.  The copy in S3 is only kept when COMPLETE is True
+        and, when EXPECTED_MD5 is given, the MD5 checksum matches it.
+        """
+        start_time = time.perf_counter()
+        self.chunks.put (None)
+        self.consumer.join()
+
+        checksums = {
+            "md5":    self.md5.hexdigest(),
+            "crc32":  f"{self.crc32:08x}",
+            "sha256": None if self.sha256 is None else self.sha256.hexdigest(),
+            "s3":     False
+        }
+        if self.s3_writer is not None:
+            if expected_md5 is not None and checksums["md5"] != expected_md5:
+                complete = False
+            checksums["s3"] = self.s3_writer.close (complete)
+        self.stall_time += time.perf_counter() - start_time
+
+        duration = max(time.perf_counter() - self.start_time, 0.000001)
+        self.log.info ("Received %d bytes in %.2fs (%.1f MiB/s): %.2fs waiting "
+                       "for the client, %.2fs stalled on checksums%s.",
+                       self.bytes_written, duration,
+                       self.bytes_written / duration / 1048576,
+                       self.read_time, self.stall_time,
+                       "" if self.s3_writer is None else " and S3")
+        return checksums
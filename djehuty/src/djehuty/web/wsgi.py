@@ -2,7 +2,6 @@
 
 from datetime import date, datetime, timedelta
 from io import StringIO
-from math import ceil, log2
 import os.path
 import os
 import shutil
@@ -11,6 +10,8 @@ import getpass
 import logging
 import json
 import hashlib
+import itertools
+import zlib
 import subprocess
 import secrets
 import re
@@ -36,6 +37,10 @@ from djehuty.web import database
 from djehuty.web import email_handler
 from djehuty.web import locks
 from djehuty.web import s3
+from djehuty.web import upload
+from djehuty.web import iiif
+from djehuty.web import jobs
+from djehuty.web import thumbnails
 from djehuty.utils.convenience import pretty_print_size, decimal_coords, normalize_doi
 from djehuty.utils.convenience import value_or, value_or_none, deduplicate_list
 from djehuty.utils.convenience import self_or_value_or_none, parses_to_int
@@ -62,6 +67,14 @@ try:
 except (OSError, ImportError, ModuleNotFoundError):
     pass
 
+## The commonly used mimetypes for JPEG and TIFF are image/jpeg and image/tiff.
+IIIF_MIMETYPES = {
+    "jpg":  "image/jpeg",
+    "png":  "image/png",
+    "tif":  "image/tiff",
+    "webp": "image/webp"
+}
+
 def R (uri_path, endpoint):  # pylint: disable=invalid-name
     """
     Short-hand for defining a route between a URI and its
@@ -81,6 +94,12 @@ class WebServer:
         self.log_access          = self.log_access_directly
         self.log                 = logging.getLogger(__name__)
         self.locks               = locks.Locks()
+        self.derivatives         = iiif.DerivativeCache()
+        self.pyramids            = iiif.Pyramids(self.derivatives)
+        self.jobs                = jobs.JobQueue()
+        self.jobs.register ("thumbnail", self.__thumbnail_job)
+        self.jobs.register ("iiif-pyramid", self.__iiif_pyramid_job)
+        self.jobs.register ("crc32", self.__crc32_job)
         self.static_pages = {}
 
         ## Routes to all reachable pages and API calls.
@@ -144,6 +163,8 @@ class WebServer:
             R("/admin/maintenance/repair-doi-registrations",                     self.ui_admin_repair_doi_registrations),
             R("/admin/maintenance/remove-website-sessions",                      self.ui_admin_remove_website_sessions),
             R("/admin/maintenance/recalculate-statistics",                       self.ui_admin_recalculate_statistics),
+            R("/admin/maintenance/compute-crc32-checksums",                      self.ui_admin_compute_crc32_checksums),
+            R("/admin/maintenance/create-missing-thumbnails",                    self.ui_admin_create_missing_thumbnails),
             R("/categories/<category_id>",                                       self.ui_categories),
             R("/category",                                                       self.ui_category),
             R("/institutions/<institution_name>",                                self.ui_institution),
@@ -288,6 +309,7 @@ class WebServer:
             R("/v3/datasets/<dataset_id>.git/branches",                          self.api_v3_dataset_git_branches),
             R("/v3/datasets/<dataset_id>.git/set-default-branch",                self.api_v3_datasets_git_set_default_branch),
             R("/v3/file/<file_id>",                                              self.api_v3_file),
+            R("/v3/jobs/<job_id>",                                               self.api_v3_job),
             R("/v3/datasets/<container_uuid>/authors",                           self.api_v3_dataset_authors),
             R("/v3/datasets/<container_uuid>/authors/<author_uuid>",             self.api_v3_dataset_authors),
             R("/v3/datasets/<container_uuid>/reorder-authors",                   self.api_v3_datasets_authors_reorder),
@@ -330,6 +352,7 @@ class WebServer:
             ## Administrative
             ## ----------------------------------------------------------------
             R("/v3/admin/files-integrity-statistics",                            self.api_v3_admin_files_integrity_statistics),
+            R("/v3/admin/iiif-cache-statistics",                                 self.api_v3_admin_iiif_cache_statistics),
             R("/v3/admin/accounts/clear-cache",                                  self.api_v3_admin_accounts_clear_cache),
             R("/v3/admin/reviews/clear-cache",                                   self.api_v3_admin_reviews_clear_cache),
 
@@ -372,6 +395,7 @@ class WebServer:
                 # For static pages.
                 "/"
             ]), autoescape = True)
+        self.jinja.globals["thumbnail_sources"] = thumbnails.sources
 
         self.metadata_jinja = Environment(loader = FileSystemLoader([
             os.path.join(resources_path, "resources", "metadata_templates"),
@@ -425,7 +449,7 @@ class WebServer:
             s3_cached_file = None
             original = None
             if isinstance (input_filename, s3.S3DownloadStreamer):
-                s3_cached_file = s3.s3_temporary_file (input_filename)
+                s3_cached_file = s3.s3_cached_file (input_filename)
                 original = Image.open (s3_cached_file)
             else:
                 original = Image.open (input_filename)
@@ -433,10 +457,21 @@ class WebServer:
             extension = original.format.lower()
             output_filename = os.path.join (config.thumbnail_storage, f"{dataset_uuid}.{extension}")
 
+            # JPEG images are decoded at the smallest scale that is still at
+            # least as large as the thumbnail and its widest variant.
+            if extension == "jpeg":
+                largest = max([max_width, max_height] + config.thumbnail_widths)
+                original.draft (None, (largest, largest))
+
+            try:
+                thumbnails.save_variants (original, dataset_uuid)
+            except (OSError, ValueError) as error:
+                self.log.warning ("Failed to create thumbnail variants due to %s", error)
+
             # When the image is the exact thumbnail size.
             if original.width == max_width and original.height == max_height:
                 original.save (output_filename)
-                return None
+                return extension
 
             # Determine relative scaling.
             if original.width > original.height:
@@ -475,9 +510,6 @@ class WebServer:
             thumbnail = original.resize ((thumb_width, thumb_height))
             thumbnail.save (output_filename)
 
-            if s3_cached_file is not None:
-                os.remove (s3_cached_file)
-
             return extension
 
         except (FileNotFoundError, UnidentifiedImageError) as error:
@@ -485,14 +517,72 @@ class WebServer:
 
         return None
 
+    def __submit_thumbnail_job (self, dataset_uuid, account_uuid, file_uuid, version=None):
+        """Returns a response for generating a thumbnail in the background."""
+        job_id = self.jobs.submit ("thumbnail", {
+            "dataset_uuid": dataset_uuid,
+            "account_uuid": account_uuid,
+            "file_uuid":    file_uuid,
+            "version":      version
+        }, account_uuid = account_uuid)
+        if job_id is None:
+            return self.error_500 ()
+
+        return self.respond_202 ({ "job": job_id, "status": f"/v3/jobs/{job_id}" })
+
+    def __thumbnail_job (self, parameters):
+        """Procedure to generate a thumbnail and set it for its dataset."""
+        metadata = self.__file_by_id_or_uri (parameters["file_uuid"],
+                                             account_uuid = parameters["account_uuid"])
+        if metadata is None:
+            raise FileNotFoundError (f"file:{parameters['file_uuid']} is not accessible.")
+
+        input_filename = self.__filesystem_location (metadata)
+        if input_filename is None:
+            raise FileNotFoundError (f"file:{parameters['file_uuid']} is not stored.")
+
+        extension = self.__generate_thumbnail (input_filename, parameters["dataset_uuid"])
+        if extension is None:
+            raise RuntimeError (f"Unable to create a thumbnail of file:{parameters['file_uuid']}.")
+
+        if not self.db.dataset_update_thumb (parameters["dataset_uuid"],
+                                             parameters["account_uuid"],
+                                             parameters["file_uuid"],
+                                             extension,
+                                             parameters["version"]):
+            raise RuntimeError (f"Unable to set the thumbnail of dataset:{parameters['dataset_uuid']}.")
+
+    def __crc32_job (self, parameters):
+        """Procedure to compute and store the CRC-32 checksum of a file."""
+        crc32 = self.__file_crc32 (parameters)
+        if crc32 is None:
+            raise FileNotFoundError (f"file:{parameters['uuid']} is not readable.")
+
+        if not self.db.insert_missing_crc32 (parameters["uuid"], f"{crc32:08x}"):
+            raise RuntimeError (f"Unable to store the CRC-32 checksum of file:{parameters['uuid']}.")
+
+    def __iiif_pyramid_job (self, parameters):
+        """Procedure to create the IIIF pyramid of a file."""
+        file_uuid = parameters["file_uuid"]
+        if os.path.isfile (self.pyramids.filename (file_uuid)):
+            return
+
+        source = value_or_none (parameters, "path")
+        if source is None or not os.path.isfile (source):
+            metadata = self.db.dataset_files (file_uuid = file_uuid)
+            if not metadata:
+                raise FileNotFoundError (f"file:{file_uuid} does not exist.")
+            source = self.__filesystem_location (metadata[0])
+            if source is None:
+                raise FileNotFoundError (f"file:{file_uuid} is not stored.")
+
+        if not self.pyramids.create (source, file_uuid, parameters["is_pdf"]):
+            raise RuntimeError (f"Unable to create the IIIF pyramid of file:{file_uuid}.")
+
     def __render_svg_template (self, template_name, **context):
         template = self.jinja.get_template (template_name)
         return self.response (template.render (context), mimetype="image/svg+xml")
 
-    def __render_xml_template(self, template_name, **context):
-        template = self.jinja.get_template(template_name)
-        return self.response(template.render(context), mimetype="application/xml")
-
     def __render_css_template (self, template_name, **context):
         template = self.jinja.get_template (template_name)
         return self.response (template.render (context), mimetype="text/css")
@@ -568,6 +658,7 @@ class WebServer:
 
     def __dispatch_request (self, request):
         adapter = self.url_map.bind_to_environ(request.environ)
+        self.db.begin_request ()
         try:
             self.log_access (request)
             if config.maintenance_mode:
@@ -598,6 +689,8 @@ class WebServer:
         except Exception as error:
             self.log.error ("In request: %s", request.environ)
             raise error
+        finally:
+            self.db.end_request ()
 
     def __respond (self, environ, start_response):
         request  = Request(environ)
@@ -933,6 +1026,13 @@ class WebServer:
         response.status_code = 415
         return response
 
+    def error_416 (self, length):
+        """Procedure to respond with HTTP 416."""
+        response = self.response ("", mimetype="text/plain")
+        response.headers["Content-Range"] = f"bytes */{length}"
+        response.status_code = 416
+        return response
+
     def error_406 (self, allowed_formats):
         """Procedure to respond with HTTP 406."""
         response = self.response (f"Acceptable formats: {allowed_formats}",
@@ -1652,6 +1752,12 @@ class WebServer:
         output.status_code = 201
         return output
 
+    def respond_202 (self, body):
+        """Procedure to respond with HTTP 202."""
+        output = self.response (json.dumps(body))
+        output.status_code = 202
+        return output
+
     def respond_204 (self):
         """Procedure to respond with HTTP 204."""
         output = Response("", 204, {})
@@ -1717,11 +1823,27 @@ class WebServer:
         if not self.accepts_content_type(request, "application/xml", strict=False):
             return self.error_406("application/xml")
 
+        # The sitemap is streamed without caching, because caching would
+        # hold all of its datasets in memory until the last one was read.
         datasets = self.db.datasets(is_published=True, is_latest=True,
-                                    limit=50000)
-        return self.__render_xml_template("sitemap_template.xml",
-                                          base_url = config.base_url,
-                                          datasets = datasets)
+                                    limit=50000, use_cache=False,
+                                    as_iterator=True)
+
+        # Reading the first dataset before responding turns an unreachable
+        # SPARQL endpoint into an error rather than an empty sitemap.  A
+        # failure later on is raised from the iterator, which aborts the
+        # response instead of ending it with a truncated sitemap.
+        try:
+            first = next (datasets, None)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            return self.error_500 (f"Could not generate the sitemap: {error}")
+
+        if first is not None:
+            datasets = itertools.chain ([first], datasets)
+        template = self.jinja.get_template("sitemap_template.xml")
+        return self.response(template.generate(base_url = config.base_url,
+                                               datasets = datasets),
+                             mimetype="application/xml")
 
     def ui_maintenance (self, request):
         """Implements a maintenance page."""
@@ -3426,6 +3548,98 @@ class WebServer:
 
         return self.error_403 (request)
 
+    def __file_crc32 (self, file_info):
+        """Returns the CRC-32 checksum of a stored file, or None."""
+
+        file_path = self.__filesystem_location (file_info)
+        if file_path is None:
+            return None
+
+        crc32 = 0
+        if isinstance (file_path, s3.S3DownloadStreamer):
+            try:
+                for chunk in file_path.iterator():
+                    crc32 = zlib.crc32 (chunk, crc32)
+            except (AttributeError, OSError, *s3.S3_ERRORS) as error:
+                self.log.error ("Reading %s from S3 failed: %s", file_info["uuid"], error)
+                return None
+            finally:
+                file_path.close()
+            return crc32
+
+        with open (file_path, "rb") as stream:
+            for chunk in iter(lambda: stream.read(262144), b""): # pylint: disable=cell-var-from-loop
+                crc32 = zlib.crc32 (chunk, crc32)
+        return crc32
+
+    def ui_admin_compute_crc32_checksums (self, request):
+        """Implements /admin/maintenance/compute-crc32-checksums."""
+        token = self.token_from_cookie (request)
+        if not self.db.may_administer (token):
+            return self.error_403 (request)
+
+        # Reading every stored file takes far longer than a request may,
+        # so each file is checksummed by a background job.
+        queued = set()
+        error_count = 0
+        for file_info in self.db.missing_crc32_files ():
+            # Files are shared between the versions of a dataset.
+            if file_info["uuid"] in queued:
+                continue
+            if self.jobs.submit ("crc32", file_info) is None:
+                error_count += 1
+                continue
+            queued.add (file_info["uuid"])
+
+        self.log.info ("Queued %s CRC-32 checksum jobs.", len(queued))
+        if error_count == 0:
+            return self.respond_204 ()
+
+        return self.error_500 (f"Failed to queue {error_count} CRC-32 checksum jobs.")
+
+    def ui_admin_create_missing_thumbnails (self, request):
+        """Implements /admin/maintenance/create-missing-thumbnails."""
+        token = self.token_from_cookie (request)
+        if not self.db.may_administer (token):
+            return self.error_403 (request)
+
+        thumbnail_jobs = 0
+        pyramid_jobs   = set()
+        for file_info in self.db.image_files ():
+            # Dataset thumbnails that are referred to but no longer stored,
+            # or that have no variants for responsive images yet.
+            thumb = value_or_none (file_info, "thumb")
+            if (thumb is not None and
+                value_or_none (file_info, "thumb_origin") == file_info["uuid"] and
+                (not os.path.isfile (os.path.join (config.thumbnail_storage,
+                                                   os.path.basename (thumb))) or
+                 (not thumbnails.sources (thumb) and not thumb.endswith (".gif")))):
+                if self.jobs.submit ("thumbnail", {
+                        "dataset_uuid": file_info["dataset_uuid"],
+                        "account_uuid": file_info["account_uuid"],
+                        "file_uuid":    file_info["uuid"],
+                        "version":      None
+                    }, account_uuid = file_info["account_uuid"]) is not None:
+                    thumbnail_jobs += 1
+
+            # Files are shared between the versions of a dataset.
+            if file_info["uuid"] in pyramid_jobs:
+                continue
+
+            extension = os.path.splitext (value_or (file_info, "name", ""))[1]
+            if (config.enable_iiif and config.iiif_pyramid_workers > 0 and
+                extension in iiif_supported_formats and
+                not os.path.isfile (self.pyramids.filename (file_info["uuid"]))):
+                if self.jobs.submit ("iiif-pyramid", {
+                        "file_uuid": file_info["uuid"],
+                        "is_pdf":    extension == ".pdf"
+                    }) is not None:
+                    pyramid_jobs.add (file_info["uuid"])
+
+        self.log.info ("Queued %s thumbnail and %s IIIF pyramid jobs.",
+                       thumbnail_jobs, len(pyramid_jobs))
+        return self.respond_204 ()
+
     def ui_admin_clear_sessions (self, request):
         """Implements /admin/maintenance/clear-sessions."""
         token = self.token_from_cookie (request)
@@ -3515,13 +3729,11 @@ class WebServer:
         latest = []
         try:
             records = self.db.latest_datasets_portal(15)
+            authors = self.db.authors_for_items ([rec["dataset_uri"] for rec in records])
             for rec in records:
-                authors = self.db.authors (item_uri  = rec["dataset_uri"],
-                                           item_type = "dataset",
-                                           limit     = None)
                 pub_date = rec['published_date'][:10]
                 url = f'/datasets/{rec["container_uuid"]}'
-                latest.append((url, rec['title'], pub_date, authors))
+                latest.append((url, rec['title'], pub_date, authors[rec["dataset_uri"]]))
         except (IndexError, KeyError):
             pass
 
@@ -3661,26 +3873,29 @@ class WebServer:
                 except IndexError:
                     self.log.warning ("No email found for account %s.", account_uuid)
 
-        versions      = self.db.dataset_versions (container_uri=dataset["container_uri"])
+        files_params  = {}
+        if is_own_item:
+            files_params['account_uuid'] = account_uuid
+        elif private_view:
+            files_params['private_view'] = True
+        bundle        = self.db.item_metadata_bundle (dataset, "dataset",
+                                                      files_parameters=files_params)
+
+        versions      = bundle["versions"]
         if not versions:
             versions = [{"version": 1}]
         versions      = [v for v in versions if v["version"]]
         id_version    = f"{dataset_id}/{version}" if version else f"{dataset_id}"
 
-        authors       = self.db.authors(item_uri=dataset["uri"], limit=None)
-        files_params  = {'dataset_uri': dataset['uri'], 'order': 'order_name'}
-        if is_own_item:
-            files_params['account_uuid'] = account_uuid
-        elif private_view:
-            files_params['private_view'] = True
-        files         = self.db.dataset_files(**files_params)
+        authors       = bundle["authors"]
+        files         = bundle["files"]
         files_size    = sum(value_or(f,'size',0) for f in files)
-        tags          = self.db.tags(item_uri=dataset["uri"], limit=None)
-        categories    = self.db.categories(item_uri=dataset["uri"], limit=None)
-        references    = self.db.references(item_uri=dataset["uri"], limit=None)
-        derived_from  = self.db.derived_from(item_uri=dataset["uri"], limit=None)
-        fundings      = self.db.fundings(item_uri=dataset["uri"], limit=None)
-        collections   = self.db.collections_from_dataset(dataset["container_uuid"])
+        tags          = bundle["tags"]
+        categories    = bundle["categories"]
+        references    = bundle["references"]
+        derived_from  = bundle["derived_from"]
+        fundings      = bundle["fundings"]
+        collections   = bundle["collections"]
 
         show_iiif_link = False
         if config.enable_iiif:
@@ -3869,19 +4084,18 @@ class WebServer:
             return self.error_404 (request)
 
         container_uuid = collection["container_uuid"]
-        container_uri  = f"container:{container_uuid}"
+        bundle         = self.db.item_metadata_bundle (collection, "collection")
 
-        versions      = self.db.collection_versions(container_uri=container_uri)
+        versions      = bundle["versions"]
         if not versions:
             versions = [{"version":1}]
         versions      = [v for v in versions if v['version']]
 
-        collection_uri = collection['uri']
-        authors       = self.db.authors(item_uri=collection_uri, item_type='collection', limit=None)
-        tags          = self.db.tags(item_uri=collection_uri, limit=None)
-        categories    = self.db.categories(item_uri=collection_uri, limit=None)
-        references    = self.db.references(item_uri=collection_uri, limit=None)
-        fundings      = self.db.fundings(item_uri=collection_uri, item_type='collection', limit=None)
+        authors       = bundle["authors"]
+        tags          = bundle["tags"]
+        categories    = bundle["categories"]
+        references    = bundle["references"]
+        fundings      = bundle["fundings"]
         statistics    = {'downloads': value_or(collection, 'total_downloads', 0),
                          'views'    : value_or(collection, 'total_views'    , 0),
                          'shares'   : value_or(collection, 'total_shares'   , 0),
@@ -3910,7 +4124,7 @@ class WebServer:
         coordinates = {'lat': lat, 'lon': lon, 'lat_valid': lat_valid, 'lon_valid': lon_valid}
 
         contributors = self.parse_contributors(value_or(collection, 'contributors', ''))
-        datasets     = self.db.collection_datasets(collection_uri)
+        datasets     = bundle["datasets"]
 
         if not private_view:
             self.__log_event (request, container_uuid, "collection", "view")
@@ -4075,7 +4289,54 @@ class WebServer:
         return os.path.join (path, str(file_id), name)
 
     def __filesystem_location (self, file_info):
-        """Procedure to gather the filesystem location from file metadata."""
+        """
+        Procedure to gather the filesystem location from file metadata.
+        Locations are remembered per file, so that the storage locations
+        and S3 buckets only need to be searched once.
+        """
+
+        file_uuid = value_or_none (file_info, "uuid")
+        if file_uuid is None:
+            return self.__search_file_location (file_info)
+
+        prefix = f"locations_{file_uuid}"
+        location = self.db.cache.cached_value (prefix, "location")
+        if location is not None:
+            if "path" in location and os.path.isfile (location["path"]):
+                return location["path"]
+
+            bucket = value_or_none (config.s3_buckets, value_or_none (location, "bucket"))
+            if bucket is not None:
+                return s3.bucket_streamer (bucket, location["key"], file_info["name"])
+
+            # The file was moved, or its bucket is no longer configured.
+            self.db.cache.invalidate_by_prefix (prefix)
+
+        file_path = self.__search_file_location (file_info)
+        if isinstance (file_path, s3.S3DownloadStreamer):
+            self.db.cache.cache_value (prefix, "location", {
+                "bucket": file_path.bucket,
+                "key":    file_path.filename
+            })
+        elif file_path is not None:
+            self.db.cache.cache_value (prefix, "location", { "path": file_path })
+
+        return file_path
+
+    def __upload_bucket (self):
+        """Returns the S3 bucket that uploads are copied to, or None."""
+
+        if config.upload_s3_bucket is None:
+            return None
+
+        bucket = value_or_none (config.s3_buckets, config.upload_s3_bucket)
+        if bucket is None:
+            self.log.warning ("Not copying uploads to unconfigured S3 bucket '%s'.",
+                              config.upload_s3_bucket)
+        return bucket
+
+    def __search_file_location (self, file_info):
+        """Procedure to search the storage locations for a file."""
 
         # There are two ways to configure storage in Djehuty. The historical
         # way one can configure primary-storage-root and secondary-storage-root.
@@ -4111,12 +4372,7 @@ class WebServer:
                 if s3.s3_file_exists (bucket["endpoint"], bucket["name"],
                                       bucket["key-id"], bucket["secret-key"],
                                       filename):
-                    return s3.S3DownloadStreamer (bucket["endpoint"],
-                                                  bucket["name"],
-                                                  bucket["key-id"],
-                                                  bucket["secret-key"],
-                                                  filename,
-                                                  file_info["name"])
+                    return s3.bucket_streamer (bucket, filename, file_info["name"])
 
         # Use primary-storage-root and secondary-storage-root -- the historical
         # way of configuring storage.
@@ -4218,6 +4474,42 @@ class WebServer:
         else:
             self.__log_event (request, container_uuid, "dataset", "download")
 
+    def __offloaded_file_response (self, file_path, name):
+        """
+        Returns a response that lets the web server in front of djehuty
+        send FILE_PATH, or None when downloads are not offloaded.
+        """
+        if config.download_offload is None:
+            return None
+
+        header    = None
+        value     = None
+        real_path = os.path.realpath (file_path)
+        if config.download_offload == "x-sendfile":
+            header = "X-Sendfile"
+            value  = real_path
+        elif config.download_offload == "x-accel-redirect":
+            # The most specific location wins when locations are nested.
+            for path in sorted (config.download_offload_locations, key=len, reverse=True):
+                if real_path.startswith (path):
+                    header = "X-Accel-Redirect"
+                    value  = f"{config.download_offload_locations[path]}/{quote(real_path[len(path):])}"
+                    break
+
+        if header is None:
+            return None
+
+        # Raises FileNotFoundError like 'send_file' does for missing files.
+        file_size = os.path.getsize (file_path)
+
+        response = self.response ("", mimetype="application/octet-stream")
+        response.headers[header] = value
+        response.content_length = file_size
+        ascii_name = name.encode("ascii", "ignore").decode("ascii").replace('"', '')
+        response.headers["Content-Disposition"] = (f'attachment; filename="{ascii_name}"; '
+                                                   f"filename*=UTF-8''{quote(name)}")
+        return response
+
     def ui_download_file (self, request, dataset_id, file_id):
         """Implements /file/<id>/<fid>."""
         dataset, metadata = self.__accessible_files_for_dataset (request, dataset_id, file_id)
@@ -4247,13 +4539,22 @@ class WebServer:
 
             self.__log_download_event (request, dataset["container_uuid"])
             if isinstance (file_path, s3.S3DownloadStreamer):
-                file_path.connect ()
-                response = self.response (file_path.iterator(), mimetype="application/octet-stream")
+                ranges = file_path.part_ranges ()
+                if ranges is not None:
+                    iterator = file_path.parts_iterator (ranges)
+                else:
+                    file_path.connect ()
+                    iterator = file_path.iterator()
+                response = self.response (iterator, mimetype="application/octet-stream")
                 filename = quote(metadata["name"])
                 if file_path.content_length > 0:
                     response.headers["Content-Length"] = file_path.content_length
                 response.headers["Content-disposition"] = f"filename*=UTF-8''{filename}"
                 return response
+            response = self.__offloaded_file_response (file_path, metadata["name"])
+            if response is not None:
+                return response
+
             return send_file (file_path,
                               request.environ,
                               "application/octet-stream",
@@ -4288,7 +4589,10 @@ class WebServer:
                                     file_info["name"], dataset_id)
                     continue
                 key = "s3" if isinstance (file_path, s3.S3DownloadStreamer) else "fs"
-                file_paths.append ({ key: file_path, "n": file_info["name"] })
+                path = { key: file_path, "n": file_info["name"] }
+                if "computed_crc32" in file_info:
+                    path["crc32"] = int(file_info["computed_crc32"], 16)
+                file_paths.append (path)
 
             if not file_paths:
                 return self.error_404 (request, (f"Download-all for {dataset_id} failed: "
@@ -4296,13 +4600,40 @@ class WebServer:
 
             writer = None
             try:
-                zipfly_object = zipfly.ZipFly(paths = file_paths)
-                writer = zipfly_object.generator()
+                zipfly_object = zipfly.ZipFly(paths = file_paths,
+                                              read_ahead = config.s3_read_ahead,
+                                              read_ahead_memory = config.s3_read_ahead_memory)
+                archive_size  = zipfly_object.archive_size()
+                archive_tag   = zipfly_object.archive_tag()
             except TypeError:
                 self.log.error ("Error in zipping files: %s", file_paths)
                 return self.error_404 (request)
+            except s3.S3_ERRORS as error:
+                self.log.error ("Reading the metadata of files in %s from S3 failed: %s",
+                                dataset_id, error)
+                return self.error_500 ()
 
+            # The archive is laid out deterministically, so interrupted
+            # downloads can be resumed with a Range request.  Requests for
+            # multiple ranges receive the full archive.
+            start, stop = 0, archive_size
+            if (request.range is not None and
+                request.if_range.date is None and
+                request.if_range.etag in (None, archive_tag)):
+                byte_range = request.range.range_for_length (archive_size)
+                if byte_range is not None:
+                    start, stop = byte_range
+                elif len(request.range.ranges) == 1:
+                    return self.error_416 (archive_size)
+
+            writer = zipfly_object.generator (start, stop)
             response = self.response (writer, mimetype="application/zip")
+            response.headers["Accept-Ranges"] = "bytes"
+            response.set_etag (archive_tag)
+            response.content_length = stop - start
+            if stop - start < archive_size:
+                response.status_code = 206
+                response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{archive_size}"
 
             if version is None:
                 version = "draft"
@@ -4317,7 +4648,12 @@ class WebServer:
                 filename_utf8 = f"{quote(safe_title)}_{version}_all.zip"
                 response.headers["Content-disposition"] += f"; filename*=UTF-8''{filename_utf8}"
 
-            self.__log_download_event (request, dataset["container_uuid"])
+            # Only the response that starts at the first byte counts as a
+            # download, so resuming a download doesn't count it again.  A
+            # client that fetches segments in parallel is counted once too,
+            # while restarting from scratch counts as a new download.
+            if start == 0:
+                self.__log_download_event (request, dataset["container_uuid"])
             return response
 
         except (FileNotFoundError, KeyError, IndexError, TypeError) as error:
@@ -4610,19 +4946,11 @@ class WebServer:
         if metadata is None:
             return self.error_404 (request)
 
-        input_filename = self.__filesystem_location (metadata)
-        if input_filename is None:
+        if self.__filesystem_location (metadata) is None:
             return self.error_404 (request)
 
-        extension = self.__generate_thumbnail (input_filename, dataset["uuid"])
-        if extension is None:
-            return self.error_500 ()
-
-        if not self.db.dataset_update_thumb (dataset_id, account_uuid,
-                                             metadata["uuid"], extension, version):
-            return self.error_500()
-
-        return self.respond_205()
+        return self.__submit_thumbnail_job (dataset["uuid"], account_uuid,
+                                            metadata["uuid"], version)
 
     def api_dataset_files (self, request, dataset_id):
         """Implements /v2/articles/<id>/files."""
@@ -5556,9 +5884,15 @@ class WebServer:
                     return self.error_403 (request, (f"account:{account_uuid} attempted to remove "
                                                      f"all files from dataset:{dataset_id}."))
 
+                file_uuids = []
+                if config.enable_iiif:
+                    file_uuids = [file["uuid"] for file in self.db.dataset_files (
+                        dataset_uri = dataset["uri"], account_uuid = account_uuid)]
+
                 if self.db.delete_items_all_from_list (dataset["uri"], "files"):
                     self.db.cache.invalidate_by_prefix (f"{account_uuid}_storage")
                     self.db.cache.invalidate_by_prefix (f"{dataset['uuid']}_dataset_storage")
+                    self.__remove_iiif_copies (file_uuids)
                     return self.respond_204()
 
                 self.log.error ("Failed to delete all files from dataset %s.",
@@ -5685,6 +6019,8 @@ class WebServer:
                                                   uuid_to_uri (metadata["uuid"], "file")):
                     self.db.cache.invalidate_by_prefix (f"{account_uuid}_storage")
                     self.db.cache.invalidate_by_prefix (f"{dataset['uuid']}_dataset_storage")
+                    self.db.cache.invalidate_by_prefix (f"locations_{metadata['uuid']}")
+                    self.__remove_iiif_copies ([metadata["uuid"]])
                     return self.respond_204()
 
                 self.log.error ("Failed to delete file %s from dataset %s.",
@@ -6794,17 +7130,15 @@ class WebServer:
                                          limit        = limit,
                                          offset       = offset)
 
-            output = []
+            output  = []
+            authors = self.db.authors_for_items ([dataset["uri"] for dataset in datasets])
             for dataset in datasets:
                 has_files = bool(self.db.dataset_files (dataset_uri = dataset["uri"], limit=1))
                 output.append (formatter.format_codemeta_record (
                     dataset,
                     git_url = self.__git_repository_url_for_dataset (dataset),
                     tags = self.db.tags(item_uri=dataset["uri"], limit=None),
-                    authors = self.db.authors (item_uri=dataset["uri"],
-                                               is_published = True,
-                                               item_type = "dataset",
-                                               limit = 10000),
+                    authors = authors[dataset["uri"]],
                     has_files = has_files,
                     base_url = config.base_url))
             return self.response (json.dumps(output))
@@ -6831,7 +7165,8 @@ class WebServer:
                                      order_direction = order_direction,
                                      limit        = limit,
                                      offset       = offset)
-        output = []
+        output  = []
+        authors = self.db.authors_for_items ([dataset["uri"] for dataset in datasets])
         for dataset in datasets:
             output.append (formatter.format_rocrate_record (
                 config.base_url,
@@ -6839,10 +7174,7 @@ class WebServer:
                 dataset,
                 config.ror_url,
                 tags    = self.db.tags(item_uri=dataset["uri"], limit=None),
-                authors = self.db.authors (item_uri=dataset["uri"],
-                                           is_published = True,
-                                           item_type = "dataset",
-                                           limit = 10000),
+                authors = authors[dataset["uri"]],
                 files   = self.db.dataset_files (dataset_uri = dataset["uri"]),
                 git_url = self.__git_repository_url_for_dataset (dataset)))
 
@@ -7974,26 +8306,23 @@ class WebServer:
             output_filename = os.path.join (config.storage, f"{dataset_id}_{file_uuid}")
 
             computed_md5 = None
-            md5 = hashlib.new ("md5", usedforsecurity=False)
             file_size = 0
             destination_fd = os.open (output_filename, os.O_WRONLY | os.O_CREAT, 0o600)
             is_incomplete = None
+            writer = None
             try:
                 with open (destination_fd, "wb") as output_stream:
-                    file_size = 0
-                    while content_to_read > 4096:
-                        chunk = input_stream.read (4096)
-                        content_to_read -= 4096
-                        file_size += output_stream.write (chunk)
-                        md5.update (chunk)
-
-                    if content_to_read > 0:
-                        chunk = input_stream.read (content_to_read)
-                        file_size += output_stream.write (chunk)
-                        md5.update (chunk)
+                    writer = upload.UploadWriter (output_stream,
+                                                  chunk_size = config.upload_chunk_size,
+                                                  sha256     = config.upload_sha256,
+                                                  bucket     = self.__upload_bucket (),
+                                                  filename   = f"{dataset['container_uuid']}_{file_uuid}")
+                    try:
+                        file_size = writer.copy (input_stream, content_to_read)
                         content_to_read = 0
-                    else:
-                        md5.update (bytes(0))
+                    except OSError:
+                        writer.finish (complete = False)
+                        raise
 
                     # Make the file read-only from here on.
                     if os.name != 'nt':
@@ -8020,7 +8349,15 @@ class WebServer:
                     self.log.error ("Expected different end after file contents: '%s' != '%s'.",
                                     ending, expected_end)
 
-            computed_md5 = md5.hexdigest()
+            if writer is None:
+                os.remove (output_filename)
+                return self.error_500 (f"Could not receive the upload of {output_filename}.")
+
+            # The copy in S3 is discarded on an MD5 mismatch, rather than
+            # being completed before the checksum is compared.
+            checksums    = writer.finish (complete     = is_incomplete != 1,
+                                          expected_md5 = supplied_md5 if strict_check else None)
+            computed_md5 = checksums["md5"]
 
             if strict_check and computed_md5 != supplied_md5:
                 self.log.error ("MD5 checksum mismatch for %s: computed_md5(%s) != supplied_md5(%s)",
@@ -8053,14 +8390,35 @@ class WebServer:
             if file_size < 10000001:
                 is_image = self.__image_mimetype (output_filename) is not None
 
+            # Deep-zoom viewers request many tiles, which are read from a
+            # pyramid of the image rather than from the upload itself.
+            if config.enable_iiif and not is_incomplete and filename is not None:
+                extension = os.path.splitext (filename)[1]
+                if extension in iiif_supported_formats and config.iiif_pyramid_workers > 0:
+                    self.jobs.submit ("iiif-pyramid", {
+                        "file_uuid": file_uuid,
+                        "path":      output_filename,
+                        "is_pdf":    extension == ".pdf"
+                    })
+
             handle = None
             if not is_incomplete:
                 handle = f"{config.handle_prefix}/{file_uuid}"
                 if not self.__register_file_handle (handle, download_url):
                     handle = None
 
+            # The CRC-32 checksum allows ZIP archives to be written without
+            # reading the file first.
+            computed_crc32 = None
+            computed_sha256 = None
+            if not is_incomplete:
+                computed_crc32 = checksums["crc32"]
+                computed_sha256 = checksums["sha256"]
+
             self.db.update_file (account_uuid, file_uuid, dataset["uuid"],
                                  computed_md5  = computed_md5,
+                                 computed_crc32 = computed_crc32,
+                                 computed_sha256 = computed_sha256,
                                  download_url  = download_url,
                                  filesystem_location = output_filename,
                                  file_size     = file_size,
@@ -8151,19 +8509,37 @@ class WebServer:
                 message = "Cannot create thumbnails for images larger than 10MB.",
                 code = "ImageTooLarge")
 
-        input_filename = self.__filesystem_location (metadata)
-        if input_filename is None:
+        if self.__filesystem_location (metadata) is None:
             return self.error_404 (request)
 
-        extension = self.__generate_thumbnail (input_filename, dataset["uuid"])
-        if extension is None:
-            return self.error_500 ()
+        return self.__submit_thumbnail_job (dataset["uuid"], account_uuid, file_uuid)
 
-        if not self.db.dataset_update_thumb (dataset["uuid"], account_uuid,
-                                             file_uuid, extension):
-            return self.error_500()
+    def api_v3_job (self, request, job_id):
+        """Implements /v3/jobs/<id>."""
+        account_uuid = self.default_authenticated_error_handling (request, "GET", "application/json")
+        if isinstance (account_uuid, Response):
+            return account_uuid
+
+        if not validator.is_valid_uuid (job_id):
+            return self.error_404 (request)
+
+        job = self.jobs.status (job_id)
+        if job is None:
+            return self.error_404 (request)
+
+        if (job["account_uuid"] != account_uuid and
+            not self.db.may_administer (self.token_from_cookie (request))):
+            return self.error_404 (request)
 
-        return self.respond_205()
+        return self.response (json.dumps ({
+            "id":       job["id"],
+            "type":     job["type"],
+            "state":    job["state"],
+            "attempts": job["attempts"],
+            "error":    job["error"],
+            "created":  job["created"],
+            "updated":  job["updated"]
+        }))
 
     def api_v3_file (self, request, file_id):
         """Implements /v3/file/<id>."""
@@ -8390,9 +8766,8 @@ class WebServer:
         if isinstance (handler, Response):
             return handler
 
-        files = self.db.repository_file_statistics (extended_properties=True)
-        if not files:
-            return self.response (json.dumps({ "message": "No files to check." }))
+        files = self.db.repository_file_statistics (extended_properties=True,
+                                                    as_iterator=True)
 
         number_of_files = 0
         number_of_inaccessible_files = 0
@@ -8424,6 +8799,9 @@ class WebServer:
                 number_of_inaccessible_files += 1
                 missing_files.append (filesystem_location)
 
+        if number_of_files == 0 and number_of_links == 0:
+            return self.response (json.dumps({ "message": "No files to check." }))
+
         output = {
             "number_of_links":              number_of_links,
             "number_of_files":              number_of_files,
@@ -9017,6 +9395,19 @@ class WebServer:
         self.db.cache.invalidate_by_prefix (key)
         return self.respond_204 ()
 
+    def api_v3_admin_iiif_cache_statistics (self, request):
+        """Implements /v3/admin/iiif-cache-statistics."""
+
+        handler = self.default_authenticated_error_handling (request, "GET", "application/json",
+                                                             self.db.may_administer)
+        if isinstance (handler, Response):
+            return handler
+
+        if not config.enable_iiif:
+            return self.error_404 (request)
+
+        return self.response (json.dumps (self.derivatives.statistics ()))
+
     def api_v3_admin_accounts_clear_cache (self, request):
         """Implements /v3/admin/accounts/clear-cache."""
         return self.__api_v3_admin_clear_cache (request, "accounts")
@@ -9120,15 +9511,18 @@ class WebServer:
             file_uuid = row["file_uuid"]
             computed_md5 = None
             md5 = hashlib.new ("md5", usedforsecurity=False)
+            crc32 = 0
             filename = os.path.join (config.storage, f"{container_uuid}_{file_uuid}")
             with open(filename, "rb") as stream:
                 for chunk in iter(lambda: stream.read(4096), b""): # pylint: disable=cell-var-from-loop
                     md5.update(chunk)
+                    crc32 = zlib.crc32 (chunk, crc32)
                 computed_md5 = md5.hexdigest()
 
                 self.log.info ("Generated %s for %s", computed_md5, file_uuid)
                 self.db.update_file (account_uuid, file_uuid, dataset["uuid"],
                                      computed_md5 = computed_md5,
+                                     computed_crc32 = f"{crc32:08x}",
                                      filesystem_location = filename)
 
         return self.respond_201 ({ "message": "The MD5 sums have been regenerated."})
@@ -9270,22 +9664,27 @@ class WebServer:
                                        value_or_none (container, "doi"))
             self.log.info ("Using predicted DOI (%s) for %s.", doi, item_uri)
 
+        parts = ["authors", "categories", "tags", "references"]
+        if is_dataset:
+            parts.append ("fundings")
+        bundle = self.db.item_metadata_bundle (item, item_type, parts=parts)
+
         parameters = {
             'item'          : item,
             'container_doi' : value_or_none (container, "doi"),
             'doi'           : doi,
-            'authors'       : self.db.authors(item_uri=item_uri, item_type=item_type),
-            'categories'    : self.db.categories(item_uri=item_uri, limit=None),
-            'tags'          : [tag['tag'] for tag in self.db.tags(item_uri=item_uri)],
+            'authors'       : bundle["authors"],
+            'categories'    : bundle["categories"],
+            'tags'          : [tag['tag'] for tag in bundle["tags"]],
             'published_year': published_date[:4] if published_date is not None else None,
             'published_date': published_date,
             'organizations' : self.parse_organizations(value_or(item, 'organizations', '')),
             'contributors'  : self.parse_contributors (value_or(item, 'contributors' , '')),
-            'references'    : self.db.references(item_uri=item_uri, limit=None),
+            'references'    : bundle["references"],
             'coordinates'   : coordinates
             }
         if is_dataset:
-            parameters['fundings'] = self.db.fundings(item_uri=item_uri)
+            parameters['fundings'] = bundle["fundings"]
         return parameters
 
     def ui_export_citation (self, request, citation_format, item_type, item_id, version=None):
@@ -9515,30 +9914,46 @@ class WebServer:
 
         return redirect (f"{config.base_url}/iiif/v3/{file_uuid}/info.json", code=303)
 
+    def __iiif_original (self, metadata):
+        """
+        Returns the full resolution image of METADATA, preferably from its
+        pyramid, and the local file it was opened from, or None when it was
+        opened from the pyramid.  When the image has no pyramid yet, one is
+        created in the background.
+        """
+        image = self.pyramids.full_image (metadata["uuid"])
+        if image is not None:
+            return image, None
+
+        is_pdf = os.path.splitext (value_or (metadata, "name", ""))[1] == ".pdf"
+        source = self.__filesystem_location (metadata)
+        input_filename = source
+        if isinstance (source, s3.S3DownloadStreamer):
+            input_filename = s3.s3_cached_file (source)
+
+        if is_pdf:
+            image = pyvips.Image.new_from_file (input_filename, dpi=300)
+        else:
+            image = pyvips.Image.new_from_file (input_filename)
+        if max(image.width, image.height) > iiif.TILE_SIZE:
+            self.pyramids.schedule (source, metadata["uuid"], is_pdf)
+
+        return image, input_filename
+
     def __iiif_image_context (self, metadata):
         """Returns a IIIF ImageService3 dict on success or None on failure."""
         image = None
         try:
-            input_filename = self.__filesystem_location (metadata)
-            if isinstance (input_filename, s3.S3DownloadStreamer):
-                s3_cached_file = s3.s3_temporary_file (input_filename)
-                if os.path.splitext (value_or (metadata, "name", ""))[1] == ".pdf":
-                    s3_cached_file = f"{s3_cached_file}[dpi=300]"
-                image = pyvips.Image.new_from_file (s3_cached_file)
-            else:
-                if os.path.splitext (value_or (metadata, "name", ""))[1] == ".pdf":
-                    input_filename = f"{input_filename}[dpi=300]"
-                image = pyvips.Image.new_from_file (input_filename)
+            image, _ = self.__iiif_original (metadata)
         except (KeyError, FileNotFoundError, UnidentifiedImageError):
             self.log.error ("Unable to open image file %s.", metadata['uuid'])
             return None
         except pyvips.error.Error:
             return None
 
-        tile_size = 1024
-        largest_size = max(image.width, image.height)
-        layers = max(0, ceil(log2(largest_size / tile_size)))
-        scale_factors = [pow(2, layer) for layer in range(layers + 1)]
+        # The sizes are those of the pyramid levels, so that viewers can
+        # request them without resizing a larger level.
+        scale_factors, sizes = iiif.level_sizes (image.width, image.height)
 
         output = {
             "@context":  "http://iiif.io/api/image/3/context.json",
@@ -9556,11 +9971,11 @@ class WebServer:
                               "regionSquare", "rotationArbitrary",
                               "rotationBy90s"],
             "tiles": [{
-                "width": tile_size,
-                "height": tile_size,
+                "width": iiif.TILE_SIZE,
+                "height": iiif.TILE_SIZE,
                 "scaleFactors": scale_factors,
             }],
-            "sizes": [{ "width": image.width, "height": image.height }]
+            "sizes": sizes[::-1]
         }
         del image
         return output
@@ -9604,6 +10019,23 @@ class WebServer:
 
         return self.error_500 ()
 
+    def __remove_iiif_copies (self, file_uuids):
+        """Removes the pyramids and cached IIIF outputs of FILE_UUIDS."""
+        if not config.enable_iiif:
+            return None
+
+        for file_uuid in file_uuids:
+            self.pyramids.remove (file_uuid)
+            self.derivatives.invalidate (file_uuid)
+        return None
+
+    def __iiif_image_response (self, request, file_path, image_format):
+        """Returns a response that sends the IIIF output in FILE_PATH."""
+        response = send_file (file_path, request.environ, IIIF_MIMETYPES[image_format],
+                              as_attachment=False, download_name=None)
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        return response
+
     def iiif_v3_image (self, request, file_uuid, region, size, rotation, quality, image_format):
         """Implements /iiif/v3/<uuid>/<region>/<size>/<rotation>/<quality>.<format>."""
 
@@ -9613,6 +10045,15 @@ class WebServer:
         if not validator.is_valid_uuid (file_uuid):
             return self.error_400 (request, "Invalid file UUID.", "InvalidFileUUID")
 
+        # Serve from cache
+        # ---------------------------------------------------------------------
+        # Outputs are looked up before the metadata and the image itself, so
+        # that serving a cached tile costs a single 'stat'.
+        file_path = self.derivatives.filename (file_uuid, region, size, rotation,
+                                               quality, image_format)
+        if file_path is not None and self.derivatives.lookup (file_path) is not None:
+            return self.__iiif_image_response (request, file_path, image_format)
+
         validation_errors = []
         parameters = {
             "region": region,
@@ -9634,17 +10075,7 @@ class WebServer:
             return self.error_404 (request)
 
         metadata = metadata[0]
-        input_filename = self.__filesystem_location (metadata)
-        s3_cached_file = None
-        if isinstance (input_filename, s3.S3DownloadStreamer):
-            s3_cached_file = s3.s3_temporary_file (input_filename)
-            if os.path.splitext (value_or (metadata, "name", ""))[1] == ".pdf":
-                s3_cached_file = f"{s3_cached_file}[dpi=300]"
-            original  = pyvips.Image.new_from_file (s3_cached_file)
-        else:
-            if os.path.splitext (value_or (metadata, "name", ""))[1] == ".pdf":
-                input_filename = f"{input_filename}[dpi=300]"
-            original  = pyvips.Image.new_from_file (input_filename)
+        original, input_filename = self.__iiif_original (metadata)
 
         # Region
         output_region = { "x": 0, "y": 0, "w": original.width, "h": original.height }
@@ -9668,14 +10099,14 @@ class WebServer:
             })
         elif region not in ("full", "square"):
             deconstructed = region.split (",")
-            if len(deconstructed) != 4:
+            if len(deconstructed) != 4 or not all(map(parses_to_int, deconstructed)):
                 validation_errors.append ({
                     "field_name": "region",
                     "message": "The region format should be 'x,y,w,h'."
                 })
             else:
-                output_region = { "x": deconstructed[0], "y": deconstructed[1],
-                                  "w": deconstructed[2], "h": deconstructed[3] }
+                output_region = { "x": int(deconstructed[0]), "y": int(deconstructed[1]),
+                                  "w": int(deconstructed[2]), "h": int(deconstructed[3]) }
 
         # Size
         output_size = { "w": original.width, "h": original.height }
@@ -9740,60 +10171,32 @@ class WebServer:
 
         # Error reporting
         if validation_errors:
-            if s3_cached_file is not None:
-                os.remove (s3_cached_file)
             return self.error_400_list (request, validation_errors)
 
-        # Serve from cache
-        # ---------------------------------------------------------------------
-        cache_key = self.db.cache.make_key ((f"{file_uuid}_{region}_{size}_"
-                                             f"{mirror}_{rotation}_"
-                                             f"{quality}_{image_format}"))
-        file_path = os.path.join (config.iiif_cache_storage, cache_key)
-        try:
-            response = send_file (file_path, request.environ, f"image/{image_format}",
-                                  as_attachment=False, download_name=None)
-            response.headers["Access-Control-Allow-Origin"] = "*"
-            if s3_cached_file is not None:
-                os.remove (s3_cached_file)
-            return response
-        except OSError:
-            pass
-
         # Transform the input image to the output image
         # ---------------------------------------------------------------------
         output = None
         try:
-            output = pyvips.Image.new_temp_file(format=f".{image_format}")
-            original.write(output)
-
-            if s3_cached_file is not None:
-                os.remove (s3_cached_file)
-
-            output = output.crop (output_region["x"], output_region["y"],
-                                  output_region["w"], output_region["h"])
-            output = output.thumbnail_image (output_size["w"],
-                                             height = output_size["h"],
-                                             size = "force")
-            if mirror:
-                output = output.fliphor()
-            if rotation not in (0, 360):
-                output = output.similarity (angle=rotation)
-            if quality == "gray":
-                output = output.colourspace (pyvips.enums.Interpretation.B_W)
-
-            # The commonly used mimetype for TIFF is image/tiff.
-            if image_format == "tif":
-                image_format = "tiff"
-
-            target = pyvips.Target.new_to_file (file_path)
-            output.write_to_target (target, f".{image_format}")
-            response = send_file (file_path, request.environ, f"image/{image_format}",
-                              as_attachment=False, download_name=None)
-            response.headers["Access-Control-Allow-Origin"] = "*"
-            return response
-        except FileNotFoundError:
-            self.log.error ("File download failed due to missing file: '%s'.", file_path)
+            # The pixels are only decoded while the output is encoded, and
+            # only for the requested region at the smallest resolution that
+            # suffices.
+            if input_filename is None:
+                output = self.pyramids.region (file_uuid, original,
+                                               output_region, output_size)
+            else:
+                output = iiif.load_region (input_filename, original,
+                                           output_region, output_size)
+            output = iiif.transform (output, output_size, mirror, rotation, quality)
+
+            if file_path is None:
+                return self.response (output.write_to_buffer (f".{image_format}"),
+                                      mimetype=IIIF_MIMETYPES[image_format],
+                                      allow_origin="*")
+
+            self.derivatives.store (file_path, output, image_format)
+            return self.__iiif_image_response (request, file_path, image_format)
+        except OSError as error:
+            self.log.error ("Writing the IIIF output '%s' failed: %s", file_path, error)
         except pyvips.error.Error as error:
             if "is not a known file format" in str(error):
                 return self.error_400 (request,
@@ -30,9 +30,14 @@ conditions of 'zipfly'.
 # -----------------------------------------------------------------------------
 
 import io
-import zipfile
+import zlib
+import queue
+import struct
+import hashlib
 import logging
-from zipfile import ZipFile, ZipInfo, ZIP_STORED
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipInfo
 
 try:
     from botocore.exceptions import ResponseStreamingError, ReadTimeoutError
@@ -44,15 +49,176 @@ except (ImportError, ModuleNotFoundError):
 class LargePredictionSize (Exception):
     """Raised when Buffer is larger than ZIP64."""
 
+ZIP64_LIMIT = (1 << 32) - 1
+ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
+
+class ZipMember:
+    """
+    The position of a file in an archive without compression.  Because the
+    data is stored as-is, all offsets follow from the file names and sizes.
+
+    When the CRC-32 checksum is known beforehand, the local header is
+    complete and the data is passed through as-is.  Otherwise the checksum
+    is calculated while reading, and written to a data descriptor that
+    follows the data.
+    """
+
+    def __init__ (self, path, source, z_info, offset, crc=None):
+        self.path = path
+        self.source = source
+        self.info = z_info
+        self.size = z_info.file_size
+        self.crc = crc
+        self.has_descriptor = crc is None
+        self.zip64 = self.size >= ZIP64_LIMIT
+        self.flags = 0x08 if self.has_descriptor else 0
+        try:
+            self.name = z_info.filename.encode("ascii")
+        except UnicodeEncodeError:
+            self.name = z_info.filename.encode("utf-8")
+            self.flags |= 0x800
+
+        year, month, day, hour, minute, second = z_info.date_time
+        self.dos_date = (year - 1980) << 9 | month << 5 | day
+        self.dos_time = hour << 11 | minute << 5 | (second // 2)
+        self.version = 45 if self.zip64 else 20
+
+        self.header_offset = offset
+        self.header = self.__local_header ()
+        self.data_offset = offset + len(self.header)
+        self.descriptor_offset = self.data_offset + self.size
+        self.end = self.descriptor_offset
+        if self.has_descriptor:
+            self.end += 24 if self.zip64 else 16
+
+    def __local_header (self):
+        """Returns the local file header, which precedes the data."""
+        extra = b""
+        size = 0 if self.has_descriptor else self.size
+        if self.zip64:
+            extra = struct.pack ("<HHQQ", 1, 16, size, size)
+            size = ZIP64_LIMIT
+        return struct.pack ("<IHHHHHIIIHH", 0x04034b50, self.version,
+                            self.flags, 0, self.dos_time, self.dos_date,
+                            self.crc or 0, size, size, len(self.name),
+                            len(extra)) + self.name + extra
+
+    def descriptor (self):
+        """Returns the data descriptor, which follows the data."""
+        if not self.has_descriptor:
+            return b""
+        if self.zip64:
+            return struct.pack ("<IIQQ", 0x08074b50, self.crc, self.size, self.size)
+        return struct.pack ("<IIII", 0x08074b50, self.crc, self.size, self.size)
+
+    def __central_directory_extra (self):
+        """Returns the ZIP64 fields of the central directory record."""
+        fields = []
+        if self.zip64:
+            fields += [self.size, self.size]
+        if self.header_offset >= ZIP64_LIMIT:
+            fields.append (self.header_offset)
+        if not fields:
+            return b""
+        return struct.pack (f"<HH{len(fields)}Q", 1, len(fields) * 8, *fields)
+
+    def central_directory_size (self):
+        """Returns the length of the central directory record."""
+        return 46 + len(self.name) + len(self.__central_directory_extra ())
+
+    def central_directory_record (self):
+        """Returns the record of this file in the central directory."""
+        extra = self.__central_directory_extra ()
+        size = ZIP64_LIMIT if self.zip64 else self.size
+        offset = min(self.header_offset, ZIP64_LIMIT)
+        version = 45 if extra else 20
+        return struct.pack ("<IBBHHHHHIIIHHHHHII", 0x02014b50, version, 3,
+                            version, self.flags, 0, self.dos_time,
+                            self.dos_date, self.crc, size, size,
+                            len(self.name), len(extra), 0, 0, 0,
+                            self.info.external_attr, offset) + self.name + extra
+
+class ReadAhead:
+    """
+    Reads the data of upcoming archive members in worker threads, so that
+    waiting for the first bytes of one S3 object overlaps with writing the
+    members before it.  At most WORKERS members are read ahead, and each of
+    them buffers at most MEMORY_LIMIT / WORKERS bytes.
+    """
+
+    def __init__ (self, reader, jobs, workers, memory_limit):
+        self.reader       = reader
+        self.jobs         = jobs
+        self.workers      = workers
+        self.part_limit   = max(memory_limit // workers, 1)
+        self.queues       = {}
+        self.next_job     = 0
+        self.cancelled    = Event()
+        self.executor     = ThreadPoolExecutor (max_workers = workers,
+                                                thread_name_prefix = "zipfly")
+
+    def __put (self, job_queue, item):
+        """Returns True when ITEM was queued before reading was cancelled."""
+        while not self.cancelled.is_set():
+            try:
+                job_queue.put (item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __fill (self, job_queue, member, start, stop):
+        """Procedure that reads the data of a member into JOB_QUEUE."""
+        try:
+            for chunk in self.reader (member, start, stop):
+                if not self.__put (job_queue, chunk):
+                    return
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            self.__put (job_queue, error)
+        self.__put (job_queue, None)
+
+    def __submit (self):
+        """Procedure to start reading the next job."""
+        member, start, stop = self.jobs[self.next_job]
+        chunk_size = max(getattr (member.path[member.source], "chunk_size", 0), 1)
+        job_queue = queue.Queue (maxsize = max(self.part_limit // chunk_size, 1))
+        self.queues[self.next_job] = job_queue
+        self.executor.submit (self.__fill, job_queue, member, start, stop)
+        self.next_job += 1
+
+    def chunks (self, index):
+        """Returns an iterator over the data of job INDEX."""
+        while self.next_job < min(index + self.workers, len(self.jobs)):
+            self.__submit ()
+
+        job_queue = self.queues.pop (index)
+        while True:
+            item = job_queue.get ()
+            if item is None:
+                return
+            if isinstance (item, Exception):
+                raise item
+            yield item
+
+    def close (self):
+        """Procedure to stop reading ahead."""
+        self.cancelled.set()
+        self.executor.shutdown (wait=False, cancel_futures=True)
+
 class ZipflyStream (io.RawIOBase):
     """
     The RawIOBase ABC extends IOBase. It deals with
     the reading and writing of bytes to a stream. FileIO subclasses
     RawIOBase to provide an interface to files in the machine’s file system.
+
+    Written chunks are kept as references rather than being copied into a
+    single buffer, and are only joined when they are read with 'get'.
     """
-    def __init__ (self):
-        self._buffer = b""
+    def __init__ (self, flush_threshold=0):
+        self._chunks = []
+        self._pending = 0
         self._size = 0
+        self.flush_threshold = flush_threshold
 
     def writable (self):
         """Returns True to signify the stream is writable."""
@@ -62,14 +228,31 @@ class ZipflyStream (io.RawIOBase):
         """Procedure to write a chunk to the opened stream."""
         if self.closed:  # pylint: disable=using-constant-test
             raise RuntimeError("ZipFly stream was closed!")
-        self._buffer += b
-        return len(b)
+
+        # Only immutable chunks can be kept without copying them, because
+        # the caller may reuse its buffer after writing it.
+        if not isinstance (b, bytes):
+            b = bytes(b)
+
+        length = len(b)
+        if length > 0:
+            self._chunks.append (b)
+            self._pending += length
+        return length
+
+    def ready (self):
+        """Returns True when enough data is stored to be read."""
+        return self._pending > 0 and self._pending >= self.flush_threshold
 
     def get (self):
         """Procedure to read a chunk from the opened stream."""
-        chunk = self._buffer
-        self._buffer = b""
-        self._size += len(chunk)
+        if len(self._chunks) == 1:
+            chunk = self._chunks[0]
+        else:
+            chunk = b"".join (self._chunks)
+        self._chunks = []
+        self._size += self._pending
+        self._pending = 0
         return chunk
 
     def size (self):
@@ -79,15 +262,21 @@ class ZipflyStream (io.RawIOBase):
 
 class ZipFly:
     """The core ZipFly class."""
-    def __init__(self, paths=None, reproducible_timestamps=False):
+    def __init__(self, paths=None, reproducible_timestamps=False,
+                 chunksize=262144, flush_threshold=65536, read_ahead=0,
+                 read_ahead_memory=67108864):
         """This class implements the main ZipFly functionality."""
         self.log = logging.getLogger(__name__)
         self.paths = paths if paths is not None else []
         self.filesystem = "fs"
         self.s3_stream = "s3"
         self.arcname = "n"
-        self.chunksize = 32768
+        self.chunksize = chunksize
+        self.flush_threshold = flush_threshold
+        self.read_ahead = read_ahead
+        self.read_ahead_memory = read_ahead_memory
         self._buffer_size = None
+        self._layout = None
         self.reproducible_timestamps = reproducible_timestamps
 
     def buffer_prediction_size (self):
@@ -112,58 +301,280 @@ class ZipFly:
 
         return zs
 
-    def generator (self):
-        """Returns a generator to stream-on-the-fly."""
-        stream = ZipflyStream()
-        with ZipFile(stream, mode="w", compression=ZIP_STORED, allowZip64=True) as zip_stream:
-            for path in self.paths:
-                if self.s3_stream in path:
-                    if not S3_ENABLED:
-                        self.log.warning ("Unable to process S3 object because 'boto3' is not installed.")
-                        continue
-                    s3_object = path[self.s3_stream]
-                    s3_object.connect()
-                    z_info = ZipInfo.from_file (__file__, s3_object.original_filename)
-                    z_info.file_size = s3_object.content_length
-                    if not self.reproducible_timestamps:
-                        z_info.date_time = s3_object.last_modified
-                    else:
-                        z_info.date_time = (1980, 1, 1, 0, 0, 0)
-                    z_info.external_attr = 33188 << 16  # Unix attributes
-                    with zip_stream.open (z_info, mode="w") as zip_writer:
-                        retries = 3
-                        while retries > 0:
-                            try:
-                                for chunk in s3_object.iterator():
-                                    zip_writer.write (chunk)
-                                    yield stream.get()
-                                retries = 0
-                            except (ResponseStreamingError, ReadTimeoutError, IncompleteRead):
-                                current_offset = s3_object.body().tell()
-                                s3_object.reset (offset = current_offset)
-                                retries -= 1
-                                if retries > 0:
-                                    self.log.warning ("Retrying to fetch after %s bytes of %s.",
-                                                      current_offset, s3_object.original_filename)
-                                    continue
-                                self.log.error ("Failed to fetch S3 object %s (%s) for ZIP.",
-                                                s3_object.original_filename,
-                                                s3_object.content_length)
-                        s3_object.close()
-                elif self.filesystem in path:
-                    if not self.arcname in path:
-                        path[self.arcname] = path[self.filesystem]
-                    z_info = zipfile.ZipInfo.from_file(path[self.filesystem], path[self.arcname])
-                    if self.reproducible_timestamps:
-                        z_info.date_time = (1980, 1, 1, 0, 0, 0)
-                    with open (path[self.filesystem], "rb") as e:
-                        with zip_stream.open (z_info, mode="w") as d:
-                            for chunk in iter(lambda: e.read(self.chunksize), b""):  # pylint: disable=cell-var-from-loop
-                                d.write(chunk)
-                                yield stream.get()
-
-                else:
-                    raise RuntimeError(f"'{self.filesystem}' or '{self.s3_stream}' key is required")
+    def __head_s3_objects (self):
+        """
+        Returns a dictionary of the indices of S3 objects in the paths to
+        whether their metadata could be read.  When reading ahead, the
+        requests are sent concurrently, because each waits for a round-trip.
+        """
+        if not S3_ENABLED:
+            return {}
+
+        indices = [index for index, path in enumerate (self.paths)
+                   if self.s3_stream in path]
+        def head (index):
+            return self.paths[index][self.s3_stream].head()
+
+        if self.read_ahead < 2 or len(indices) < 2:
+            return { index: head (index) for index in indices }
+
+        with ThreadPoolExecutor (max_workers = min(self.read_ahead, len(indices)),
+                                 thread_name_prefix = "zipfly") as executor:
+            return dict(zip (indices, executor.map (head, indices)))
+
+    def __zip_info (self, path, is_headed=False):
+        """Returns the source type and ZipInfo for PATH, or None to skip it."""
+
+        if self.s3_stream in path:
+            if not S3_ENABLED:
+                self.log.warning ("Unable to process S3 object because 'boto3' is not installed.")
+                return None, None
+            s3_object = path[self.s3_stream]
+            if not is_headed:
+                self.log.error ("Excluding S3 object %s from the ZIP.",
+                                s3_object.original_filename)
+                return None, None
+            z_info = ZipInfo.from_file (__file__, path.get(self.arcname,
+                                                           s3_object.original_filename))
+            z_info.file_size = s3_object.content_length
+            if not self.reproducible_timestamps and s3_object.last_modified:
+                z_info.date_time = s3_object.last_modified
+            else:
+                z_info.date_time = (1980, 1, 1, 0, 0, 0)
+            z_info.external_attr = 33188 << 16  # Unix attributes
+            return self.s3_stream, z_info
+
+        if self.filesystem in path:
+            if not self.arcname in path:
+                path[self.arcname] = path[self.filesystem]
+            z_info = ZipInfo.from_file (path[self.filesystem], path[self.arcname],
+                                        strict_timestamps=False)
+            if self.reproducible_timestamps:
+                z_info.date_time = (1980, 1, 1, 0, 0, 0)
+            return self.filesystem, z_info
+
+        raise RuntimeError(f"'{self.filesystem}' or '{self.s3_stream}' key is required")
+
+    def layout (self):
+        """
+        Returns the members of the archive, the offset of the central
+        directory and the size of the archive.
+        """
+        if self._layout is not None:
+            return self._layout
+
+        members = []
+        offset = 0
+        headed = self.__head_s3_objects ()
+        for index, path in enumerate (self.paths):
+            source, z_info = self.__zip_info (path, headed.get (index, False))
+            if z_info is None:
+                continue
+            member = ZipMember (path, source, z_info, offset, path.get("crc32"))
+            members.append (member)
+            offset = member.end
+
+        directory_offset = offset
+        directory_size = sum(member.central_directory_size() for member in members)
+        size = directory_offset + directory_size + 22
+        if (len(members) >= ZIP_FILECOUNT_LIMIT or
+            directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT):
+            size += 56 + 20
+
+        self._layout = (members, directory_offset, size)
+        return self._layout
+
+    def archive_size (self):
+        """Returns the size of the archive in bytes."""
+        return self.layout()[2]
+
+    def archive_tag (self):
+        """Returns a string that changes whenever the archive would change."""
+        members, _, size = self.layout()
+        digest = hashlib.sha256 (str(size).encode("utf-8"))
+        for member in members:
+            digest.update (member.name)
+            # Only use stored checksums, so that the tag is the same before
+            # and after the archive was generated.
+            digest.update (struct.pack ("<QHHI", member.size, member.dos_date,
+                                        member.dos_time, member.path.get("crc32") or 0))
+        return digest.hexdigest()[:32]
+
+    def __end_records (self, members, directory_offset):
+        """Returns the records that end the archive."""
+        directory_size = sum(member.central_directory_size() for member in members)
+        count = len(members)
+        output = b""
+        if (count >= ZIP_FILECOUNT_LIMIT or
+            directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT):
+            end_offset = directory_offset + directory_size
+            output += struct.pack ("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0,
+                                   count, count, directory_size, directory_offset)
+            output += struct.pack ("<IIQI", 0x07064b50, 0, end_offset, 1)
+            count = min(count, ZIP_FILECOUNT_LIMIT)
+            directory_size = min(directory_size, ZIP64_LIMIT)
+            directory_offset = min(directory_offset, ZIP64_LIMIT)
+
+        return output + struct.pack ("<IHHHHIIH", 0x06054b50, 0, 0, count, count,
+                                     directory_size, directory_offset, 0)
+
+    def __read_s3 (self, s3_object, start, stop):
+        """Generator that yields the bytes START to STOP of an S3 object."""
+        position = start
+        retries = 3
+        while retries > 0 and position < stop:
+            s3_object.offset = position
+            s3_object.connect()
+            if s3_object.file_contents is None:
+                s3_object.close()
+                break
+            try:
+                for chunk in s3_object.iterator():
+                    chunk = chunk[:stop - position]
+                    position += len(chunk)
+                    yield chunk
+                    if position >= stop:
+                        break
+                retries = 0
+            except (ResponseStreamingError, ReadTimeoutError, IncompleteRead):
+                retries -= 1
+                if retries > 0:
+                    self.log.warning ("Retrying to fetch after %s bytes of %s.",
+                                      position, s3_object.original_filename)
+                    continue
+                self.log.error ("Failed to fetch S3 object %s (%s) for ZIP.",
+                                s3_object.original_filename,
+                                s3_object.content_length)
+            finally:
+                s3_object.close()
+
+    def __read (self, member, start, stop):
+        """Generator that yields the bytes START to STOP of MEMBER's data."""
+        if member.source == self.s3_stream:
+            yield from self.__read_s3 (member.path[self.s3_stream], start, stop)
+            return
+
+        with open (member.path[self.filesystem], "rb") as stream:
+            stream.seek (start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = stream.read (min(self.chunksize, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def __plan (self, members, directory_offset, start, stop):
+        """
+        Returns the members that contribute to the bytes START to STOP,
+        together with the part of their data that must be read.  When the
+        checksum of a member is unknown but needed, all of its data is read
+        to calculate it.
+        """
+        plan = []
+        for member in members:
+            if member.header_offset >= stop:
+                break
+            # Members before START only matter for their checksum.
+            if member.end <= start and (member.crc is not None or stop <= directory_offset):
+                continue
+
+            data_start = max(start, member.data_offset) - member.data_offset
+            data_stop = max(min(stop, member.descriptor_offset) - member.data_offset, 0)
+            if member.crc is None and member.descriptor_offset < stop:
+                read = (0, member.size)
+            elif data_start < data_stop:
+                read = (data_start, data_stop)
+            else:
+                read = None
+            plan.append ((member, data_start, data_stop, read))
+
+        return plan
+
+    def __member_data (self, member, data_start, data_stop, read, chunks):
+        """
+        Generator that yields MEMBER's data from DATA_START to DATA_STOP,
+        out of the CHUNKS that were READ.  When CHUNKS holds all data of a
+        member without a known checksum, the checksum is calculated along
+        the way.
+        """
+        if member.crc is not None or read != (0, member.size):
+            yield from chunks
+            return
+
+        position = 0
+        crc = 0
+        for chunk in chunks:
+            crc = zlib.crc32 (chunk, crc)
+            chunk_end = position + len(chunk)
+            if chunk_end > data_start and position < data_stop:
+                yield chunk[max(data_start - position, 0):data_stop - position]
+            position = chunk_end
+
+        if position == member.size:
+            member.crc = crc
+
+    def generator (self, start=0, stop=None):
+        """
+        Returns a generator to stream-on-the-fly.  Pass START and STOP to
+        only produce that byte range of the archive.
+        """
+        members, directory_offset, size = self.layout()
+        stop = size if stop is None else min(stop, size)
+        plan = self.__plan (members, directory_offset, start, stop)
+        stream = ZipflyStream(self.flush_threshold)
+
+        # Objects in S3 are read ahead, because waiting for the first bytes
+        # takes longer than reading them.
+        read_ahead = None
+        jobs = [(member, *read) for member, _, _, read in plan
+                if read is not None and member.source == self.s3_stream]
+        if self.read_ahead > 0 and len(jobs) > 1:
+            read_ahead = ReadAhead (self.__read, jobs, self.read_ahead,
+                                    self.read_ahead_memory)
+
+        def clip (data, offset):
+            return data[max(start - offset, 0):max(stop - offset, 0)]
+
+        job_index = 0
+        try:
+            for member, data_start, data_stop, read in plan:
+                stream.write (clip (member.header, member.header_offset))
+                chunks = iter(())
+                if read is not None and read_ahead is not None and member.source == self.s3_stream:
+                    chunks = read_ahead.chunks (job_index)
+                    job_index += 1
+                elif read is not None:
+                    chunks = self.__read (member, *read)
+
+                written = 0
+                for chunk in self.__member_data (member, data_start, data_stop,
+                                                 read, chunks):
+                    written += stream.write (chunk)
+                    if stream.ready():
+                        yield stream.get()
+
+                # The offsets of everything that follows depend on the size of
+                # this member, so a partial read cannot be recovered from.
+                expected = max(data_stop - data_start, 0)
+                if written != expected or (member.crc is None and member.descriptor_offset < stop):
+                    self.log.error ("Incomplete read of '%s' for ZIP; stopping.",
+                                    member.info.filename)
+                    self._buffer_size = stream.size()
+                    stream.close()
+                    return
+
+                if member.descriptor_offset < stop:
+                    stream.write (clip (member.descriptor(), member.descriptor_offset))
+        finally:
+            if read_ahead is not None:
+                read_ahead.close()
+
+        if directory_offset < stop:
+            directory = b"".join(member.central_directory_record() for member in members)
+            stream.write (clip (directory + self.__end_records (members, directory_offset),
+                                directory_offset))
+
         yield stream.get()
         self._buffer_size = stream.size()
         stream.close()
@@ -0,0 +1,173 @@
+"""
+This module tests the cache layer.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from djehuty.web import cache
+from djehuty.web.config import config
+
+class TestCacheLayer(unittest.TestCase):
+    """Class to test the cache layer."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestCacheLayer, self).__init__(*args, **kwargs)
+        self.directory = None
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        config.cache_memory_budget = 1024 * 1024
+        config.cache_memory_default_ttl = None
+        config.cache_memory_ttls = {}
+        with cache.MEMORY.lock:
+            cache.MEMORY.items.clear()
+            cache.MEMORY.size = 0
+
+    def tearDown (self):
+        config.cache_memory_budget = 0
+        self.directory.cleanup()
+
+    def cache_layer (self):
+        """Returns a cache layer on the temporary directory."""
+        layer = cache.CacheLayer (self.directory.name)
+        self.assertTrue (layer.cache_is_ready())
+        return layer
+
+    def test_invalidate_by_prefix (self):
+        """Tests removing cache items by their prefix."""
+
+        config.cache_memory_budget = 0
+        layer = self.cache_layer ()
+        layer.cache_value ("datasets", "one", [1], query="SELECT 1")
+        layer.cache_value ("datasets_account", "two", [2])
+        layer.cache_value ("account_storage", "three", [3])
+        layer.cache_value ("account_dataset_storage", "four", [4])
+
+        layer.invalidate_by_prefix ("account_storage")
+        self.assertIsNone (layer.cached_value ("account_storage", "three"))
+        self.assertEqual (layer.cached_value ("account_dataset_storage", "four"), [4])
+
+        layer.invalidate_by_prefix ("datasets")
+        self.assertIsNone (layer.cached_value ("datasets", "one"))
+        self.assertIsNone (layer.cached_value ("datasets_account", "two"))
+
+        layer.invalidate_all ()
+        self.assertIsNone (layer.cached_value ("account_dataset_storage", "four"))
+
+    def test_migrate_flat_cache (self):
+        """Tests moving items from the flat layout into prefix directories."""
+
+        key = cache.CacheLayer (None).make_key ("SELECT 1")
+        for filename in (f"datasets_account_{key}", f"datasets_account_{key}.sparql",
+                         "git_languages_uuid_commit"):
+            with open (os.path.join (self.directory.name, filename), "w",
+                       encoding="utf-8") as output:
+                output.write ("[1]")
+
+        layer = self.cache_layer ()
+        self.assertEqual (layer.cached_value ("datasets_account", key), [1])
+        remaining = [name for name in os.listdir (self.directory.name)
+                     if not name.startswith (".")]
+        self.assertEqual (remaining, [cache.STORE_DIRECTORY])
+
+    def test_memory_tier (self):
+        """Tests serving values from memory."""
+
+        layer = self.cache_layer ()
+        value = [{ "uuid": "a", "count": 1 }]
+        layer.cache_value ("datasets", "key", value)
+
+        # Remove the files to make sure the value is served from memory.
+        shutil.rmtree (os.path.join (self.directory.name, cache.STORE_DIRECTORY))
+
+        cached = layer.cached_value ("datasets", "key")
+        self.assertEqual (cached, value)
+
+        # Modifying the returned value must not modify the cache.
+        cached[0]["count"] = 2
+        self.assertEqual (layer.cached_value ("datasets", "key")[0]["count"], 1)
+
+    def test_shared_memory_tier (self):
+        """Tests that the cache layers of a process share the memory tier."""
+
+        self.cache_layer ().cache_value ("datasets", "key", [1])
+        shutil.rmtree (os.path.join (self.directory.name, cache.STORE_DIRECTORY))
+        self.assertEqual (self.cache_layer ().cached_value ("datasets", "key"), [1])
+
+        # Layers on other directories don't see the items.
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone (cache.CacheLayer (directory).cached_value ("datasets", "key"))
+
+    def invalidate_in_child (self, procedure):
+        """Procedure to call PROCEDURE on a new cache layer in a child process."""
+        pid = os.fork ()
+        if pid == 0:
+            try:
+                procedure (cache.CacheLayer (self.directory.name))
+            finally:
+                os._exit (0)  # pylint: disable=protected-access
+        os.waitpid (pid, 0)
+
+    @unittest.skipUnless (hasattr (os, "fork"), "requires os.fork")
+    def test_invalidation_between_processes (self):
+        """Tests that invalidations reach the memory of other processes."""
+
+        layer = self.cache_layer ()
+        layer.cache_value ("datasets_account", "key", [1])
+        layer.cache_value ("licenses", "key", [2])
+        self.assertEqual (layer.cached_value ("datasets_account", "key"), [1])
+
+        self.invalidate_in_child (lambda child: child.invalidate_by_prefix ("datasets"))
+        self.assertIsNone (layer.cached_value ("datasets_account", "key"))
+        self.assertEqual (layer.cached_value ("licenses", "key"), [2])
+
+        self.invalidate_in_child (lambda child: child.invalidate_all ())
+        self.assertIsNone (layer.cached_value ("licenses", "key"))
+
+    @unittest.skipUnless (os.path.isdir ("/proc/self/fd"), "requires /proc/self/fd")
+    def test_shared_lock_file (self):
+        """Tests that the cache layers of a process share one lock file."""
+
+        handle = self.cache_layer ().lock_item ("prefix", "key", timeout=0)
+        self.cache_layer ().unlock_item (handle)
+        descriptors = len(os.listdir ("/proc/self/fd"))
+        for _ in range (50):
+            layer  = self.cache_layer ()
+            handle = layer.lock_item ("prefix", "key", timeout=0)
+            self.assertIsNotNone (handle)
+            layer.unlock_item (handle)
+        self.assertEqual (len(os.listdir ("/proc/self/fd")), descriptors)
+
+    def test_budget_and_ttl (self):
+        """Tests the size budget and time-to-live of the memory tier."""
+
+        config.cache_memory_budget = 10
+        config.cache_memory_ttls = { "accounts": 0 }
+        layer = self.cache_layer ()
+        layer.cache_value ("licenses", "one", "12345")
+        layer.cache_value ("licenses", "two", "12345")
+        layer.cache_value ("accounts", "three", "1")
+        self.assertLessEqual (cache.MEMORY.size, 10)
+        self.assertEqual (len(cache.MEMORY.items), 1)
+
+    def test_stale_while_revalidate (self):
+        """Tests serving invalidated values of stale-while-revalidate prefixes."""
+
+        layer = self.cache_layer ()
+        layer.stale_prefixes.add ("statistics")
+        layer.cache_value ("statistics", "key", [1])
+        layer.cache_value ("licenses", "key", [2])
+
+        layer.invalidate_by_prefix ("statistics")
+        self.assertIsNone (layer.cached_value ("statistics", "key"))
+        self.assertEqual (layer.stale_value ("statistics", "key"), [1])
+
+        layer.invalidate_all ()
+        self.assertEqual (layer.stale_value ("statistics", "key"), [1])
+        self.assertIsNone (layer.stale_value ("licenses", "key"))
+
+        config.cache_max_staleness = 0
+        self.assertIsNone (layer.stale_value ("statistics", "key"))
+        config.cache_max_staleness = 86400
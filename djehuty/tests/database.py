@@ -0,0 +1,280 @@
+"""
+This module tests the SparqlInterface against an in-memory RDF store.
+"""
+
+import time
+import tempfile
+import unittest
+from threading import Barrier, Thread
+from rdflib import Graph, RDF, XSD, URIRef
+from rdflib.plugins.stores import sparqlstore
+from djehuty.web import database
+from djehuty.web.config import config
+from djehuty.utils import rdf
+
+class TestSparqlInterface(unittest.TestCase):
+    """Class to test queries of the SparqlInterface."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestSparqlInterface, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.db        = None  # pylint: disable=invalid-name
+        self.endpoint  = config.endpoint
+
+    def setUp (self):
+        self.directory   = tempfile.TemporaryDirectory()
+        config.endpoint  = "memory://"
+        self.db          = database.SparqlInterface()
+        self.db.cache.storage = self.directory.name
+        self.db.setup_sparql_endpoint ()
+        database.SESSION_CACHE.clear()
+
+    def tearDown (self):
+        config.endpoint = self.endpoint
+        self.directory.cleanup()
+
+    def test_sessions (self):
+        """Tests listing sessions next to the cache of session accounts."""
+
+        account_uuid = self.db.insert_account (email      = "depositor@example.org",
+                                               first_name = "Example",
+                                               last_name  = "Depositor")
+        self.assertEqual (self.db.sessions (account_uuid), [])
+
+        token, _, session_uuid = self.db.insert_session (account_uuid, name="Test")
+        self.assertEqual (self.db.account_by_session_token (token)["uuid"], account_uuid)
+        sessions = self.db.sessions (account_uuid)
+        self.assertEqual ([session["uuid"] for session in sessions], [session_uuid])
+
+        self.db.delete_session_by_uuid (account_uuid, session_uuid)
+        self.assertEqual (self.db.sessions (account_uuid), [])
+        self.assertIsNone (self.db.account_by_session_token (token))
+
+    def test_shared_session_cache (self):
+        """Tests that the accounts of sessions are remembered between requests."""
+
+        account_uuid = self.db.insert_account (email="depositor@example.org")
+        token, _, session_uuid = self.db.insert_session (account_uuid, name="Test")
+        self.assertEqual (self.db.account_by_session_token (token)["uuid"], account_uuid)
+
+        # Each request may have its own SparqlInterface.
+        other = database.SparqlInterface()
+        other.cache.storage = self.db.cache.storage
+        other.sparql = self.db.sparql
+        calls = self.slow_queries ()
+        self.assertEqual (other.account_by_session_token (token)["uuid"], account_uuid)
+        self.assertEqual (calls, [])
+
+        other.delete_session_by_uuid (account_uuid, session_uuid)
+        self.assertIsNone (self.db.account_by_session_token (token))
+
+    def test_cached_iterator (self):
+        """Tests that streamed results are cached, and that errors are raised."""
+
+        account_uuid = self.db.insert_account (email="depositor@example.org")
+        self.db.insert_dataset (title="Example", account_uuid=account_uuid)
+        query = lambda: self.db.datasets (account_uuid=account_uuid, is_published=False,
+                                          is_latest=None, as_iterator=True)
+        self.assertEqual ([dataset["title"] for dataset in query ()], ["Example"])
+
+        def fail (*args, **kwargs):
+            raise OSError ("The endpoint is down.")
+
+        # The complete result was cached, so the endpoint isn't queried again.
+        self.db.sparql.query = fail
+        self.assertEqual ([dataset["title"] for dataset in query ()], ["Example"])
+
+        self.db.cache.invalidate_by_prefix (f"datasets_{account_uuid}")
+        with self.assertLogs ("djehuty.web.database", level="ERROR"):
+            with self.assertRaises (OSError):
+                list(query ())
+
+    def test_uncached_iterator (self):
+        """Tests that results streamed without caching are not held on to."""
+
+        account_uuid = self.db.insert_account (email="depositor@example.org")
+        self.db.insert_dataset (title="Example", account_uuid=account_uuid)
+
+        cached = []
+        self.db.cache.cache_value = lambda prefix, *args, **kwargs: cached.append (prefix)
+        datasets = self.db.datasets (account_uuid=account_uuid, is_published=False,
+                                     is_latest=None, use_cache=False, as_iterator=True)
+        self.assertEqual ([dataset["title"] for dataset in datasets], ["Example"])
+        self.assertEqual ([prefix for prefix in cached if prefix.startswith ("datasets")], [])
+
+    def test_insert_missing_crc32 (self):
+        """Tests that storing a missing checksum keeps the modification date."""
+
+        file_uri = URIRef (rdf.uuid_to_uri ("file", "file"))
+        graph    = Graph()
+        rdf.add (graph, file_uri, RDF.type, rdf.DJHT["File"], "uri")
+        rdf.add (graph, file_uri, rdf.DJHT["modified_date"], "2020-01-01T00:00:00",
+                 XSD.dateTime)
+        self.assertTrue (self.db.add_triples_from_graph (graph))
+
+        query = ("SELECT ?predicate ?value WHERE { GRAPH ?graph { "
+                 f"<{file_uri}> ?predicate ?value "
+                 f"FILTER (?predicate IN (<{rdf.DJHT['modified_date']}>, "
+                 f"<{rdf.DJHT['computed_crc32']}>)) }} }}")
+        self.assertTrue (self.db.insert_missing_crc32 ("file", "0000abcd"))
+        self.assertTrue (self.db.insert_missing_crc32 ("file", "ffffffff"))
+        values = { str(row[0]): str(row[1]) for row in self.db.sparql.query (query) }
+        self.assertEqual (values, { str(rdf.DJHT["modified_date"]): "2020-01-01T00:00:00",
+                                    str(rdf.DJHT["computed_crc32"]): "0000abcd" })
+
+    def run_concurrently (self, number_of_callers, procedure):
+        """Returns the results of calling PROCEDURE from NUMBER_OF_CALLERS threads."""
+
+        results = [None] * number_of_callers
+        def call (index):
+            results[index] = procedure ()
+
+        threads = [Thread (target=call, args=(index,)) for index in range (number_of_callers)]
+        for thread in threads:
+            thread.start ()
+        for thread in threads:
+            thread.join ()
+        return results
+
+    def slow_queries (self, fail_first=False):
+        """Returns a list that counts the queries, which are made to take a while."""
+
+        calls = []
+        query = self.db.sparql.query
+        def slow_query (*args, **kwargs):
+            calls.append (args)
+            time.sleep (0.2)
+            if fail_first and len(calls) == 1:
+                raise OSError ("The endpoint is down.")
+            return query (*args, **kwargs)
+
+        self.db.sparql.query = slow_query
+        return calls
+
+    def test_coalesced_queries (self):
+        """Tests that concurrent identical queries are sent once."""
+
+        account_uuid = self.db.insert_account (email="depositor@example.org")
+        self.db.insert_dataset (title="Example", account_uuid=account_uuid)
+        calls   = self.slow_queries ()
+        results = self.run_concurrently (8, lambda: self.db.datasets (
+            account_uuid=account_uuid, is_published=False, is_latest=None))
+
+        self.assertEqual (len(calls), 1)
+        for result in results:
+            self.assertEqual ([dataset["title"] for dataset in result], ["Example"])
+        self.assertEqual (database.FLIGHTS, {})
+
+    def test_coalesced_queries_between_objects (self):
+        """Tests that queries are coalesced between the objects of a process."""
+
+        account_uuid = self.db.insert_account (email="depositor@example.org")
+        self.db.insert_dataset (title="Example", account_uuid=account_uuid)
+        calls   = self.slow_queries ()
+        objects = [self.db]
+        for _ in range (3):
+            other = database.SparqlInterface()
+            other.cache.storage = self.db.cache.storage
+            other.sparql = self.db.sparql
+            objects.append (other)
+
+        queue   = iter(objects * 2)
+        results = self.run_concurrently (8, lambda: next (queue).datasets (
+            account_uuid=account_uuid, is_published=False, is_latest=None))
+        self.assertEqual (len(calls), 1)
+        self.assertTrue (all (len(result) == 1 for result in results))
+
+    def test_coalesced_query_failure (self):
+        """Tests that waiting callers run the query themselves when it fails."""
+
+        account_uuid = self.db.insert_account (email="depositor@example.org")
+        self.db.insert_dataset (title="Example", account_uuid=account_uuid)
+        calls = self.slow_queries (fail_first=True)
+        with self.assertLogs ("djehuty.web.database", level="ERROR"):
+            results = self.run_concurrently (4, lambda: self.db.datasets (
+                account_uuid=account_uuid, is_published=False, is_latest=None))
+
+        # The caller that ran the failing query receives no datasets, while
+        # the callers that waited for it query the endpoint themselves.
+        self.assertEqual (sorted (len(result) for result in results), [0, 1, 1, 1])
+        self.assertEqual (len(calls), 4)
+        self.assertEqual (database.FLIGHTS, {})
+
+    def test_item_lock_within_process (self):
+        """Tests that the lock between processes doesn't block threads."""
+
+        first  = self.db.cache.lock_item ("prefix", "key", timeout=0)
+        second = self.db.cache.lock_item ("prefix", "key", timeout=0)
+        self.assertIsNotNone (first)
+        self.assertEqual (first, second)
+        self.db.cache.unlock_item (second)
+        self.db.cache.unlock_item (first)
+
+    def test_landing_page_bundle (self):
+        """Tests that the bundle holds the same records as the separate queries."""
+
+        account_uuid = self.db.insert_account (email="depositor@example.org")
+        _, dataset_uuid = self.db.insert_dataset (title="Example", account_uuid=account_uuid,
+                                                  tags=[{ "tag": "example" }])
+        dataset  = self.db.datasets (dataset_uuid=dataset_uuid, is_published=False,
+                                     is_latest=None)[0]
+        item_uri = rdf.uuid_to_uri (dataset_uuid, "dataset")
+
+        bundle = self.db.item_metadata_bundle (dataset)
+        self.assertEqual (set(bundle), { "versions", "authors", "files", "tags", "categories",
+                                         "references", "derived_from", "fundings",
+                                         "collections" })
+        self.assertEqual (bundle["tags"], self.db.tags (item_uri=item_uri, limit=None))
+        self.assertEqual (bundle["versions"], self.db.dataset_versions (
+            container_uri=rdf.uuid_to_uri (dataset["container_uuid"], "container")))
+        self.assertEqual (list(self.db.item_metadata_bundle (dataset, parts=["tags"])),
+                          ["tags"])
+
+    def test_parallel_landing_page_bundle (self):
+        """Tests that the queries of the bundle run concurrently for SPARQL endpoints."""
+
+        # Each of these queries waits for the others, so running them one
+        # after another breaks the barrier instead of passing it.
+        barrier = Barrier (3, timeout=5)
+        def waiting_query (name):
+            def query (**kwargs):
+                barrier.wait ()
+                return [name]
+            return query
+
+        self.db.store = sparqlstore.SPARQLStore ()
+        for name in ("tags", "categories", "references"):
+            setattr (self.db, name, waiting_query (name))
+        for name in ("authors", "fundings", "dataset_versions", "derived_from",
+                     "collections_from_dataset", "dataset_files"):
+            setattr (self.db, name, lambda **kwargs: [])
+
+        bundle = self.db.item_metadata_bundle ({ "uuid": "dataset", "container_uuid": "container" })
+        self.assertEqual (bundle["tags"], ["tags"])
+        self.assertEqual (bundle["references"], ["references"])
+        self.assertEqual (bundle["files"], [])
+
+    def test_authors_for_items (self):
+        """Tests gathering the authors of several datasets in one query."""
+
+        account_uuid = self.db.insert_account (email="depositor@example.org")
+        authors = [self.db.insert_author (full_name=name, account_uuid=account_uuid)
+                   for name in ("First", "Second", "Third")]
+        item_uris = []
+        for item_authors in ([authors[1], authors[0]], [authors[2]], []):
+            _, dataset_uuid = self.db.insert_dataset (
+                title        = "Example",
+                account_uuid = account_uuid,
+                authors      = [{ "uuid": author_uuid } for author_uuid in item_authors])
+            item_uris.append (rdf.uuid_to_uri (dataset_uuid, "dataset"))
+
+        calls = self.slow_queries ()
+        output = self.db.authors_for_items (item_uris)
+        self.assertEqual (len(calls), 1)
+        self.assertEqual (list(output), item_uris)
+        self.assertEqual ([author["full_name"] for author in output[item_uris[0]]],
+                          ["Second", "First"])
+        self.assertEqual ([author["uuid"] for author in output[item_uris[1]]], [authors[2]])
+        self.assertEqual (output[item_uris[2]], [])
+        self.assertEqual (self.db.authors_for_items ([]), {})
+        self.assertEqual (len(calls), 1)
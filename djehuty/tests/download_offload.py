@@ -0,0 +1,85 @@
+"""
+This module tests handing file downloads over to the web server.
+"""
+
+import os
+import logging
+import tempfile
+import unittest
+from defusedxml import ElementTree
+from djehuty.web import ui
+from djehuty.web import wsgi
+from djehuty.web.config import config
+
+class TestDownloadOffload(unittest.TestCase):
+    """Class to test the X-Sendfile and X-Accel-Redirect responses."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestDownloadOffload, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.server    = None
+        self.log       = logging.getLogger (__name__)
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server    = wsgi.WebServer ()
+        os.makedirs (os.path.join (self.directory.name, "storage", "nested"))
+        os.symlink (os.path.join (self.directory.name, "storage"),
+                    os.path.join (self.directory.name, "link"))
+
+    def tearDown (self):
+        config.download_offload           = None
+        config.download_offload_locations = {}
+        self.directory.cleanup()
+
+    def configure (self, mode, locations):
+        """Procedure to read the offload configuration for MODE and LOCATIONS."""
+        elements = "".join (f'<location path="{path}" uri="{uri}"/>'
+                            for path, uri in locations)
+        xml_root = ElementTree.fromstring (f'<djehuty><download-offload mode="{mode}">'
+                                           f"{elements}</download-offload></djehuty>")
+        ui.read_download_offload_configuration (xml_root, self.log)
+
+    def offload (self, filename, name):
+        """Returns the offloaded response for FILENAME, stored in the temporary directory."""
+        file_path = os.path.join (self.directory.name, filename)
+        if not os.path.exists (file_path):
+            with open (file_path, "wb") as output:
+                output.write (b"contents")
+        return self.server._WebServer__offloaded_file_response (  # pylint: disable=protected-access
+            file_path, name)
+
+    def test_accel_redirect (self):
+        """Tests mapping files onto the internal locations of the web server."""
+
+        self.configure ("x-accel-redirect", [
+            (os.path.join (self.directory.name, "link"), "/protected/"),
+            (os.path.join (self.directory.name, "storage", "..", "storage", "nested"), "/nested")])
+
+        response = self.offload ("storage/data file.csv", "data file.csv")
+        self.assertEqual (response.headers["X-Accel-Redirect"], "/protected/data%20file.csv")
+        self.assertEqual (response.content_length, 8)
+
+        response = self.offload ("link/nested/file.bin", "file.bin")
+        self.assertEqual (response.headers["X-Accel-Redirect"], "/nested/file.bin")
+
+        # Files outside the configured locations are sent by djehuty.
+        self.assertIsNone (self.offload ("elsewhere.bin", "elsewhere.bin"))
+
+        # Locations that only share the beginning of their name don't match.
+        os.makedirs (os.path.join (self.directory.name, "storage-other"))
+        self.assertIsNone (self.offload ("storage-other/file.bin", "file.bin"))
+
+    def test_content_disposition (self):
+        """Tests the file names in the Content-Disposition header."""
+
+        self.configure ("x-sendfile", [])
+        response = self.offload ("file.bin", 'naïve "quoted" name.csv')
+        self.assertEqual (response.headers["X-Sendfile"],
+                          os.path.realpath (os.path.join (self.directory.name, "file.bin")))
+        self.assertEqual (response.headers["Content-Disposition"],
+                          "attachment; filename=\"nave quoted name.csv\"; "
+                          "filename*=UTF-8''na%C3%AFve%20%22quoted%22%20name.csv")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+"""
+This module tests the pyramids used to serve IIIF image requests.
+"""
+
+import os
+import tempfile
+import unittest
+from djehuty.web import iiif
+from djehuty.web.config import config
+
+try:
+    import pyvips
+    PYVIPS_DEPENDENCY_LOADED = True
+except (OSError, ImportError, ModuleNotFoundError):
+    PYVIPS_DEPENDENCY_LOADED = False
+
+class TestIIIFPyramids(unittest.TestCase):
+    """Class to test the resolution levels of IIIF images."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestIIIFPyramids, self).__init__(*args, **kwargs)
+        self.directory = None
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        config.iiif_cache_storage = self.directory.name
+
+    def tearDown (self):
+        config.iiif_cache_storage = None
+        config.iiif_cache_budget = 10737418240
+        self.directory.cleanup()
+
+    def test_level_sizes (self):
+        """Tests the scale factors and sizes advertised in info.json."""
+
+        scale_factors, sizes = iiif.level_sizes (5000, 3001)
+        self.assertEqual (scale_factors, [1, 2, 4, 8])
+        self.assertEqual (sizes[0], { "width": 5000, "height": 3001 })
+        self.assertEqual (sizes[-1], { "width": 625, "height": 376 })
+
+        scale_factors, sizes = iiif.level_sizes (800, 600)
+        self.assertEqual (scale_factors, [1])
+        self.assertEqual (sizes, [{ "width": 800, "height": 600 }])
+
+    @unittest.skipUnless (PYVIPS_DEPENDENCY_LOADED, "requires pyvips")
+    def test_pyramid_regions (self):
+        """Tests reading regions from the level closest to the requested size."""
+
+        source = f"{self.directory.name}/source.png"
+        pyvips.Image.xyz (4096, 2048).cast ("uchar").write_to_file (source)
+
+        pyramids = iiif.Pyramids ()
+        self.assertIsNone (pyramids.full_image ("uuid"))
+        pyramids.create (source, "uuid")
+        full_image = pyramids.full_image ("uuid")
+        self.assertEqual ((full_image.width, full_image.height), (4096, 2048))
+
+        region = { "x": 1024, "y": 0, "w": 2048, "h": 2048 }
+        output = pyramids.region ("uuid", full_image, region, { "w": 512, "h": 512 })
+        self.assertEqual ((output.width, output.height), (512, 512))
+
+        output = pyramids.region ("uuid", full_image, region, { "w": 2048, "h": 2048 })
+        self.assertEqual ((output.width, output.height), (2048, 2048))
+
+        pyramids.remove ("uuid")
+        self.assertIsNone (pyramids.full_image ("uuid"))
+
+    @unittest.skipUnless (PYVIPS_DEPENDENCY_LOADED, "requires pyvips")
+    def test_pyramid_claims (self):
+        """Tests that a pyramid is created by one worker of all processes."""
+
+        source = f"{self.directory.name}/source.png"
+        pyvips.Image.xyz (2048, 2048).cast ("uchar").write_to_file (source)
+
+        # Each request may have its own Pyramids, which share the claims.
+        first, second = iiif.Pyramids (), iiif.Pyramids ()
+        self.assertTrue (first.claim ("uuid"))
+        self.assertFalse (second.claim ("uuid"))
+        self.assertTrue (second.create (source, "uuid"))
+        second.schedule (source, "uuid")
+        self.assertIsNone (second.full_image ("uuid"))
+
+        # Claims of workers that stopped expire.
+        claim_filename = f"{first.filename ('uuid')}.claim"
+        os.utime (claim_filename, (0, 0))
+        with self.assertLogs ("djehuty.web.iiif", level="WARNING"):
+            self.assertTrue (second.create (source, "uuid"))
+        self.assertIsNotNone (second.full_image ("uuid"))
+        self.assertFalse (os.path.exists (claim_filename))
+        self.assertTrue (first.claim ("uuid"))
+
+    def test_derivative_names (self):
+        """Tests that only safe requests are stored by their parameters."""
+
+        derivatives = iiif.DerivativeCache ()
+        filename = derivatives.filename ("uuid", "0,0,512,512", "!256,256", "!90",
+                                         "default", "jpg")
+        self.assertEqual (filename, os.path.join (self.directory.name, "derivatives",
+                                                  "uuid", "0,0,512,512_!256,256_!90_default.jpg"))
+        self.assertIsNone (derivatives.filename ("uuid", "..", "/etc", "0", "default", "jpg"))
+        self.assertIsNone (derivatives.filename ("uuid", "full", "x" * 255, "0", "default", "jpg"))
+
+    @unittest.skipUnless (PYVIPS_DEPENDENCY_LOADED, "requires pyvips")
+    def test_derivative_cache (self):
+        """Tests the counters, eviction and invalidation of stored outputs."""
+
+        image = pyvips.Image.xyz (64, 64).cast ("uchar")
+        config.iiif_cache_budget = len(image.write_to_buffer (".png")) * 3
+        derivatives = iiif.DerivativeCache ()
+        names = []
+        for index in range (8):
+            filename = derivatives.filename (f"uuid-{index % 2}", "full", f"{index},",
+                                             "0", "default", "png")
+            self.assertIsNone (derivatives.lookup (filename))
+            derivatives.store (filename, image, "png")
+            self.assertIsNotNone (derivatives.lookup (filename))
+            os.utime (filename, (index, index))
+            names.append (filename)
+
+        derivatives.evict ()
+        statistics = derivatives.statistics ()
+        self.assertEqual (statistics["hits"], 8)
+        self.assertEqual (statistics["misses"], 8)
+        self.assertEqual (statistics["files"], 3)
+        self.assertLessEqual (statistics["bytes"], config.iiif_cache_budget)
+        self.assertGreater (statistics["evictions"], 0)
+        self.assertFalse (os.path.isfile (names[0]))
+        self.assertTrue (os.path.isfile (names[-1]))
+
+        derivatives.invalidate ("uuid-1")
+        self.assertIsNone (derivatives.lookup (names[-1]))
+
+    @unittest.skipUnless (PYVIPS_DEPENDENCY_LOADED, "requires pyvips")
+    def test_shared_counters (self):
+        """Tests that the caches of a process share the counters and the eviction."""
+
+        image = pyvips.Image.xyz (64, 64).cast ("uchar")
+        size  = len(image.write_to_buffer (".png"))
+        config.iiif_cache_budget = size * 30
+        outdated = os.path.join (self.directory.name, "derivatives", "outdated", "full.png")
+        os.makedirs (os.path.dirname (outdated))
+        with open (outdated, "wb") as output:
+            output.write (b"0" * size * 40)
+        os.utime (outdated, (0, 0))
+
+        # Each request may have its own cache.  Together they store enough
+        # to trigger an eviction, while none of them does on its own.
+        for index in range (2):
+            filename = iiif.DerivativeCache ().filename ("uuid", "full", f"{index},",
+                                                      "0", "default", "png")
+            iiif.DerivativeCache ().store (filename, image, "png")
+            iiif.DerivativeCache ().lookup (filename)
+
+        statistics = iiif.DerivativeCache ().statistics ()
+        self.assertFalse (os.path.isfile (outdated))
+        self.assertIsNone (iiif.DerivativeCache ().lookup (outdated))
+        self.assertEqual (statistics["hits"], 2)
+        self.assertEqual (statistics["bytes_stored"], size * 2)
+        self.assertEqual (statistics["evictions"], 1)
+        self.assertEqual (statistics["files"], 2)
+        self.assertEqual (iiif.DerivativeCache ().statistics ()["misses"], 1)
+
+    @unittest.skipUnless (PYVIPS_DEPENDENCY_LOADED, "requires pyvips")
+    def test_pyramid_budget (self):
+        """Tests that pyramids are counted against the budget and evicted."""
+
+        source = f"{self.directory.name}/source.png"
+        pyvips.Image.xyz (2048, 2048).cast ("uchar").write_to_file (source)
+
+        derivatives = iiif.DerivativeCache ()
+        pyramids    = iiif.Pyramids (derivatives)
+        config.iiif_cache_budget = 1
+        self.assertTrue (pyramids.create (source, "old"))
+        os.utime (pyramids.filename ("old"), (0, 0))
+        self.assertTrue (pyramids.create (source, "new"))
+
+        # Creating a pyramid evicts those used least recently, except itself.
+        self.assertFalse (os.path.isfile (pyramids.filename ("old")))
+        self.assertIsNotNone (pyramids.full_image ("new"))
+        statistics = derivatives.statistics ()
+        self.assertEqual (statistics["pyramids"], 1)
+        self.assertEqual (statistics["bytes"], os.path.getsize (pyramids.filename ("new")))
@@ -0,0 +1,163 @@
+"""
+This module benchmarks transforming images for IIIF image requests.
+
+Each transformation runs in a separate process, so that its peak memory
+use can be measured.  The benchmarks only run when the environment
+variable DJEHUTY_BENCHMARKS is set, and log their measurements.  The width
+and height of the source images can be set with the environment variable
+DJEHUTY_IIIF_BENCHMARK_PIXELS (default: 10000).
+"""
+
+import os
+import time
+import logging
+import resource
+import tempfile
+import unittest
+import multiprocessing
+from djehuty.web import iiif
+
+try:
+    import pyvips
+    PYVIPS_DEPENDENCY_LOADED = True
+except (OSError, ImportError, ModuleNotFoundError):
+    PYVIPS_DEPENDENCY_LOADED = False
+
+PIXELS   = int(os.getenv("DJEHUTY_IIIF_BENCHMARK_PIXELS", "10000"))
+REQUESTS = {
+    "tile":   ({ "x": PIXELS // 2, "y": PIXELS // 2, "w": 1024, "h": 1024 },
+               { "w": 256, "h": 256 }),
+    "region": ({ "x": 0, "y": 0, "w": PIXELS // 2, "h": PIXELS // 2 },
+               { "w": 1000, "h": 1000 }),
+    "full":   ({ "x": 0, "y": 0, "w": PIXELS, "h": PIXELS },
+               { "w": 1024, "h": 1024 }),
+}
+
+def reference_transform (filename, is_pdf, region, size):
+    """The transformation that 'iiif.load_region' replaces."""
+    original = pyvips.Image.new_from_file (f"{filename}[dpi=300]" if is_pdf else filename)
+    output = pyvips.Image.new_temp_file (format=".jpg")
+    original.write (output)
+    output = output.crop (region["x"], region["y"], region["w"], region["h"])
+    return output.thumbnail_image (size["w"], height=size["h"], size="force")
+
+def pipeline_transform (filename, is_pdf, region, size):
+    """The transformation as performed for IIIF image requests."""
+    if is_pdf:
+        original = pyvips.Image.new_from_file (filename, dpi=300)
+    else:
+        original = pyvips.Image.new_from_file (filename)
+    output = iiif.load_region (filename, original, region, size)
+    return iiif.transform (output, size)
+
+def measure (queue, function_name, filename, is_pdf, request):
+    """Reports the seconds and the peak memory of one transformation."""
+    pyvips.cache_set_max (0)
+    baseline = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    start    = time.perf_counter()
+    region, size = REQUESTS[request]
+    output = globals()[function_name] (filename, is_pdf, region, size)
+    output.write_to_buffer (".jpg")
+    seconds  = time.perf_counter() - start
+    peak     = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss - baseline
+    queue.put ((seconds, peak, output.width, output.height))
+
+@unittest.skipUnless (os.getenv ("DJEHUTY_BENCHMARKS"), "set DJEHUTY_BENCHMARKS to run")
+@unittest.skipUnless (PYVIPS_DEPENDENCY_LOADED, "requires pyvips")
+class TestIIIFTransformBenchmark(unittest.TestCase):
+    """Class to compare the IIIF transformation with the temporary copy."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestIIIFTransformBenchmark, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.source    = None
+        self.log       = logging.getLogger (__name__)
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        xyz = pyvips.Image.xyz (PIXELS, PIXELS)
+        self.source = (xyz[0] ^ xyz[1]).cast ("uchar").bandjoin ([xyz[0], xyz[1]]).cast ("uchar")
+
+    def tearDown (self):
+        self.directory.cleanup()
+
+    def run_in_process (self, function_name, filename, is_pdf, request):
+        """Returns the result of 'measure' in a new process."""
+        context = multiprocessing.get_context ("spawn")
+        queue   = context.Queue()
+        process = context.Process (target=measure,
+                                   args=(queue, function_name, filename, is_pdf, request))
+        process.start()
+        result = queue.get()
+        process.join()
+        return result
+
+    def report (self, source, filename, is_pdf=False):
+        """Procedure to compare both transformations for FILENAME."""
+        for request, (_, size) in REQUESTS.items():
+            reference = self.run_in_process ("reference_transform", filename, is_pdf, request)
+            pipeline  = self.run_in_process ("pipeline_transform", filename, is_pdf, request)
+            self.assertEqual (pipeline[2:], (size["w"], size["h"]))
+            self.assertEqual (pipeline[2:], reference[2:])
+            self.log.info ("%s %s: %.2fs, %.0f MiB peak; reference: %.2fs, %.0f MiB peak.",
+                           source, request, pipeline[0], pipeline[1] / 1024,
+                           reference[0], reference[1] / 1024)
+
+    def test_tiff (self):
+        """Measures transforming a striped TIFF image."""
+        filename = os.path.join (self.directory.name, "source.tif")
+        self.source.tiffsave (filename)
+        self.report ("TIFF", filename)
+
+    def test_jpeg (self):
+        """Measures transforming a JPEG image."""
+        filename = os.path.join (self.directory.name, "source.jpg")
+        self.source.jpegsave (filename)
+        self.report ("JPEG", filename)
+
+    def test_pdf (self):
+        """Measures transforming a PDF document."""
+        if pyvips.type_find ("VipsOperation", "pdfload") == 0:
+            self.skipTest ("requires libvips with PDF support")
+
+        # A page of PIXELS points at 72 DPI is rendered at 300 DPI.
+        filename = os.path.join (self.directory.name, "source.pdf")
+        self.source.resize (72 / 300).write_to_file (
+            os.path.join (self.directory.name, "page.jpg"))
+        with open (filename, "wb") as output:
+            output.write (_pdf_with_image (os.path.join (self.directory.name, "page.jpg")))
+        self.report ("PDF", filename, is_pdf=True)
+
+def _pdf_with_image (jpeg_filename):
+    """Returns a single page PDF document that shows JPEG_FILENAME."""
+    image = pyvips.Image.new_from_file (jpeg_filename)
+    with open (jpeg_filename, "rb") as stream:
+        data = stream.read()
+    width, height = image.width, image.height
+    content = f"q {width} 0 0 {height} 0 0 cm /Im0 Do Q".encode("ascii")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] "
+         "/Resources << /XObject << /Im0 4 0 R >> >> /Contents 5 0 R >>").encode("ascii"),
+        (f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+         "/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode "
+         f"/Length {len(data)} >>\nstream\n").encode("ascii") + data + b"\nendstream",
+        f"<< /Length {len(content)} >>\nstream\n".encode("ascii") + content + b"\nendstream",
+    ]
+    document = b"%PDF-1.4\n"
+    offsets  = []
+    for number, body in enumerate (objects, start=1):
+        offsets.append (len(document))
+        document += f"{number} 0 obj\n".encode("ascii") + body + b"\nendobj\n"
+    xref = len(document)
+    document += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+    for offset in offsets:
+        document += f"{offset:010d} 00000 n \n".encode("ascii")
+    document += (f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+                 f"startxref\n{xref}\n%%EOF\n").encode("ascii")
+    return document
+
+if __name__ == "__main__":
+    logging.basicConfig (level=logging.INFO)
+    unittest.main()
@@ -0,0 +1,199 @@
+"""
+This module tests the spooled background job queue.
+"""
+
+import os
+import json
+import zlib
+import tempfile
+import unittest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from djehuty.web import jobs
+from djehuty.web import wsgi
+from djehuty.web.config import config
+
+class TestJobQueue(unittest.TestCase):
+    """Class to test running, retrying and recovering spooled jobs."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestJobQueue, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.calls     = []
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.calls     = []
+        config.job_storage     = self.directory.name
+        config.job_workers     = 0
+        config.job_attempts    = 2
+        config.job_retry_delay = 0
+
+    def tearDown (self):
+        config.job_storage     = None
+        config.job_workers     = 2
+        config.job_attempts    = 3
+        config.job_retry_delay = 60
+        self.directory.cleanup()
+
+    def handler (self, parameters):
+        """Records PARAMETERS and fails when asked to."""
+        self.calls.append (parameters)
+        if parameters.get ("fail"):
+            raise RuntimeError ("Failed on purpose.")
+
+    def test_run_in_order (self):
+        """Tests that jobs run once, in the order they were submitted."""
+
+        queue = jobs.JobQueue ()
+        queue.register ("record", self.handler)
+        first  = queue.submit ("record", { "index": 0 }, account_uuid="account")
+        second = queue.submit ("record", { "index": 1 })
+        self.assertEqual (queue.status (first)["state"], "queued")
+
+        self.assertTrue (queue.run_next ())
+        self.assertTrue (queue.run_next ())
+        self.assertFalse (queue.run_next ())
+        self.assertEqual ([call["index"] for call in self.calls], [0, 1])
+
+        status = queue.status (first)
+        self.assertEqual (status["state"], "done")
+        self.assertEqual (status["attempts"], 1)
+        self.assertEqual (status["account_uuid"], "account")
+        self.assertEqual (queue.status (second)["state"], "done")
+        self.assertIsNone (queue.status ("unknown"))
+
+    def test_retries (self):
+        """Tests that failing jobs are retried until they run out of attempts."""
+
+        queue = jobs.JobQueue ()
+        queue.register ("record", self.handler)
+        job_id = queue.submit ("record", { "fail": True })
+        unknown_id = queue.submit ("unknown", {})
+
+        self.assertTrue (queue.run_next ())
+        status = queue.status (job_id)
+        self.assertEqual (status["state"], "queued")
+        self.assertEqual (status["error"], "Failed on purpose.")
+
+        # Jobs without a handler are not retried.
+        self.assertTrue (queue.run_next ())
+        self.assertEqual (queue.status (unknown_id)["state"], "failed")
+
+        self.assertTrue (queue.run_next ())
+        self.assertFalse (queue.run_next ())
+        status = queue.status (job_id)
+        self.assertEqual (status["state"], "failed")
+        self.assertEqual (status["attempts"], 2)
+        self.assertEqual (len(self.calls), 2)
+        self.assertEqual (queue.statistics (),
+                          { "done": 0, "failed": 2, "running": 0, "queued": 0 })
+
+        queue.prune (retention=-1)
+        self.assertIsNone (queue.status (job_id))
+
+    def test_recover (self):
+        """Tests that jobs of a stopped process are queued again."""
+
+        queue = jobs.JobQueue ()
+        queue.register ("record", self.handler)
+        job_id = queue.submit ("record", { "index": 0 })
+
+        # Pretend a process that no longer exists claimed the job.
+        name = os.listdir (queue.directory ("queued"))[0]
+        os.makedirs (queue.directory ("running"))
+        running = os.path.join (queue.directory ("running"), f"{job_id}.json")
+        os.rename (os.path.join (queue.directory ("queued"), name), running)
+        with open (running, "r", encoding="utf-8") as stream:
+            job = json.load (stream)
+        job["pid"] = 2 ** 22 + 1
+        with open (running, "w", encoding="utf-8") as stream:
+            json.dump (job, stream)
+
+        self.assertFalse (queue.run_next ())
+        self.assertEqual (queue.status (job_id)["state"], "running")
+        queue.recover ()
+        self.assertEqual (queue.status (job_id)["state"], "queued")
+        self.assertTrue (queue.run_next ())
+        self.assertEqual (queue.status (job_id)["state"], "done")
+
+    def test_interrupted_claim (self):
+        """Tests recovering a claim of a stopped process and skipping stray files."""
+
+        queue = jobs.JobQueue ()
+        queue.register ("record", self.handler)
+        job_id = queue.submit ("record", { "index": 0 })
+        with open (os.path.join (queue.directory ("queued"), "stray.json"), "w",
+                   encoding="utf-8") as stream:
+            stream.write ("{}")
+
+        # Pretend a process that no longer exists renamed the job to claim it.
+        name = [name for name in os.listdir (queue.directory ("queued"))
+                if name.endswith (f"_{job_id}.json")][0]
+        os.makedirs (queue.directory ("running"))
+        os.rename (os.path.join (queue.directory ("queued"), name),
+                   os.path.join (queue.directory ("running"), f"{job_id}.{2 ** 22 + 1}.claim"))
+        self.assertEqual (queue.status (job_id)["state"], "running")
+        self.assertFalse (queue.run_next ())
+
+        queue.recover ()
+        self.assertEqual (queue.status (job_id)["state"], "queued")
+        self.assertTrue (queue.run_next ())
+        self.assertEqual (queue.status (job_id)["state"], "done")
+        self.assertEqual (queue.status (job_id)["attempts"], 1)
+        self.assertEqual (os.listdir (queue.directory ("running")), [])
+
+class TestComputeCrc32Checksums(unittest.TestCase):
+    """Class to test computing missing CRC-32 checksums in the background."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestComputeCrc32Checksums, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.server    = None
+        self.updates   = []
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.updates   = []
+        config.job_storage     = os.path.join (self.directory.name, "jobs")
+        config.job_workers     = 0
+        config.job_attempts    = 1
+        self.server = wsgi.WebServer ()
+        self.server.db.may_administer = lambda token: True
+        self.server.db.insert_missing_crc32 = (lambda file_uuid, computed_crc32:
+                                               self.updates.append ((file_uuid, computed_crc32))
+                                               or True)
+        self.server._WebServer__filesystem_location = (  # pylint: disable=protected-access
+            lambda file_info: file_info["filesystem_location"])
+
+    def tearDown (self):
+        config.job_storage     = None
+        config.job_workers     = 2
+        config.job_attempts    = 3
+        self.directory.cleanup()
+
+    def test_queued_checksums (self):
+        """Tests that each file is checksummed once by a job."""
+
+        files = []
+        for name in ("one", "missing"):
+            filename = os.path.join (self.directory.name, name)
+            files.append ({ "uuid": name, "account_uuid": "account", "dataset_uuid": "dataset",
+                            "name": name, "filesystem_location": filename })
+        with open (files[0]["filesystem_location"], "wb") as output:
+            output.write (b"contents")
+        self.server.db.missing_crc32_files = lambda: files + files
+
+        request  = Request (EnvironBuilder (path="/admin/maintenance/compute-crc32-checksums")
+                            .get_environ ())
+        response = self.server.ui_admin_compute_crc32_checksums (request)
+        self.assertEqual (response.status_code, 204)
+        self.assertEqual (self.updates, [])
+        self.assertEqual (self.server.jobs.statistics ()["queued"], 2)
+
+        with self.assertLogs ("djehuty.web.jobs", level="ERROR"):
+            while self.server.jobs.run_next ():
+                pass
+        crc32 = f"{zlib.crc32 (b'contents'):08x}"
+        self.assertEqual (self.updates, [("one", crc32)])
+        self.assertEqual (self.server.jobs.statistics ()["failed"], 1)
@@ -0,0 +1,113 @@
+"""
+This module tests and benchmarks normalizing the bindings of SPARQL query
+results.  The benchmark only runs when the environment variable
+DJEHUTY_BENCHMARKS is set, and logs its measurements.
+"""
+
+import os
+import time
+import logging
+import unittest
+from rdflib import Literal, URIRef, Variable, XSD
+from djehuty.web import database
+
+NUMBER_OF_ROWS = 100000
+
+def reference_normalize_binding (row):
+    """The per-row normalization that 'binding_normalizer' replaces."""
+    output = {}
+    for name in row.keys():
+        if isinstance(row[name], Literal):
+            xsd_type = row[name].datatype
+            if xsd_type == XSD.integer:
+                output[str(name)] = int(float(row[name]))
+            elif xsd_type == XSD.decimal:
+                output[str(name)] = int(float(row[name]))
+            elif xsd_type == XSD.boolean:
+                try:
+                    output[str(name)] = bool(int(row[name]))
+                except ValueError:
+                    output[str(name)] = str(row[name]).lower() == "true"
+            elif xsd_type == XSD.dateTime:
+                time_value = row[name].partition(".")[0]
+                if time_value[-1] == 'Z':
+                    time_value = time_value[:-1]
+                if time_value.endswith("+00:00"):
+                    time_value = time_value[:-6]
+                output[str(name)] = time_value
+            elif xsd_type == XSD.date:
+                output[str(name)] = row[name]
+            elif xsd_type == XSD.string:
+                if row[name] == "NULL":
+                    output[str(name)] = None
+                else:
+                    output[str(name)] = str(row[name])
+            elif xsd_type is None:
+                output[str(name)] = str(row[name])
+        elif row[name] is None:
+            output[str(name)] = None
+        else:
+            output[str(name)] = str(row[name])
+
+    return output
+
+def synthetic_result (number_of_rows):
+    """Returns NUMBER_OF_ROWS bindings resembling a query for files."""
+
+    ## Values that do not vary between rows are shared to keep building
+    ## the result fast.
+    constants = {
+        Variable("is_link_only"):  Literal("false", datatype=XSD.boolean),
+        Variable("created_date"):  Literal("2024-01-02T03:04:05.123Z",
+                                           datatype=XSD.dateTime),
+        Variable("modified_date"): Literal("2024-01-02T03:04:05+00:00",
+                                           datatype=XSD.dateTime),
+        Variable("download_url"):  Literal("NULL", datatype=XSD.string),
+        Variable("checksum"):      Literal("1.5e3", datatype=XSD.double),
+        Variable("is_public"):     Literal("1", datatype=XSD.boolean)
+    }
+
+    rows = []
+    for index in range (number_of_rows):
+        rows.append ({
+            Variable("uuid"):          Literal(f"9b4c1f4e-{index:08d}"),
+            Variable("uri"):           URIRef(f"file:9b4c1f4e-{index:08d}"),
+            Variable("name"):          Literal(f"file-{index}.csv", datatype=XSD.string),
+            Variable("bytes"):         Literal(str(index * 1024), datatype=XSD.integer),
+            Variable("size"):          Literal(f"{index}.0", datatype=XSD.decimal),
+            **constants
+        })
+    return rows
+
+class TestNormalizeBindings(unittest.TestCase):
+    """Class to compare 'binding_normalizer' with the reference."""
+
+    def test_normalize_bindings (self):
+        """Tests that the output is identical to that of the reference."""
+
+        rows = synthetic_result (1000)
+        self.assertEqual (list(map(database.binding_normalizer (), rows)),
+                          list(map(reference_normalize_binding, rows)))
+
+    @unittest.skipUnless (os.getenv ("DJEHUTY_BENCHMARKS"), "set DJEHUTY_BENCHMARKS to run")
+    def test_benchmark (self):
+        """Measures the speed-up over the reference."""
+
+        rows = synthetic_result (NUMBER_OF_ROWS)
+
+        start     = time.perf_counter()
+        reference = list(map(reference_normalize_binding, rows))
+        reference_time = time.perf_counter() - start
+
+        start     = time.perf_counter()
+        output    = list(map(database.binding_normalizer (), rows))
+        output_time = time.perf_counter() - start
+
+        self.assertEqual (output, reference)
+        logging.getLogger (__name__).info (
+            "Normalized %s rows in %.3fs (reference: %.3fs, speed-up: %.1fx).",
+            NUMBER_OF_ROWS, output_time, reference_time, reference_time / output_time)
+
+if __name__ == "__main__":
+    logging.basicConfig (level=logging.INFO)
+    unittest.main()
@@ -0,0 +1,192 @@
+"""
+This module tests parsing SPARQL results while they are being received,
+and sending SPARQL requests over a pool of connections.
+"""
+
+import gzip
+import json
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.error import HTTPError, URLError
+from rdflib import Variable
+from djehuty.web import pooled_store
+
+class TestJsonBindings(unittest.TestCase):
+    """Class to test the incremental SPARQL JSON parser."""
+
+    def result (self, bindings):
+        """Returns a SPARQL JSON result for BINDINGS as bytes."""
+        return json.dumps ({
+            "head": { "link": [], "vars": ["bindings", "title"] },
+            "results": { "distinct": False, "ordered": True, "bindings": bindings }
+        }).encode("utf-8")
+
+    def chunked (self, data, size):
+        """Returns DATA split into chunks of SIZE bytes."""
+        return [data[index:index + size] for index in range (0, len(data), size)]
+
+    def test_bindings (self):
+        """Tests reading bindings from chunks of varying size."""
+
+        bindings = [{ "title": { "type": "literal", "value": f"Dataset ✓ {index}" } }
+                    for index in range (100)]
+        data = self.result (bindings)
+        for size in (1, 7, 4096, len(data)):
+            parsed = list (pooled_store.json_bindings (self.chunked (data, size)))
+            self.assertEqual (parsed, bindings)
+
+    def test_empty_result (self):
+        """Tests reading a result without bindings."""
+
+        data = self.result ([])
+        self.assertEqual (list (pooled_store.json_bindings (self.chunked (data, 3))), [])
+        self.assertEqual (list (pooled_store.json_bindings ([])), [])
+
+    def test_incomplete_result (self):
+        """Tests that a truncated result is reported."""
+
+        data = self.result ([{ "title": { "type": "literal", "value": "a" } }] * 3)
+        with self.assertRaises (ValueError):
+            list (pooled_store.json_bindings ([data[:-20]]))
+
+class SparqlHandler (BaseHTTPRequestHandler):
+    """Answers SPARQL requests with a single binding and records them."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST (self):  # pylint: disable=invalid-name
+        """Procedure to answer a query or an update."""
+        body = self.rfile.read (int(self.headers["Content-Length"])).decode("utf-8")
+        with self.server.lock:
+            self.server.requests.append ({
+                "path":     self.path,
+                "port":     self.client_address[1],
+                "encoding": self.headers.get ("Accept-Encoding", ""),
+                "body":     body
+            })
+            status = self.server.statuses.pop (0) if self.server.statuses else 200
+
+        data = b""
+        if status == 200 and self.path == "/sparql":
+            data = gzip.compress (json.dumps ({
+                "head": { "vars": ["title"] },
+                "results": { "bindings": [
+                    { "title": { "type": "literal", "value": "Example" } }] }
+            }).encode("utf-8"))
+
+        self.send_response (status)
+        self.send_header ("Content-Type", "application/sparql-results+json")
+        self.send_header ("Content-Length", str(len(data)))
+        if data:
+            self.send_header ("Content-Encoding", "gzip")
+        self.end_headers ()
+        self.wfile.write (data)
+
+    def log_message (self, *args):  # pylint: disable=arguments-differ
+        """Procedure that keeps the test output quiet."""
+
+class TestPooledStore(unittest.TestCase):
+    """Class to test sending SPARQL requests over pooled connections."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestPooledStore, self).__init__(*args, **kwargs)
+        self.server = None
+        self.store  = None
+
+    def setUp (self):
+        self.server = ThreadingHTTPServer (("127.0.0.1", 0), SparqlHandler)
+        self.server.lock     = Lock()
+        self.server.requests = []
+        self.server.statuses = []
+        Thread (target=self.server.serve_forever, daemon=True).start ()
+        self.store = self.new_store ()
+
+    def new_store (self):
+        """Returns a store for the test server."""
+        base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        return pooled_store.PooledSPARQLUpdateStore (
+            pool_size       = 3,
+            context_aware   = False,
+            autocommit      = False,
+            query_endpoint  = f"{base_url}/sparql",
+            update_endpoint = f"{base_url}/update",
+            returnFormat    = "json",
+            method          = "POST")
+
+    def tearDown (self):
+        self.server.shutdown ()
+        self.server.server_close ()
+
+    def query (self):
+        """Returns the titles of a query."""
+        result = self.store.query ("SELECT ?title WHERE { ?s ?p ?title }", {}, {}, None)
+        return [str(row[Variable ("title")]) for row in result.bindings]
+
+    def test_keep_alive (self):
+        """Tests that threads share a few connections that are kept open."""
+
+        titles = []
+        def run_queries ():
+            for _ in range (5):
+                titles.extend (self.query ())
+
+        threads = [Thread (target=run_queries) for _ in range (3)]
+        for thread in threads:
+            thread.start ()
+        for thread in threads:
+            thread.join ()
+
+        self.assertEqual (titles, ["Example"] * 15)
+        self.assertEqual (len(self.server.requests), 15)
+        # With a connection for each thread, none is opened more than once.
+        self.assertLessEqual (len({ request["port"] for request in self.server.requests }), 3)
+        self.assertIn ("gzip", self.server.requests[0]["encoding"])
+
+    def test_shared_connections (self):
+        """Tests that the stores of a process share their connections."""
+
+        # Each request may have its own store.
+        for _ in range (5):
+            self.store = self.new_store ()
+            self.assertEqual (self.query (), ["Example"])
+
+        self.assertEqual (len(self.server.requests), 5)
+        self.assertEqual (len({ request["port"] for request in self.server.requests }), 1)
+
+    def test_errors (self):
+        """Tests that errors are reported like rdflib's own store does."""
+
+        # Queries return the error, while updates raise it, which is what
+        # the retry on 503 responses relies on.
+        self.server.statuses = [503, 503]
+        self.assertEqual (self.store.query ("SELECT * WHERE { ?s ?p ?o }", {}, {}, None)[0], 503)
+        self.store.update ("INSERT DATA { <a:s> <a:p> <a:o> }")
+        with self.assertRaises (HTTPError) as context:
+            self.store.commit ()
+        self.assertEqual (context.exception.code, 503)
+
+        # Connection failures are raised as urllib would raise them.
+        self.store.query_endpoint = "http://127.0.0.1:1/sparql"
+        with self.assertRaises (URLError):
+            self.query ()
+
+    def test_thread_edits (self):
+        """Tests that the pending edits of a thread are committed by that thread only."""
+
+        thread = Thread (target=self.store.update, args=("INSERT DATA { <a:s> <a:p> <a:o> }",))
+        thread.start ()
+        thread.join ()
+        self.store.commit ()
+        self.assertEqual (self.server.requests, [])
+
+        def update_and_commit ():
+            self.store.update ("INSERT DATA { <b:s> <b:p> <b:o> }")
+            self.store.commit ()
+
+        thread = Thread (target=update_and_commit)
+        thread.start ()
+        thread.join ()
+        self.assertEqual ([request["path"] for request in self.server.requests], ["/update"])
+        self.assertIn ("<b:s>", self.server.requests[0]["body"])
+        self.assertNotIn ("<a:s>", self.server.requests[0]["body"])
@@ -0,0 +1,407 @@
+"""
+This module tests reading objects from S3 with shared clients, and
+remembering where files are stored.
+"""
+
+import io
+import os
+import time
+import random
+import shutil
+import tempfile
+import unittest
+from threading import Lock, Thread
+from unittest import mock
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from djehuty.web import s3
+from djehuty.web import wsgi
+from djehuty.web.config import config
+
+class MockBody:
+    """Stands in for the streaming body of an S3 object."""
+
+    def __init__ (self, data):
+        self.stream = io.BytesIO (data)
+
+    def read (self):
+        """Returns the remaining bytes."""
+        return self.stream.read ()
+
+    def iter_chunks (self, chunk_size):
+        """Returns an iterator over chunks of CHUNK_SIZE bytes."""
+        return iter (lambda: self.stream.read (chunk_size), b"")
+
+    def tell (self):
+        """Returns the number of bytes read."""
+        return self.stream.tell ()
+
+    def close (self):
+        """Procedure that does nothing."""
+
+class MockS3Client:
+    """Serves objects from memory and records the requests."""
+
+    def __init__ (self, objects=None):
+        self.objects  = {} if objects is None else objects
+        self.lock     = Lock()
+        self.requests = []
+
+    def head_object (self, Bucket, Key):  # pylint: disable=invalid-name
+        """Returns the metadata of KEY."""
+        data, etag = self.objects[Key]
+        with self.lock:
+            self.requests.append (("head", Key, None))
+        return { "ContentLength": len(data), "ETag": etag }
+
+    def get_object (self, Bucket, Key, Range):  # pylint: disable=invalid-name
+        """Returns the bytes of KEY in RANGE."""
+        data, _ = self.objects[Key]
+        start, _, stop = Range[len("bytes="):].partition ("-")
+        stop = len(data) if stop == "" else int(stop) + 1
+        with self.lock:
+            self.requests.append (("get", Key, (int(start), stop)))
+        return { "Body": MockBody (data[int(start):stop]),
+                 "ResponseMetadata": { "HTTPHeaders": {
+                     "content-length": str(stop - int(start)) } } }
+
+class MockBoto3:
+    """Stands in for boto3 and records the clients it creates."""
+
+    def __init__ (self):
+        self.clients = []
+
+    def client (self, service, **kwargs):
+        """Returns a new client for SERVICE."""
+        client = MockS3Client ({ "key": (b"contents", '"etag"') })
+        self.clients.append ((service, kwargs, client))
+        return client
+
+class TestS3Clients(unittest.TestCase):
+    """Class to test sharing S3 clients between files and threads."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestS3Clients, self).__init__(*args, **kwargs)
+        self.boto3   = None
+        self.patches = []
+
+    def setUp (self):
+        self.boto3   = MockBoto3 ()
+        self.patches = [mock.patch.object (s3, "boto3", self.boto3, create=True),
+                        mock.patch.object (s3, "Config", dict, create=True)]
+        for patch in self.patches:
+            patch.start ()
+        s3.CLIENTS.clear ()
+
+    def tearDown (self):
+        for patch in self.patches:
+            patch.stop ()
+        s3.CLIENTS.clear ()
+
+    def test_shared_clients (self):
+        """Tests that one client is created per endpoint and credentials."""
+
+        clients = []
+        threads = [Thread (target=lambda: clients.append (
+                       s3.s3_client ("https://s3.example.org", "key-id", "secret")))
+                   for _ in range (8)]
+        for thread in threads:
+            thread.start ()
+        for thread in threads:
+            thread.join ()
+
+        self.assertEqual (len(self.boto3.clients), 1)
+        self.assertTrue (all (client is clients[0] for client in clients))
+        service, arguments, _ = self.boto3.clients[0]
+        self.assertEqual (service, "s3")
+        self.assertEqual (arguments["config"]["max_pool_connections"], config.s3_pool_size)
+
+        self.assertIsNot (s3.s3_client ("https://s3.example.org", "other", "secret"),
+                          clients[0])
+        self.assertEqual (len(self.boto3.clients), 2)
+
+    def test_streamers_share_clients (self):
+        """Tests that looking up and reading objects reuse the client."""
+
+        self.assertTrue (s3.s3_file_exists ("https://s3.example.org", "bucket",
+                                            "key-id", "secret", "key"))
+        for _ in range (3):
+            reader = s3.S3DownloadStreamer ("https://s3.example.org", "bucket", "key-id",
+                                            "secret", "key", "name")
+            self.assertTrue (reader.head ())
+            self.assertEqual (b"".join (reader.iterator ()), b"contents")
+            reader.close ()
+
+        self.assertEqual (len(self.boto3.clients), 1)
+        self.assertEqual (len(self.boto3.clients[0][2].requests), 7)
+
+class SlowS3Client(MockS3Client):
+    """Serves objects slowly, first returning too few bytes for SHORT_READS ranges."""
+
+    def __init__ (self, objects=None, short_reads=0):
+        super().__init__ (objects)
+        self.short_reads   = short_reads
+        self.in_flight     = 0
+        self.max_in_flight = 0
+
+    def get_object (self, Bucket, Key, Range):  # pylint: disable=invalid-name
+        with self.lock:
+            self.in_flight    += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep (random.uniform (0, 0.02))
+        response = super().get_object (Bucket, Key, Range)
+        with self.lock:
+            self.in_flight -= 1
+            if self.short_reads > 0:
+                self.short_reads -= 1
+                response["Body"] = MockBody (response["Body"].read ()[:-1])
+        return response
+
+class TestPartsIterator(unittest.TestCase):
+    """Class to test reading the parts of an object in parallel."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestPartsIterator, self).__init__(*args, **kwargs)
+        self.client = None
+        self.data   = bytes (range (256)) * 40
+        self.original_client = s3.s3_client
+
+    def setUp (self):
+        self.client  = SlowS3Client ({ "key": (self.data, '"etag"') })
+        s3.s3_client = lambda *args: self.client
+
+    def tearDown (self):
+        s3.s3_client = self.original_client
+
+    def reader (self, **kwargs):
+        """Returns a reader of the object that is read in parts."""
+        return s3.S3DownloadStreamer (None, "bucket", None, None, "key", "name",
+                                      chunk_size=100, **kwargs)
+
+    def test_ordering (self):
+        """Tests that parts fetched out of order are yielded in order."""
+
+        reader = self.reader (offset=10, part_size=512, part_workers=8, part_memory=2048)
+        ranges = reader.part_ranges ()
+        self.assertEqual (ranges[0], (10, 522))
+        self.assertEqual (ranges[-1], (9738, 10240))
+        self.assertEqual (b"".join (reader.parts_iterator (ranges)), self.data[10:])
+
+        # No more parts are held than fit in 'part_memory'.
+        self.assertEqual (self.client.max_in_flight, 4)
+        fetched = sorted (request[2] for request in self.client.requests if request[0] == "get")
+        self.assertEqual (fetched, [(start, stop) for start, stop in ranges])
+
+    def test_retries (self):
+        """Tests that incomplete parts are fetched again, up to three times."""
+
+        self.client.short_reads = 2
+        reader = self.reader (part_size=1024, part_workers=2, part_memory=1024)
+        ranges = reader.part_ranges ()
+        with self.assertLogs ("djehuty.web.s3", level="WARNING"):
+            self.assertEqual (b"".join (reader.parts_iterator (ranges)), self.data)
+        self.assertEqual (self.client.max_in_flight, 1)
+        self.assertEqual (len(self.client.requests), 1 + len(ranges) + 2)
+
+        # A part that remains incomplete ends the object early.
+        self.client.short_reads = 3
+        with self.assertLogs ("djehuty.web.s3", level="ERROR"):
+            self.assertEqual (b"".join (reader.parts_iterator (ranges)), b"")
+
+class TestS3Cache(unittest.TestCase):
+    """Class to test keeping local copies of S3 objects."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestS3Cache, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.client    = None
+        self.original_client = s3.s3_client
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        config.s3_cache_storage = self.directory.name
+        self.client  = SlowS3Client ({ name: (name.encode("utf-8") * 4, f'"{name}"')
+                                       for name in ("one", "two", "six") })
+        s3.s3_client = lambda *args: self.client
+
+    def tearDown (self):
+        config.s3_cache_storage = None
+        config.s3_cache_budget  = 10737418240
+        s3.s3_client            = self.original_client
+        self.directory.cleanup()
+
+    def cached_file (self, key):
+        """Returns the local copy of KEY."""
+        return s3.s3_cached_file (s3.S3DownloadStreamer (None, "bucket", None, None, key, key))
+
+    def downloads (self):
+        """Returns the keys that were downloaded."""
+        return [request[1] for request in self.client.requests if request[0] == "get"]
+
+    def test_reuse (self):
+        """Tests that copies are reused until the object changes."""
+
+        filename = self.cached_file ("one")
+        with open (filename, "rb") as stream:
+            self.assertEqual (stream.read (), b"oneoneoneone")
+        self.assertEqual (self.cached_file ("one"), filename)
+        self.assertEqual (self.downloads (), ["one"])
+
+        self.client.objects["one"] = (b"changed", '"changed"')
+        changed = self.cached_file ("one")
+        self.assertNotEqual (changed, filename)
+        with open (changed, "rb") as stream:
+            self.assertEqual (stream.read (), b"changed")
+        self.assertEqual (self.downloads (), ["one", "one"])
+
+    def test_eviction (self):
+        """Tests that the least recently used copies are removed first."""
+
+        config.s3_cache_budget = 30
+        one = self.cached_file ("one")
+        two = self.cached_file ("two")
+        os.utime (one, (100, 100))
+        os.utime (two, (200, 200))
+
+        # Using a copy marks it as recently used.
+        self.assertEqual (self.cached_file ("one"), one)
+        six = self.cached_file ("six")
+        self.assertTrue (os.path.exists (one))
+        self.assertFalse (os.path.exists (two))
+        self.assertTrue (os.path.exists (six))
+        self.assertEqual (self.downloads (), ["one", "two", "six"])
+
+    def test_concurrent_downloads (self):
+        """Tests that an object is downloaded once by concurrent callers."""
+
+        filenames = []
+        threads   = [Thread (target=lambda: filenames.append (self.cached_file ("one")))
+                     for _ in range (8)]
+        for thread in threads:
+            thread.start ()
+        for thread in threads:
+            thread.join ()
+
+        self.assertEqual (len(set(filenames)), 1)
+        self.assertEqual (len(filenames), 8)
+        self.assertEqual (self.downloads (), ["one"])
+
+    def test_incomplete_download (self):
+        """Tests that incomplete copies are not kept."""
+
+        self.client.short_reads = 1
+        with self.assertRaises (FileNotFoundError):
+            self.cached_file ("one")
+        self.assertEqual (os.listdir (os.path.join (self.directory.name, "objects")), [])
+        self.assertTrue (os.path.exists (self.cached_file ("one")))
+
+class TestFileLocations(unittest.TestCase):
+    """Class to test the index of file locations."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestFileLocations, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.server    = None
+        self.client    = None
+        self.endpoint  = config.endpoint
+        self.original_client = s3.s3_client
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        for name in ("first", "second", "cache"):
+            os.makedirs (os.path.join (self.directory.name, name))
+        config.endpoint = "memory://"
+        self.server     = wsgi.WebServer ()
+        self.server.db.cache.storage = os.path.join (self.directory.name, "cache")
+        self.server.db.setup_sparql_endpoint ()
+        self.client     = MockS3Client ()
+        s3.s3_client    = lambda *args: self.client
+
+    def tearDown (self):
+        config.endpoint          = self.endpoint
+        config.storage_locations = []
+        config.s3_buckets        = {}
+        s3.s3_client             = self.original_client
+        self.directory.cleanup()
+
+    def location (self, file_info):
+        """Returns the location of FILE_INFO."""
+        return self.server._WebServer__filesystem_location (file_info)  # pylint: disable=protected-access
+
+    def cached_location (self, file_uuid):
+        """Returns the remembered location of FILE_UUID."""
+        return self.server.db.cache.cached_value (f"locations_{file_uuid}", "location")
+
+    def test_moved_files (self):
+        """Tests that remembered locations are used until a file moves."""
+
+        first  = os.path.join (self.directory.name, "first")
+        second = os.path.join (self.directory.name, "second")
+        config.storage_locations = [{ "path": first }, { "path": second }]
+        with open (os.path.join (first, "data.bin"), "wb") as output:
+            output.write (b"contents")
+
+        file_info = { "uuid": "file", "filename": "data.bin", "name": "data.bin",
+                      "container_uuid": "container" }
+        self.assertEqual (self.location (file_info), os.path.join (first, "data.bin"))
+        self.assertEqual (self.cached_location ("file"), { "path": os.path.join (first, "data.bin") })
+
+        shutil.move (os.path.join (first, "data.bin"), os.path.join (second, "data.bin"))
+        self.assertEqual (self.location (file_info), os.path.join (second, "data.bin"))
+        self.assertEqual (self.cached_location ("file"), { "path": os.path.join (second, "data.bin") })
+
+        # Files that are no longer stored are not remembered.
+        os.remove (os.path.join (second, "data.bin"))
+        self.assertIsNone (self.location (file_info))
+        self.assertIsNone (self.cached_location ("file"))
+
+    def test_s3_locations (self):
+        """Tests that objects in S3 are only looked up once."""
+
+        config.storage_locations = [{ "path": os.path.join (self.directory.name, "first") }]
+        config.s3_buckets = { "bucket": { "name": "bucket", "endpoint": None, "key-id": None,
+                                          "secret-key": None, "quirks-enabled": False } }
+        self.client.objects["container_file"] = (b"contents", '"etag"')
+        file_info = { "uuid": "file", "name": "data.bin", "container_uuid": "container" }
+
+        for _ in range (3):
+            reader = self.location (file_info)
+            self.assertIsInstance (reader, s3.S3DownloadStreamer)
+            self.assertEqual ((reader.bucket, reader.filename), ("bucket", "container_file"))
+        self.assertEqual (len(self.client.requests), 1)
+
+        # Updating the location of the file forgets the remembered one,
+        # while other updates keep it.
+        self.server.db.update_file ("account", "file", "dataset", computed_crc32="00000000")
+        self.assertIsNotNone (self.cached_location ("file"))
+        self.server.db.update_file ("account", "file", "dataset",
+                                    filesystem_location="/elsewhere/data.bin")
+        self.assertIsNone (self.cached_location ("file"))
+
+    def test_deleted_files (self):
+        """Tests that removing a file from a dataset forgets its location."""
+
+        first = os.path.join (self.directory.name, "first")
+        config.storage_locations = [{ "path": first }]
+        with open (os.path.join (first, "data.bin"), "wb") as output:
+            output.write (b"contents")
+        self.location ({ "uuid": "file", "filename": "data.bin", "name": "data.bin" })
+        self.assertIsNotNone (self.cached_location ("file"))
+
+        # pylint: disable=protected-access
+        self.server.default_authenticated_error_handling = lambda *args: "account"
+        self.server._WebServer__dataset_by_id_or_uri = lambda *args, **kwargs: {
+            "uuid": "dataset", "uri": "dataset-uri" }
+        self.server._WebServer__file_by_id_or_uri = lambda *args, **kwargs: { "uuid": "file" }
+        self.server._WebServer__remove_iiif_copies = lambda file_uuids: None
+        self.server.db.delete_item_from_list = lambda *args: True
+        # pylint: enable=protected-access
+
+        request  = Request (EnvironBuilder (path="/v2/account/articles/dataset/files/file",
+                                            method="DELETE").get_environ ())
+        response = self.server.api_private_dataset_file_details (request, "dataset", "file")
+        self.assertEqual (response.status_code, 204)
+        self.assertIsNone (self.cached_location ("file"))
+
+if __name__ == "__main__":
+    unittest.main()
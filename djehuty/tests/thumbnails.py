@@ -0,0 +1,116 @@
+"""
+This module tests the responsive variants of dataset thumbnails.
+"""
+
+import os
+import tempfile
+import unittest
+from PIL import Image, features
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from djehuty.web import thumbnails
+from djehuty.web import wsgi
+from djehuty.web.config import config
+
+@unittest.skipUnless (features.check ("webp"), "requires Pillow with WebP support")
+class TestThumbnailVariants(unittest.TestCase):
+    """Class to test storing and listing thumbnail variants."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestThumbnailVariants, self).__init__(*args, **kwargs)
+        self.directory = None
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        config.thumbnail_storage = self.directory.name
+
+    def tearDown (self):
+        config.thumbnail_storage = None
+        config.thumbnail_widths  = [160, 320, 480]
+        config.thumbnail_avif    = False
+        self.directory.cleanup()
+
+    def test_variants (self):
+        """Tests the widths of the variants and the srcset listing them."""
+
+        self.assertEqual (thumbnails.sources ("/thumbnails/uuid.png"), [])
+        thumbnails.save_variants (Image.new ("RGBA", (400, 200)), "uuid")
+        for width, expected in ((160, (160, 80)), (320, (320, 160)), (480, (400, 200))):
+            with Image.open (thumbnails.variant_filename ("uuid", width, "webp")) as variant:
+                self.assertEqual (variant.format, "WEBP")
+                self.assertEqual (variant.size, expected)
+                self.assertEqual (variant.mode, "RGBA")
+
+        sources = thumbnails.sources ("/thumbnails/uuid.png")
+        self.assertEqual (sources[-1]["type"], "image/webp")
+        self.assertEqual (sources[-1]["srcset"],
+                          "/thumbnails/uuid-160.webp 160w, /thumbnails/uuid-320.webp 320w, "
+                          "/thumbnails/uuid-480.webp 480w")
+        self.assertEqual (thumbnails.sources ("https://example.org/uuid.png"), [])
+
+    def test_avif (self):
+        """Tests that AVIF variants are preferred when enabled."""
+
+        if not features.check ("avif"):
+            self.skipTest ("requires Pillow with AVIF support")
+
+        config.thumbnail_avif = True
+        thumbnails.save_variants (Image.new ("RGB", (200, 200)), "uuid")
+        sources = thumbnails.sources ("/thumbnails/uuid.jpeg")
+        self.assertEqual ([source["type"] for source in sources], ["image/avif", "image/webp"])
+
+    def test_animated (self):
+        """Tests that animated thumbnails replace their variants by none."""
+
+        thumbnails.save_variants (Image.new ("RGB", (200, 200)), "uuid")
+        self.assertNotEqual (thumbnails.sources ("/thumbnails/uuid.gif"), [])
+
+        filename = os.path.join (self.directory.name, "uuid.gif")
+        frames   = [Image.new ("RGB", (200, 200), color) for color in ("red", "blue")]
+        frames[0].save (filename, save_all=True, append_images=frames[1:])
+        with Image.open (filename) as animation:
+            thumbnails.save_variants (animation, "uuid")
+        self.assertEqual (thumbnails.sources ("/thumbnails/uuid.gif"), [])
+
+class TestCreateMissingThumbnails(unittest.TestCase):
+    """Class to test queueing thumbnails from the maintenance action."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestCreateMissingThumbnails, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.server    = None
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        config.thumbnail_storage = self.directory.name
+        config.job_storage       = os.path.join (self.directory.name, "jobs")
+        config.job_workers       = 0
+        self.server = wsgi.WebServer ()
+        self.server.db.may_administer = lambda token: True
+
+    def tearDown (self):
+        config.thumbnail_storage = None
+        config.job_storage       = None
+        config.job_workers       = 2
+        self.directory.cleanup()
+
+    def test_stored_thumbnails (self):
+        """Tests that only thumbnails without variants are queued."""
+
+        Image.new ("RGB", (300, 300)).save (os.path.join (self.directory.name, "one.png"))
+        Image.new ("RGB", (300, 300)).save (os.path.join (self.directory.name, "two.png"))
+        thumbnails.save_variants (Image.new ("RGB", (300, 300)), "two")
+        self.server.db.image_files = lambda: [
+            { "uuid": f"file-{name}", "name": f"{name}.png", "dataset_uuid": name,
+              "account_uuid": "account", "thumb": f"/thumbnails/{name}.png",
+              "thumb_origin": f"file-{name}" }
+            for name in ("one", "two")]
+
+        request  = Request (EnvironBuilder (path="/admin/maintenance/create-missing-thumbnails")
+                            .get_environ ())
+        response = self.server.ui_admin_create_missing_thumbnails (request)
+        self.assertEqual (response.status_code, 204)
+        self.assertEqual (self.server.jobs.statistics ()["queued"], 1)
+        queued = os.listdir (self.server.jobs.directory ("queued"))
+        job    = self.server.jobs.status (queued[0].split ("_", 1)[1][:-5])
+        self.assertEqual (job["parameters"]["dataset_uuid"], "one")
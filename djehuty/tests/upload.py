@@ -0,0 +1,125 @@
+"""
+This module tests writing uploads to disk with the UploadWriter.
+"""
+
+import io
+import os
+import zlib
+import hashlib
+import unittest
+from djehuty.web import s3
+from djehuty.web import upload
+
+class ShortReads(io.BytesIO):
+    """Stream that returns fewer bytes than requested, like a socket."""
+
+    def read (self, size=-1):
+        return super().read (min(size, 1000) if size > 0 else size)
+
+class MockS3Client:
+    """Records the objects written to S3."""
+
+    def __init__ (self):
+        self.objects = {}
+        self.uploads = {}
+
+    def put_object (self, Bucket, Key, Body):
+        """Stores BODY as KEY."""
+        self.objects[(Bucket, Key)] = Body
+
+    def create_multipart_upload (self, Bucket, Key):
+        """Starts a multipart upload."""
+        self.uploads[(Bucket, Key)] = {}
+        return { "UploadId": "upload" }
+
+    def upload_part (self, Bucket, Key, UploadId, PartNumber, Body):
+        """Stores part PARTNUMBER."""
+        self.uploads[(Bucket, Key)][PartNumber] = Body
+        return { "ETag": f"etag-{PartNumber}-{UploadId}" }
+
+    def complete_multipart_upload (self, Bucket, Key, UploadId, MultipartUpload):
+        """Joins the parts listed in MULTIPARTUPLOAD."""
+        parts = self.uploads.pop ((Bucket, Key))
+        self.objects[(Bucket, Key)] = b"".join (parts[part["PartNumber"]]
+            for part in MultipartUpload["Parts"])
+
+    def abort_multipart_upload (self, Bucket, Key, UploadId):
+        """Discards the parts."""
+        self.uploads.pop ((Bucket, Key))
+
+class TestUploadWriter(unittest.TestCase):
+    """Class to test receiving uploads."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestUploadWriter, self).__init__(*args, **kwargs)
+        self.client = None
+        self.original_client = s3.s3_client
+
+    def setUp (self):
+        self.client = MockS3Client ()
+        s3.s3_client = lambda *args: self.client
+
+    def tearDown (self):
+        s3.s3_client = self.original_client
+
+    def test_checksums (self):
+        """Tests the checksums and size of the data written to disk."""
+
+        for size in (0, 1, 4096, 300001):
+            data   = os.urandom (size)
+            output = io.BytesIO ()
+            writer = upload.UploadWriter (output, chunk_size=4096, sha256=True)
+            self.assertEqual (writer.copy (ShortReads (data + b"ending"), size), size)
+            checksums = writer.finish ()
+
+            self.assertEqual (output.getvalue (), data)
+            self.assertEqual (checksums["md5"], hashlib.md5 (data).hexdigest ())
+            self.assertEqual (checksums["sha256"], hashlib.sha256 (data).hexdigest ())
+            self.assertEqual (checksums["crc32"], f"{zlib.crc32 (data):08x}")
+            self.assertFalse (checksums["s3"])
+
+    def test_truncated_upload (self):
+        """Tests that a body that ends early is not written beyond its end."""
+
+        output = io.BytesIO ()
+        writer = upload.UploadWriter (output)
+        self.assertEqual (writer.copy (io.BytesIO (b"12345"), 10), 5)
+        self.assertIsNone (writer.finish (complete=False)["sha256"])
+
+    def test_s3_write_through (self):
+        """Tests copying uploads to S3 in parts."""
+
+        bucket = { "name": "bucket", "endpoint": None, "key-id": None,
+                   "secret-key": None, "part-size": 5242880, "part-workers": 2 }
+        for size in (100, 5242880 * 2 + 17):
+            data   = os.urandom (size)
+            writer = upload.UploadWriter (io.BytesIO (), chunk_size=1048576,
+                                          bucket=bucket, filename=f"{size}")
+            writer.copy (io.BytesIO (data), size)
+            self.assertTrue (writer.finish ()["s3"])
+            self.assertEqual (self.client.objects[("bucket", f"{size}")], data)
+
+        writer = upload.UploadWriter (io.BytesIO (), bucket=bucket, filename="partial")
+        writer.copy (io.BytesIO (os.urandom (5242880 + 1)), 5242880 + 1)
+        self.assertFalse (writer.finish (complete=False)["s3"])
+        self.assertNotIn (("bucket", "partial"), self.client.objects)
+        self.assertEqual (self.client.uploads, {})
+
+    def test_s3_md5_mismatch (self):
+        """Tests that S3 uploads are discarded when the MD5 does not match."""
+
+        bucket = { "name": "bucket", "endpoint": None, "key-id": None,
+                   "secret-key": None, "part-size": 5242880, "part-workers": 2 }
+        data   = os.urandom (5242880 + 1)
+        writer = upload.UploadWriter (io.BytesIO (), bucket=bucket, filename="mismatch")
+        writer.copy (io.BytesIO (data), len(data))
+        checksums = writer.finish (expected_md5="0" * 32)
+        self.assertEqual (checksums["md5"], hashlib.md5 (data).hexdigest ())
+        self.assertFalse (checksums["s3"])
+        self.assertNotIn (("bucket", "mismatch"), self.client.objects)
+        self.assertEqual (self.client.uploads, {})
+
+        writer = upload.UploadWriter (io.BytesIO (), bucket=bucket, filename="match")
+        writer.copy (io.BytesIO (data), len(data))
+        self.assertTrue (writer.finish (expected_md5=hashlib.md5 (data).hexdigest ())["s3"])
+        self.assertEqual (self.client.objects[("bucket", "match")], data)
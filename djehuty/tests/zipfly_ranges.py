@@ -0,0 +1,217 @@
+"""
+This module tests producing byte ranges of ZIP archives with ZipFly.
+"""
+
+import io
+import os
+import zlib
+import random
+import zipfile
+import tempfile
+import logging
+import unittest
+from threading import Barrier
+from unittest import mock
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from djehuty.web import s3
+from djehuty.web import wsgi
+from djehuty.web import zipfly
+from djehuty.utils import convenience
+
+class HeadedObject:
+    """Class that stands in for an S3 object whose metadata is read."""
+
+    def __init__(self, name, size, barrier=None, exists=True):
+        self.original_filename = name
+        self.content_length    = None
+        self.last_modified     = None
+        self.size              = size
+        self.barrier           = barrier
+        self.exists            = exists
+
+    def head (self):
+        """Returns whether the object exists, after all objects were asked."""
+        if self.barrier is not None:
+            self.barrier.wait ()
+        self.content_length = self.size
+        self.last_modified  = (2024, 1, 1, 0, 0, 0)
+        return self.exists
+
+class ReadError (Exception):
+    """Exception that stands in for an error of reading from S3."""
+
+class TestZipflyRanges(unittest.TestCase):
+    """Class to test resuming the download of ZIP archives."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestZipflyRanges, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.paths = []
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = []
+        for index, size in enumerate([0, 1, 1000, 300000, 70000]):
+            filename = os.path.join (self.directory.name, f"{index}.bin")
+            with open (filename, "wb") as output:
+                output.write (os.urandom (size))
+            self.paths.append ({ "fs": filename, "n": f"data/ñame-{index}.bin" })
+
+    def tearDown (self):
+        self.directory.cleanup()
+
+    def archive (self, flush_threshold=65536):
+        """Returns a ZipFly object for the test files."""
+        return zipfly.ZipFly (paths = [dict(path) for path in self.paths],
+                              chunksize = 4096,
+                              flush_threshold = flush_threshold)
+
+    def test_archive_layout (self):
+        """Tests that the archive is valid and has the predicted size."""
+
+        archive = self.archive ()
+        output  = b"".join (archive.generator ())
+        self.assertEqual (len(output), archive.archive_size ())
+
+        with zipfile.ZipFile (io.BytesIO (output)) as reader:
+            self.assertIsNone (reader.testzip ())
+            self.assertEqual (len(reader.namelist ()), len(self.paths))
+            with open (self.paths[3]["fs"], "rb") as original:
+                self.assertEqual (reader.read ("data/ñame-3.bin"), original.read ())
+
+    def test_stored_checksums (self):
+        """Tests writing complete local headers from stored checksums."""
+
+        without_checksums = b"".join (self.archive ().generator ())
+        for path in self.paths[::2]:
+            with open (path["fs"], "rb") as stream:
+                path["crc32"] = zlib.crc32 (stream.read ())
+
+        archive = self.archive ()
+        output  = b"".join (archive.generator ())
+        self.assertEqual (len(output), archive.archive_size ())
+        self.assertLess (len(output), len(without_checksums))
+        with zipfile.ZipFile (io.BytesIO (output)) as reader:
+            self.assertIsNone (reader.testzip ())
+            self.assertEqual (reader.infolist ()[0].flag_bits & 0x08, 0)
+            self.assertEqual (reader.infolist ()[1].flag_bits & 0x08, 0x08)
+
+        start, stop = len(output) // 3, len(output) - 10
+        self.assertEqual (b"".join (self.archive ().generator (start, stop)),
+                          output[start:stop])
+
+    def test_ranges (self):
+        """Tests that ranges are the same bytes as the full archive."""
+
+        full = b"".join (self.archive ().generator ())
+        generator = random.Random (1)
+        for _ in range (50):
+            start = generator.randrange (len(full))
+            stop  = generator.randrange (start, len(full) + 1)
+            part  = b"".join (self.archive (flush_threshold=0).generator (start, stop))
+            self.assertEqual (part, full[start:stop])
+
+    def test_archive_tag (self):
+        """Tests that the tag only changes when the archive changes."""
+
+        archive = self.archive ()
+        tag     = archive.archive_tag ()
+        for _ in archive.generator ():
+            pass
+        self.assertEqual (archive.archive_tag (), tag)
+        self.assertEqual (self.archive ().archive_tag (), tag)
+
+        self.paths[0]["n"] = "renamed.bin"
+        self.assertNotEqual (self.archive ().archive_tag (), tag)
+
+    def test_concurrent_heads (self):
+        """Tests that the metadata of S3 objects is read concurrently."""
+
+        barrier = Barrier (3, timeout=5)
+        objects = [HeadedObject (f"{index}.bin", 1000 * index, barrier, index != 1)
+                   for index in range (3)]
+        archive = zipfly.ZipFly (paths = [{ "s3": item } for item in objects],
+                                 read_ahead = 3)
+        with mock.patch.object (zipfly, "S3_ENABLED", True):
+            members, _, _ = archive.layout ()
+
+        self.assertEqual ([member.name for member in members], [b"0.bin", b"2.bin"])
+        self.assertEqual ([member.size for member in members], [0, 2000])
+
+class TestDownloadAllFiles(unittest.TestCase):
+    """Class to test the Range requests of the download of all files."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestDownloadAllFiles, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.server    = None
+        self.events    = []
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.events    = []
+        files = []
+        for index in range (3):
+            filename = os.path.join (self.directory.name, f"{index}.bin")
+            with open (filename, "wb") as output:
+                output.write (os.urandom (1000))
+            files.append ({ "uuid": f"file-{index}", "name": f"{index}.bin",
+                            "filesystem_location": filename })
+
+        dataset = { "title": "Example", "container_uuid": "container" }
+        self.server = wsgi.WebServer ()
+        self.server._WebServer__accessible_files_for_dataset = (  # pylint: disable=protected-access
+            lambda request, dataset_id, version=None: (dataset, files))
+        self.server._WebServer__filesystem_location = (  # pylint: disable=protected-access
+            lambda file_info: file_info["filesystem_location"])
+        self.server._WebServer__log_download_event = (  # pylint: disable=protected-access
+            lambda request, container_uuid: self.events.append (container_uuid))
+
+    def tearDown (self):
+        self.directory.cleanup()
+
+    def download (self, byte_range=None):
+        """Returns the response to a download of the archive of BYTE_RANGE."""
+        headers = {} if byte_range is None else { "Range": byte_range }
+        request = Request (EnvironBuilder (path="/ndownloader/items/1/versions/1",
+                                           headers=headers).get_environ ())
+        return self.server.ui_download_all_files (request, "1", 1)
+
+    def test_ranges (self):
+        """Tests single, multiple and unsatisfiable ranges."""
+
+        response = self.download ()
+        self.assertEqual (response.status_code, 200)
+        full = b"".join (response.response)
+        self.assertEqual (len(full), response.content_length)
+        self.assertEqual (self.events, ["container"])
+
+        response = self.download ("bytes=100-199")
+        self.assertEqual (response.status_code, 206)
+        self.assertEqual (b"".join (response.response), full[100:200])
+        self.assertEqual (response.headers["Content-Range"], f"bytes 100-199/{len(full)}")
+        self.assertEqual (self.events, ["container"])
+
+        response = self.download ("bytes=0-9,100-199")
+        self.assertEqual (response.status_code, 200)
+        self.assertEqual (b"".join (response.response), full)
+        self.assertEqual (len(self.events), 2)
+
+        response = self.download (f"bytes={len(full)}-")
+        self.assertEqual (response.status_code, 416)
+        self.assertEqual (response.headers["Content-Range"], f"bytes */{len(full)}")
+
+    def test_s3_error (self):
+        """Tests that errors of reading metadata from S3 are answered."""
+
+        def fail (*args, **kwargs):
+            raise ReadError ("The endpoint is unreachable.")
+
+        convenience.add_logging_level ("AUDIT", logging.INFO + 6)
+        with mock.patch.object (s3, "S3_ERRORS", (ReadError,)), \
+             mock.patch.object (zipfly.ZipFly, "archive_size", fail), \
+             self.assertLogs ("djehuty.web.wsgi", level="ERROR"):
+            response = self.download ()
+        self.assertEqual (response.status_code, 500)
+        self.assertEqual (self.events, [])
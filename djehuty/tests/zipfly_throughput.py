@@ -0,0 +1,170 @@
+"""
+This module benchmarks building ZIP archives with ZipFly.
+
+The benchmarks only run when the environment variable DJEHUTY_BENCHMARKS
+is set, and log their measurements.  The size of each archive can be set
+with the environment variable DJEHUTY_ZIPFLY_BENCHMARK_GIB (default: 2).
+"""
+
+import os
+import io
+import time
+import logging
+import tempfile
+import unittest
+from djehuty.web import zipfly
+
+GIB             = 1024 * 1024 * 1024
+ARCHIVE_SIZE    = int(float(os.getenv("DJEHUTY_ZIPFLY_BENCHMARK_GIB", "2")) * GIB)
+NUMBER_OF_FILES = 4
+
+class ReferenceZipflyStream (io.RawIOBase):
+    """The stream that 'ZipflyStream' replaces."""
+    def __init__ (self, flush_threshold=0):  # pylint: disable=unused-argument
+        self._buffer = b""
+        self._size = 0
+
+    def writable (self):
+        """Returns True to signify the stream is writable."""
+        return True
+
+    def write (self, b):
+        """Procedure to write a chunk to the opened stream."""
+        self._buffer += b
+        return len(b)
+
+    def ready (self):
+        """Returns True to read after every write."""
+        return True
+
+    def get (self):
+        """Procedure to read a chunk from the opened stream."""
+        chunk = self._buffer
+        self._buffer = b""
+        self._size += len(chunk)
+        return chunk
+
+    def size (self):
+        """Returns the current size of the stored stream."""
+        return self._size
+
+class MockS3Object:
+    """Stands in for 'S3DownloadStreamer' with an object of zeros."""
+
+    def __init__ (self, name, content_length, chunk_size=32768, latency=0):
+        self.original_filename = name
+        self.latency           = latency
+        self.content_length    = content_length
+        self.last_modified     = (2024, 1, 1, 0, 0, 0)
+        self.chunk_size        = chunk_size
+        self.offset            = 0
+        self.file_contents     = True
+
+    def head (self):
+        """Returns True because the metadata is always available."""
+        return True
+
+    def connect (self):
+        """Procedure that waits for the time to the first byte."""
+        time.sleep (self.latency)
+
+    def iterator (self):
+        """Returns an iterator over the contents of the object."""
+        chunk = bytes(self.chunk_size)
+        remaining = self.content_length - self.offset
+        while remaining > 0:
+            yield chunk[:remaining]
+            remaining -= self.chunk_size
+
+    def close (self):
+        """Procedure that does nothing."""
+
+@unittest.skipUnless (os.getenv ("DJEHUTY_BENCHMARKS"), "set DJEHUTY_BENCHMARKS to run")
+class TestZipflyThroughput(unittest.TestCase):
+    """Class to measure the throughput of building ZIP archives."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestZipflyThroughput, self).__init__(*args, **kwargs)
+        self.directory = None
+        self.log       = logging.getLogger (__name__)
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown (self):
+        zipfly.ZipflyStream = STREAM_CLASS
+        zipfly.S3_ENABLED = S3_ENABLED
+        self.directory.cleanup()
+
+    def measure (self, paths_function, stream_class, **parameters):
+        """
+        Returns the size of the archive, the number of chunks it was
+        yielded in and the number of seconds it took.
+        """
+
+        zipfly.ZipflyStream = stream_class
+        start = time.perf_counter()
+        size = 0
+        chunks = 0
+        for chunk in zipfly.ZipFly(paths = paths_function(), **parameters).generator():
+            size += len(chunk)
+            chunks += 1
+        return size, chunks, time.perf_counter() - start
+
+    def report (self, source, paths_function):
+        """Procedure to compare both streams for the files of PATHS_FUNCTION."""
+
+        reference_size, reference_chunks, reference_time = self.measure (
+            paths_function, ReferenceZipflyStream, chunksize = 32768)
+        size, chunks, seconds = self.measure (paths_function, STREAM_CLASS)
+
+        self.assertEqual (size, reference_size)
+        self.log.info ("%s: %.2f GiB in %.2fs (%.0f MiB/s, %s chunks); "
+                       "reference: %.0f MiB/s, %s chunks.",
+                       source, size / GIB, seconds, size / seconds / 1048576, chunks,
+                       reference_size / reference_time / 1048576, reference_chunks)
+
+    def test_filesystem (self):
+        """Measures building an archive of files on the filesystem."""
+
+        paths = []
+        for index in range (NUMBER_OF_FILES):
+            path = os.path.join (self.directory.name, f"file-{index}.bin")
+            with open (path, "wb") as output:
+                # A sparse file avoids measuring the disk.
+                output.truncate (ARCHIVE_SIZE // NUMBER_OF_FILES)
+            paths.append ({ "fs": path, "n": f"file-{index}.bin" })
+
+        self.report ("Filesystem", lambda: [dict(path) for path in paths])
+
+    def test_s3 (self):
+        """Measures building an archive of objects streamed from S3."""
+
+        zipfly.S3_ENABLED = True
+        self.report ("S3", lambda: [{ "s3": MockS3Object (f"object-{index}.bin",
+                                                          ARCHIVE_SIZE // NUMBER_OF_FILES),
+                                      "n": f"object-{index}.bin" }
+                                    for index in range (NUMBER_OF_FILES)])
+
+    def test_s3_read_ahead (self):
+        """Measures reading S3 objects ahead when each object has latency."""
+
+        zipfly.S3_ENABLED = True
+        def paths ():
+            return [{ "s3": MockS3Object (f"object-{index}.bin", 1048576, latency=0.05),
+                      "n": f"object-{index}.bin" } for index in range (64)]
+
+        sequential_size, _, sequential_time = self.measure (paths, STREAM_CLASS)
+        size, _, seconds = self.measure (paths, STREAM_CLASS, read_ahead = 8,
+                                         read_ahead_memory = 8388608)
+        self.assertEqual (size, sequential_size)
+        self.assertLess (seconds, sequential_time)
+        self.log.info ("S3 with 50ms latency: %.2fs with read-ahead; %.2fs without.",
+                       seconds, sequential_time)
+
+STREAM_CLASS = zipfly.ZipflyStream
+S3_ENABLED   = zipfly.S3_ENABLED
+
+if __name__ == "__main__":
+    logging.basicConfig (level=logging.INFO)
+    unittest.main()